@@ -0,0 +1,72 @@
+"""
+Benchmarks BiasCrate against the simulated I2C bus (see src/sparkybiasd/simbus.py).
+Reports wall time and I2C transaction counts for the common operations so that changes to
+hardware.py / midlevel.py can be compared with real numbers. Runs on any Linux box.
+
+    python benchmark.py
+    python benchmark.py --cards 4 --targets 0.5 2.0 4.0
+"""
+
+import argparse
+import tempfile
+import time
+
+from sparkybiasd.midlevel import BiasCrate
+from sparkybiasd.simbus import SimulatedBus
+
+
+def measure(bus: SimulatedBus, func, *args, **kwargs):
+    """Run func once; returns (wall seconds, I2C transactions, simulated bus seconds, result)"""
+    bus.reset_stats()
+    t0 = time.perf_counter()
+    res = func(*args, **kwargs)
+    dt = time.perf_counter() - t0
+    return dt, bus.stats["transactions"], bus.stats["busTime"], res
+
+
+def report(name: str, dt: float, transactions: int, bustime: float):
+    print(f"{name:<32} {dt * 1000:>10.1f} ms {transactions:>8d} txn {bustime * 1000:>10.1f} ms bus")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cards", type=int, default=18, help="Number of cards in the simulated crate")
+    parser.add_argument("--bitrate", type=int, default=100_000, help="I2C clock in Hz")
+    parser.add_argument("--overhead", type=float, default=50e-6, help="Fixed cost per transaction in seconds")
+    parser.add_argument("--virtual", action="store_true", help="Don't sleep for bus time, use a virtual clock")
+    parser.add_argument("--targets", type=float, nargs="+", default=[0.5, 2.0, 4.0], help="Seek voltages")
+    args = parser.parse_args()
+
+    bus = SimulatedBus(
+        cards=range(1, args.cards + 1), bitrate=args.bitrate, overhead=args.overhead, realtime=not args.virtual
+    )
+    # Start without learned transfer curves so every run measures blind seeks
+    curve_path = tempfile.mkdtemp() + "/transfer_curves.yaml"
+    dt, n, bt, crate = measure(bus, BiasCrate, bus, curve_path)
+    report("BiasCrate()", dt, n, bt)
+    crate.clock = bus.now  # Latency metrics in simulated bus time
+
+    dt, n, bt, _ = measure(bus, crate.enable_output, 1, 1)
+    report("enable_output", dt, n, bt)
+    dt, n, bt, _ = measure(bus, crate.get_status, 1, 1)
+    report("get_status", dt, n, bt)
+
+    for v in args.targets:
+        dt, n, bt, _ = measure(bus, crate.seek_voltage, 1, 1, v)
+        report(f"seek_voltage -> {v} V", dt, n, bt)
+
+    crate.enable_all_outputs()
+    targets = [(card, ch, 0.4 * ch) for card in crate.cards for ch in range(1, 8 + 1)]
+    dt, n, bt, _ = measure(bus, crate.seek_many, targets, "vbus")
+    report(f"seek_many x{len(targets)}", dt, n, bt)
+
+    dt, n, bt, _ = measure(bus, crate.get_crate_status)
+    report("get_crate_status", dt, n, bt)
+
+    dt, n, bt, timing = measure(bus, crate.emergency_disable, True)
+    report("emergency_disable", dt, n, bt)
+    print(f"{'':<32} outputs off after {timing['safe'] * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,7 @@
 """
 
-Implements a Bias Crate Daemon that listens to a redis pub-sub channel for commands
-and executes them. 
+Implements a Bias Crate Daemon that listens to a redis pub-sub channel (or a redis stream, see serve_streams)
+for commands and executes them. 
 Functions defined in midlevel.py handle the actual execution of system-wide commands such as seeking voltages, 
 enabling outputs, etc. 
 
@@ -15,8 +15,8 @@ in https://asu-rdl.github.io/Primecam-Bias/software.html or Primecam-Bias/docs/s
 
 This has been setup to run as a systemd service, and will automatically start on boot.
 
-Redis is simply used to broker the communication between a client and the daemon. In theory, it should be 
-fairly straightforward to replace redis with some other pub-sub system or perhaps even a direct socket connection.
+Redis is simply used to broker the communication between a client and the daemon. Local clients can skip it and
+send the same commands over a Unix or TCP socket instead, see sockets.py.
 
 """
 
@@ -39,134 +39,549 @@ logger.getChild("dconf").addHandler(log_handler)
 logger.getChild("midlevel").addHandler(log_handler)
 
 
+import asyncio
+import contextvars
 import redis
+import redis.asyncio as aioredis
 import redis.exceptions
 import os
-from .midlevel import BiasCrate
+from .midlevel import BiasCrate, ConfigError
+from .scheduler import SAFETY, BusScheduler, priority, safety_scope
+from .macros import MacroError, MacroRun, MacroStore
+from .mirror import StateMirror
+from .schema import SchemaError, compile_schema
+from .sockets import SocketServer
+from .telestream import TelemetryStream
+from .seek import SEEK_MODES
 
 from omegaconf import OmegaConf
 import json
-import time
+
+# Named server side macros, see macros.py
+macro_store = MacroStore(CONFIGPATH + "macros.yaml")
+# Commands that can't be used inside a macro
+NOT_IN_MACROS = ("batch", "defineMacro", "runMacro", "deleteMacro", "listMacros", "cancel")
+# Safety commands jump the bus queue and cancel the operations they conflict with, see preempt()
+SAFETY_COMMANDS = ("disableOutput", "disableAllOutputs")
+# Commands that drive outputs and are cancelled by a conflicting safety command
+PREEMPTIBLE = (
+    "seekVoltage", "seekCurrent", "seekVoltageMany", "seekCurrentMany", "enableOutput", "enableTestload",
+    "disableTestload", "setAdcProfile", "loadConfig", "batch", "runMacro",
+)
 
 
 @dataclass
+class Operation:
+    """A command being executed. cancelled_by is set once something asked for it to be cancelled."""
+    command: dict
+    task: asyncio.Task
+    cancelled_by: str = None
+
+
+# Commands that hold the lock of every output they drive or measure while they run (see _channels_of), so two of
+# them never interleave their bus jobs on one output. Safety commands take no locks, they cancel what they conflict
+# with instead. A batch or macro takes none itself, its commands do. Neither does a getStatus the telemetry buffer
+# can answer (see BiasCrate.cached_status).
+CHANNEL_LOCKED = (
+    "seekVoltage", "seekCurrent", "seekVoltageMany", "seekCurrentMany", "getStatus", "enableOutput",
+    "enableTestload", "disableTestload", "setAdcProfile", "loadConfig",
+)
+
+# Commands that change or measure the state mirrored to redis (see mirror.py). A batch or macro marks nothing
+# itself, its commands do.
+STATE_COMMANDS = (
+    "seekVoltage", "seekCurrent", "seekVoltageMany", "seekCurrentMany", "getStatus", "getCrateStatus", "enableOutput",
+    "disableOutput", "enableTestload", "disableTestload", "loadConfig", "disableAllOutputs",
+)
+# Set by serve() when conf.mirror.enabled
+state_mirror: StateMirror = None
+
+# Commands in flight, outermost first. The commands of a batch or macro are listed after it.
+operations: list[Operation] = []
+# Innermost command being executed by the current task
+current_operation = contextvars.ContextVar("current_operation", default=None)
+
+
+
+def _json_number(value) -> str:
+    """json text of a number, as json.dumps would write it"""
+    cls = value.__class__
+    if cls is float and value - value == 0.0:  # Finite
+        return float.__repr__(value)
+    if cls is int:
+        return int.__repr__(value)
+    return json.dumps(value.item() if hasattr(value, "item") else value)  # numpy scalars, NaN, ...
+
+
+_json_string = json.encoder.encode_basestring_ascii
+# Precompiled reply encodings, same text as json.dumps of the equivalent dict
+_SUCCESS_REPLY = (
+    '{"status": %s, "card": %s, "channel": %s, "vbus": %s, "vshunt": %s, "current": %s, "outputEnabled": %s, '
+    '"wiper": %s}'
+)
+_ERROR_REPLY = '{"status": %s, "code": %s, "msg": %s}'
+
+
 class reply:
-    status = ""
-    code = 0
-    errormessage = ""
-    card = 0
-    channel = 0
-    vbus = 0.0
-    vshunt = 0.0
-    current = 0.0
-    outputEnabled = False
-    wiper = 0
+    """
+    Reply of a command: status, code and errormessage for errors, plus the channel readings of single channel
+    commands. success_str() and error_str() fill precompiled json templates.
+    """
+    __slots__ = (
+        "status", "code", "errormessage", "card", "channel", "vbus", "vshunt", "current", "outputEnabled", "wiper"
+    )
+
+    def __init__(self):
+        self.status = ""
+        self.code = 0
+        self.errormessage = ""
+        self.card = 0
+        self.channel = 0
+        self.vbus = 0.0
+        self.vshunt = 0.0
+        self.current = 0.0
+        self.outputEnabled = False
+        self.wiper = 0
+
     def success_str(self):
-        return json.dumps({
-            "status": self.status, "card": self.card, "channel": self.channel,
-            "vbus": self.vbus, "vshunt": self.vshunt, "current": self.current,
-            "outputEnabled": self.outputEnabled, "wiper": self.wiper, })
+        return _SUCCESS_REPLY % (
+            _json_string(self.status), _json_number(self.card), _json_number(self.channel),
+            _json_number(self.vbus), _json_number(self.vshunt), _json_number(self.current),
+            "true" if self.outputEnabled else "false", _json_number(self.wiper))
+
     def error_str(self):
-        return json.dumps({
-            "status": self.status, "code": self.code, "msg": self.errormessage
-        })
+        return _ERROR_REPLY % (_json_string(self.status), _json_number(self.code), _json_string(self.errormessage))
+
+
+def _error(code: int, message: str) -> reply:
+    r = reply()
+    r.status = "error"
+    r.code = code
+    r.errormessage = message
+    return r
 
 
-def validate_command(command_data) -> bool:
-    """Valudate the command data against the expected structure, and parameters."""
-    rep = reply()
+def validate_command(command_data) -> tuple:
+    """
+    Validate the envelope of a command, then its arguments with the command's compiled schema (see schema.py).
 
+    Returns:
+        (True, the arguments coerced to their declared types) or (False, reply describing the error)
+    """
     if not isinstance(command_data, dict):
-        rep.status = "error"
-        rep.code = -3
-        rep.errormessage = "Command data must be a dictionary"
-        return False, rep
+        return False, _error(-3, "Command data must be a dictionary")
     if 'command' not in command_data or 'args' not in command_data:
-        rep.status = "error"
-        rep.code = -4
-        rep.errormessage = "Command data must contain 'command' and 'args' keys"
-        return False, rep
-    if not isinstance(command_data['args'], dict):
-        rep.status = "error"
-        rep.code = -5
-        rep.errormessage = "'args' must be a dictionary"
-        return False, rep
+        return False, _error(-4, "Command data must contain 'command' and 'args' keys")
+    args = command_data['args']
+    if not isinstance(args, dict):
+        return False, _error(-5, "'args' must be a dictionary")
+    if 'id' in command_data and (isinstance(command_data['id'], bool)
+                                 or not isinstance(command_data['id'], (str, int))):
+        return False, _error(-10, "'id' must be a string or an integer")
+    if 'replyTo' in command_data and (not isinstance(command_data['replyTo'], str) or not command_data['replyTo']):
+        return False, _error(-11, "'replyTo' must be a non-empty channel name")
     command = command_data['command']
-    if command not in COMMAND_TABLE:
-        rep.status = "error"
-        rep.code = -6
-        rep.errormessage = f"Command '{command}' not recognized"
-        return False, rep
-    expected_args = COMMAND_TABLE[command]['args']
-    
-    for arg in expected_args:
-        if arg not in command_data['args']:
-            rep.status = "error"
-            rep.code = -7
-            rep.errormessage = f"Missing argument '{arg}' for command '{command}'"
-            return False, rep
-        
-    if 'card' in expected_args and 'card' in command_data['args']:
-        if command_data['args']['card'] < 1 or command_data['args']['card'] > 18:
-            rep.status = "error"
-            rep.code = -8
-            rep.errormessage = "Card number must be between 1 and 18"
-            return False, rep
-    if 'channel' in expected_args and 'channel' in command_data['args']:
-        if command_data['args']['channel'] < 1 or command_data['args']['channel'] > 8:
-            rep.status = "error"
-            rep.code = -9
-            rep.errormessage = "Channel number must be between 1 and 8"
-            return False, rep
-    return True, rep
+    validate = VALIDATORS.get(command) if isinstance(command, str) else None
+    if validate is None:
+        return False, _error(-6, f"Command '{command}' not recognized")
+    try:
+        return True, validate(args)
+    except SchemaError as e:
+        return False, _error(e.code, str(e))
 
 
 def main():
     """Main run loop for the Bias Crate Daemon."""
+    asyncio.run(serve())
+
+
+async def serve():
+    """
+    Receive commands from redis and run each one as its own task. Hardware work of all commands is serialized
+    by a BusScheduler, so a long seek no longer blocks other clients.
+    """
+    global state_mirror
     logger.info("Starting Bias Crate Daemon")
     crate = BiasCrate()
-    r = redis.Redis(host=conf.redis.ip, port=conf.redis.port, db=0)
+    if conf.telemetry.enabled:
+        crate.start_telemetry()
+    bus = BusScheduler(crate)
+    bus.start()
+    r = aioredis.Redis(host=conf.redis.ip, port=conf.redis.port, db=0)
     try:
-        r.ping()
+        await r.ping()
     except redis.exceptions.ConnectionError as e:
         logger.error(f"Could not connect to Redis server at {conf.redis.ip}:{conf.redis.port}. Is the server running?")
         raise e
+    mirror_task = None
+    if conf.mirror.enabled:
+        state_mirror = StateMirror(crate, r, conf.redis.keyPrefix, conf.mirror.interval)
+        state_mirror.mark()
+        crate.sweep_done = state_mirror.mark_threadsafe
+        mirror_task = asyncio.create_task(state_mirror.run())
+    telemetry_task = None
+    if conf.telemetry.enabled and conf.telemetry.stream.enabled:
+        t = conf.telemetry.stream
+        telemetry = TelemetryStream(crate, r, t.name, t.interval, t.keyframeEvery, t.maxLen, t.deadband)
+        telemetry_task = asyncio.create_task(telemetry.run())
+    publisher = None
+    if conf.progress.enabled:
+        events = asyncio.Queue(conf.progress.queueDepth)
+        crate.progress = progress_reporter(events)
+        publisher = asyncio.create_task(publish_progress(r, events))
+    sockets = None
+    if conf.sockets.unixPath or conf.sockets.tcpHost:
+        sockets = SocketServer(lambda command: respond(bus, command, None), conf.sockets.maxFrame)
+        await sockets.start(conf.sockets.unixPath, conf.sockets.tcpHost, conf.sockets.tcpPort)
+    tasks = set()
+    try:
+        if conf.redis.transport == "streams":
+            await serve_streams(bus, r, tasks)
+        else:
+            await serve_pubsub(bus, r, tasks)
+    except redis.exceptions.ConnectionError as e:
+        logger.error(f"Redis connection error: {e}")
+    finally:
+        if sockets is not None:
+            await sockets.close()
+        for task in tasks:
+            task.cancel()
+        if publisher is not None:
+            crate.progress = None
+            publisher.cancel()
+        if telemetry_task is not None:
+            telemetry_task.cancel()
+        if mirror_task is not None:
+            crate.sweep_done = None
+            mirror_task.cancel()
+            state_mirror = None
+        await bus.stop()
+        crate.stop_telemetry()
+        crate.curves.flush(force=True)
+        await r.aclose()
+
+
+def spawn(tasks: set, coro):
+    """Run `coro` as a task that is kept in `tasks` until it is done"""
+    task = asyncio.create_task(coro)
+    tasks.add(task)
+    task.add_done_callback(tasks.discard)
+
+
+async def serve_pubsub(bus: BusScheduler, r, tasks: set):
+    """
+    Run the commands published on conf.redis.commandChannel. Commands sent while the daemon isn't subscribed are
+    lost, see serve_streams for a transport that keeps them.
+    """
     pubsub = r.pubsub()
-    pubsub.subscribe(conf.redis.commandChannel)
-    logger.info("Bias Crate Daemon started successfully")
+    await pubsub.subscribe(conf.redis.commandChannel)
+    logger.info(f"Bias Crate Daemon started successfully, listening on channel {conf.redis.commandChannel}")
     try:
-        for message in pubsub.listen():
+        async for message in pubsub.listen():
             if message['type'] == 'message':
-                command = json.loads(message['data'].decode())
-                logger.info(f"Received command: {command}")
-                # Validate the command structure and content
-                command_is_valid, response = validate_command(command)
-                if command_is_valid:
-                    command_name = command['command']
-                    args = command['args']
-                    func = COMMAND_TABLE[command_name]['function']
-                    try:
-                        response = func(crate, args)
-                        logger.info(f"Execution of {command_name} completed.")
-                    except Exception as e:
-                        logger.exception(f"Error executing command {command_name}: {e}")
-                        response = reply()
-                        response.status = "error"
-                        response.code = -1
-                        response.errormessage = str(e)
-                        response = response.error_str()
-
-                    logger.debug(f"Response: {response}")
-                    r.publish(conf.redis.replyChannel, response)
-
-                else:
-                    logger.error(response.errormessage)
-                    r.publish(conf.redis.replyChannel, response.error_str())
+                spawn(tasks, handle_message(bus, r, message['data']))
+    finally:
+        await pubsub.unsubscribe()
 
-    except redis.exceptions.ConnectionError as e:
-        logger.error(f"Redis connection error: {e}")
+
+async def serve_streams(bus: BusScheduler, r, tasks: set):
+    """
+    Run the commands added to the conf.redis.streams.commandStream stream, read through a consumer group.
+    Entries are read in batches and each batch is scheduled grouped per card (see _card_grouped). An entry is
+    acknowledged once its reply has been added to the reply stream. Entries that were read but not acknowledged
+    before a restart are run first, so every command is run at least once.
+    """
+    s = conf.redis.streams
+    try:
+        await r.xgroup_create(s.commandStream, s.group, id="$", mkstream=True)
+    except redis.exceptions.ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+    logger.info(f"Bias Crate Daemon started successfully, reading stream {s.commandStream} as {s.group}/{s.consumer}")
+    pending = "0"  # Read our unacknowledged entries first, then new ones (">")
+    while True:
+        if pending is not None:
+            response = await r.xreadgroup(s.group, s.consumer, {s.commandStream: pending}, count=s.batch)
+        else:
+            response = await r.xreadgroup(s.group, s.consumer, {s.commandStream: ">"}, count=s.batch, block=s.block)
+        entries = response[0][1] if response else []
+        if pending is not None:
+            if not entries:
+                pending = None
+                continue
+            pending = entries[-1][0]
+            logger.warning(f"Rerunning {len(entries)} unacknowledged commands")
+        decoded = [decode_entry(fields) for _, fields in entries]
+        for i in _card_grouped([command for command, _ in decoded]):
+            spawn(tasks, handle_entry(bus, r, entries[i][0], *decoded[i]))
+
+
+def decode(data: bytes) -> tuple:
+    """
+    Parse a json command message.
+
+    Returns:
+        (command, None) or (None, error reply string)
+    """
+    try:
+        return json.loads(data.decode()), None
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        response = reply()
+        response.status = "error"
+        response.code = -2
+        response.errormessage = f"Command is not valid json: {e}"
+        return None, response.error_str()
+
+
+def decode_entry(fields: dict) -> tuple:
+    """decode() for a stream entry, the command is in its 'command' field"""
+    if not fields or b"command" not in fields:
+        response = reply()
+        response.status = "error"
+        response.code = -12
+        response.errormessage = "Stream entry has no 'command' field"
+        return None, response.error_str()
+    return decode(fields[b"command"])
+
+
+async def respond(bus: BusScheduler, command, default_reply: str) -> tuple:
+    """
+    Run a decoded command envelope.
+
+    Returns:
+        (where the reply goes, reply string)
+    """
+    logger.info(f"Received command: {command}")
+    request_id, reply_to = route(command, default_reply)
+    response = with_id(await execute(bus, command), request_id)
+    logger.debug(f"Response: {response}")
+    return reply_to, response
+
+
+async def execute(bus: BusScheduler, command) -> str:
+    """Validate and run one command. Returns the reply string."""
+    # Validate the command structure and content
+    command_is_valid, args = validate_command(command)
+    if not command_is_valid:
+        logger.error(args.errormessage)
+        return args.error_str()
+    command = {**command, 'args': args}
+    command_name = command['command']
+    func = COMMAND_TABLE[command_name]['function']
+    op = Operation(command, asyncio.current_task())
+    operations.append(op)
+    current = current_operation.set(op)
+    level = scope = None
+    if command_name in SAFETY_COMMANDS:
+        level = priority.set(SAFETY)
+        if command_name == "disableOutput":
+            scope = safety_scope.set((args['card'], args['channel']))
+        preempt(command)
+    channels = _channels_of(command, bus.crate) if command_name in CHANNEL_LOCKED else ()
+    if command_name == "getStatus" and args.get("maxAge") is not None \
+            and bus.crate.cached_status(args['card'], args['channel'], args['maxAge']) is not None:
+        # Answered from the telemetry buffer, so it needn't wait for a seek running on the channel
+        channels = ()
+    try:
+        async with bus.locks.hold(channels):
+            if asyncio.iscoroutinefunction(func):
+                response = await func(bus, args)
+            else:
+                # Blocking handlers run as a single bus job
+                response = await bus.run(func, bus.crate, args)
+        logger.info(f"Execution of {command_name} completed.")
+    except asyncio.CancelledError:
+        # The outermost cancelled operation of this task replies, anything else (e.g. shutdown) propagates
+        task = asyncio.current_task()
+        if next((o for o in operations if o.task is task and o.cancelled_by is not None), None) is not op:
+            raise
+        task.uncancel()
+        logger.warning(f"{command_name} cancelled by {op.cancelled_by}")
+        response = reply()
+        response.status = "error"
+        response.code = -39100
+        response.errormessage = f"Cancelled by {op.cancelled_by}"
+        response = response.error_str()
+    except Exception as e:
+        logger.exception(f"Error executing command {command_name}: {e}")
+        response = reply()
+        response.status = "error"
+        response.code = -1
+        response.errormessage = str(e)
+        response = response.error_str()
     finally:
-        pubsub.unsubscribe()
+        operations.remove(op)
+        current_operation.reset(current)
+        if state_mirror is not None and command_name in STATE_COMMANDS:
+            state_mirror.mark(_cards_of(command))
+        if scope is not None:
+            safety_scope.reset(scope)
+        if level is not None:
+            priority.reset(level)
+    return response
+
+
+def cancel_operations(matches, reason: str) -> int:
+    """
+    Cancel the in-flight operations for which `matches(operation)` is true. Each one stops at its next await,
+    at the latest when its current bus job is done, and replies with an error (code -39100). Operations of the
+    calling task are left alone.
+
+    Returns:
+        Number of operations cancelled
+    """
+    current = asyncio.current_task()
+    cancelled = 0
+    for op in operations:
+        if op.task is current or op.cancelled_by is not None or not matches(op):
+            continue
+        op.cancelled_by = reason
+        cancelled += 1
+        if op.task.cancelling() == 0:
+            op.task.cancel()
+    return cancelled
+
+
+def _channels_of(command: dict, crate: BiasCrate) -> list:
+    """(card, channel) of every output a valid command may drive"""
+    args = command['args']
+    if 'channel' in args:
+        return [(args['card'], args['channel'])]
+    if 'targets' in args:
+        # Malformed entries only get an error entry in the reply, they drive nothing
+        return [(t[0], t[1]) for t in args['targets']
+                if isinstance(t, list) and len(t) >= 2 and type(t[0]) is int and type(t[1]) is int]
+    return [(card, channel) for card in crate.cards for channel in range(1, 8 + 1)]  # loadConfig
+
+
+def _cards_of(command: dict):
+    """Cards a valid command works on, None for the whole crate"""
+    args = command['args']
+    if 'card' in args:
+        return [args['card']]
+    if 'targets' in args:
+        return [t[0] for t in args['targets'] if isinstance(t, list) and t]
+    return args.get('cards')
+
+
+def _touches(command: dict, card: int, channel: int) -> bool:
+    """Whether a preemptible command may drive the output of card+channel"""
+    name, args = command['command'], command['args']
+    if name in ("seekVoltageMany", "seekCurrentMany"):
+        targets = args.get('targets')
+        return isinstance(targets, list) and any(isinstance(t, list) and t[:2] == [card, channel] for t in targets)
+    if name == "batch":
+        commands = args.get('commands')
+        return isinstance(commands, list) and any(
+            isinstance(c, dict) and c.get('command') in PREEMPTIBLE and isinstance(c.get('args'), dict)
+            and _touches(c, card, channel) for c in commands)
+    if name in ("runMacro", "loadConfig"):
+        return True  # Which outputs these drive isn't known up front
+    return args.get('card') == card and args.get('channel') == channel
+
+
+def preempt(command: dict) -> int:
+    """
+    Cancel the operations a safety command conflicts with: every preemptible operation for disableAllOutputs,
+    the ones that may drive the same output for disableOutput.
+
+    Returns:
+        Number of operations cancelled
+    """
+    if command['command'] == "disableAllOutputs":
+        n = cancel_operations(lambda op: op.command['command'] in PREEMPTIBLE, command['command'])
+    else:
+        card, channel = command['args']['card'], command['args']['channel']
+        n = cancel_operations(
+            lambda op: op.command['command'] in PREEMPTIBLE and _touches(op.command, card, channel),
+            command['command'])
+    if n:
+        logger.warning(f"{command['command']} cancelled {n} operations")
+    return n
+
+
+def progress_reporter(events: asyncio.Queue):
+    """
+    Build a BiasCrate.progress callback that tags each event with the command (and its id) that caused it and
+    hands it to `events` on the running loop. Never blocks the bus thread: events that don't fit are dropped.
+    """
+    loop = asyncio.get_running_loop()
+
+    def offer(event: dict):
+        try:
+            events.put_nowait(event)
+        except asyncio.QueueFull:
+            logger.debug("Progress queue full, event dropped")
+
+    def report(event: dict):
+        op = current_operation.get()
+        if op is not None:
+            tag = {"command": op.command['command']}
+            if route(op.command)[0] is not None:
+                tag["id"] = op.command['id']
+            event = {**tag, **event}
+        loop.call_soon_threadsafe(offer, event)
+
+    return report
+
+
+async def publish_progress(r, events: asyncio.Queue):
+    """Publish progress events to conf.redis.progressChannel as they arrive."""
+    while True:
+        event = await events.get()
+        try:
+            await r.publish(conf.redis.progressChannel, json.dumps(event))
+        except redis.exceptions.RedisError as e:
+            logger.warning(f"Could not publish progress: {e}")
+
+
+def route(command, default_reply: str = None) -> tuple:
+    """
+    Reply routing of a command envelope: the optional 'id' is echoed in the reply and the reply is published to
+    the optional 'replyTo' channel (or stream) instead of `default_reply`, conf.redis.replyChannel by default.
+    Invalid values are ignored here, validate_command reports them.
+
+    Returns:
+        (id or None, reply channel)
+    """
+    default_reply = conf.redis.replyChannel if default_reply is None else default_reply
+    if not isinstance(command, dict):
+        return None, default_reply
+    request_id = command.get("id")
+    if isinstance(request_id, bool) or not isinstance(request_id, (str, int)):
+        request_id = None
+    reply_to = command.get("replyTo")
+    if not isinstance(reply_to, str) or not reply_to:
+        reply_to = default_reply
+    return request_id, reply_to
+
+
+def with_id(response: str, request_id) -> str:
+    """Add the request id to a json reply string, spliced in front of the reply object's other keys"""
+    if request_id is None:
+        return response
+    return '{"id": ' + json.dumps(request_id) + ", " + response[1:]
+
+
+async def handle_message(bus: BusScheduler, r, data: bytes):
+    """Run the command in a pubsub message and publish its reply."""
+    command, error = decode(data)
+    if error is not None:
+        await r.publish(conf.redis.replyChannel, error)
+        return
+    reply_to, response = await respond(bus, command, conf.redis.replyChannel)
+    await r.publish(reply_to, response)
+
+
+async def handle_entry(bus: BusScheduler, r, entry_id, command, error: str):
+    """Run the command of a stream entry, add its reply to the reply stream and acknowledge the entry."""
+    s = conf.redis.streams
+    if error is not None:
+        reply_to, response = s.replyStream, error
+    else:
+        reply_to, response = await respond(bus, command, s.replyStream)
+    await r.xadd(reply_to, {"reply": response}, maxlen=s.maxLen, approximate=True)
+    await r.xack(s.commandStream, s.group, entry_id)
 
 
 
@@ -181,7 +596,7 @@ def get_status(crate:BiasCrate, args:dict)->str:
     r.channel = channel
     
     try:
-        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = crate.get_status(card, channel)
+        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = crate.get_status(card, channel, args.get("maxAge"))
         r.status = "success"
         return r.success_str()
     except Exception as e:
@@ -191,8 +606,16 @@ def get_status(crate:BiasCrate, args:dict)->str:
         r.errormessage = str(e)
         return r.error_str()
     
-def seek_voltage(crate:BiasCrate, args:dict)->str:
+def _seek_options(args: dict) -> dict:
+    """The optional seek arguments (tolerance, mode, maxStep) that were given, as BiasCrate keyword arguments.
+    They have been checked against SEEK_OPTIONS already."""
+    return {kw: args[name] for name, kw in (("tolerance", "tolerance"), ("mode", "mode"), ("maxStep", "max_step"))
+            if name in args}
+
+
+async def seek_voltage(bus:BusScheduler, args:dict)->str:
     r = reply()
+    crate = bus.crate
     card = args['card']
     channel = args['channel']
 
@@ -200,16 +623,17 @@ def seek_voltage(crate:BiasCrate, args:dict)->str:
     r.channel = channel
     try:
         voltage = args['voltage']
-        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = crate.get_status(card, channel)
+        opts = _seek_options(args)
+        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = await bus.run(crate.get_status, card, channel)
         if r.outputEnabled:
-            crate.seek_voltage(card, channel, voltage)
+            await bus.drive(crate.seek_steps(card, channel, "vbus", voltage, **opts))
         else:
             r.status = "error"
             r.code = -32000
             r.errormessage = "Output is disabled, cannot seek voltage."
             return r.error_str()
-        time.sleep(0.2)  # Allow time for the voltage to settle
-        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = crate.get_status(card, channel)
+        await bus.settle(card, channel, conf.settle.afterSeek)  # Allow time for the voltage to settle
+        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = await bus.run(crate.get_status, card, channel)
         r.status = "success"
     except Exception as e:
         logger.exception(e)
@@ -219,8 +643,9 @@ def seek_voltage(crate:BiasCrate, args:dict)->str:
         return r.error_str()
     return r.success_str()
 
-def seek_current(crate:BiasCrate, args:dict)->str:
+async def seek_current(bus:BusScheduler, args:dict)->str:
     r = reply()
+    crate = bus.crate
     card = args['card']
     channel = args['channel']
    
@@ -228,16 +653,17 @@ def seek_current(crate:BiasCrate, args:dict)->str:
     r.channel = channel
     try:
         current = args['current']
-        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = crate.get_status(card, channel)
+        opts = _seek_options(args)
+        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = await bus.run(crate.get_status, card, channel)
         if r.outputEnabled:
-            crate.seek_current(card, channel, current)
+            await bus.drive(crate.seek_steps(card, channel, "current", current, **opts))
         else:
             r.status = "error"
             r.code = -33000
             r.errormessage = "Output is disabled, cannot seek current."
             return r.error_str()
-        time.sleep(0.2)  # Allow time for the current to settle
-        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = crate.get_status(card, channel)
+        await bus.settle(card, channel, conf.settle.afterSeek)  # Allow time for the current to settle
+        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = await bus.run(crate.get_status, card, channel)
         r.status = "success"
     except Exception as e:
         logger.exception(e)
@@ -248,17 +674,59 @@ def seek_current(crate:BiasCrate, args:dict)->str:
     return r.success_str()
 
 
-def enable_output(crate: BiasCrate, args:dict)->str:
+async def _seek_many(bus: BusScheduler, args: dict, quantity: str) -> str:
+    """
+    Shared implementation of seekVoltageMany and seekCurrentMany. args['targets'] is a list of
+    [card, channel, target] entries; every entry gets its own status in the aggregated reply.
+    """
+    try:
+        targets = args['targets']
+        opts = _seek_options(args)
+        crate = bus.crate
+        # Settles before returning
+        results = await bus.drive(crate.seek_many_steps([tuple(t) for t in targets], quantity, **opts))
+        replies = []
+        for res in results:
+            if "error" in res:
+                replies.append({"status": "error", "card": res["card"], "channel": res["channel"], "msg": res["error"]})
+                continue
+            vbus, vshunt, current, enabled, wiper = await bus.run(crate.get_status, res["card"], res["channel"])
+            replies.append({
+                "status": "success", "card": res["card"], "channel": res["channel"],
+                "vbus": vbus, "vshunt": vshunt, "current": current,
+                "outputEnabled": enabled, "wiper": wiper, "iterations": res["iterations"]})
+    except Exception as e:
+        logger.exception(e)
+        r = reply()
+        r.status = "error"
+        r.code = -34100 #TODO: Define error codes
+        r.errormessage = str(e)
+        return r.error_str()
+    failed = sum(1 for res in replies if res["status"] != "success")
+    if failed:
+        return json.dumps({"status": "error", "code": -34000, "msg": f"{failed} of {len(replies)} seeks failed",
+                           "results": replies})
+    return json.dumps({"status": "success", "results": replies})
+
+async def seek_voltage_many(bus: BusScheduler, args: dict) -> str:
+    return await _seek_many(bus, args, "vbus")
+
+async def seek_current_many(bus: BusScheduler, args: dict) -> str:
+    return await _seek_many(bus, args, "current")
+
+
+async def enable_output(bus: BusScheduler, args:dict)->str:
     r = reply()
+    crate = bus.crate
     card = args['card']
     channel = args['channel']
     
     r.card = card
     r.channel = channel
     try:
-        crate.enable_output(card, channel)
-        time.sleep(0.1)  # Allow time for the output to settle
-        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = crate.get_status(card, channel)
+        await bus.run(crate.enable_output, card, channel)
+        await bus.settle(card, channel, conf.settle.afterSwitch)  # Allow time for the output to settle
+        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = await bus.run(crate.get_status, card, channel)
         r.status = "success"
     except Exception as e:
         logger.exception(e)
@@ -269,17 +737,18 @@ def enable_output(crate: BiasCrate, args:dict)->str:
     return r.success_str()  
 
 
-def disable_output(crate: BiasCrate, args:dict)->str:
+async def disable_output(bus: BusScheduler, args:dict)->str:
     r = reply()
+    crate = bus.crate
     card = args['card']
     channel = args['channel']
    
     r.card = card
     r.channel = channel
     try:
-        crate.disable_output(card, channel)
-        time.sleep(0.1)  # Allow time for the output to settle
-        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = crate.get_status(card, channel)
+        await bus.run(crate.disable_output, card, channel)
+        await bus.settle(card, channel, conf.settle.afterSwitch)  # Allow time for the output to settle
+        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = await bus.run(crate.get_status, card, channel)
         r.status = "success"
     except Exception as e:
         logger.exception(e)
@@ -290,17 +759,18 @@ def disable_output(crate: BiasCrate, args:dict)->str:
     return r.success_str() 
 
 
-def enable_testload(crate: BiasCrate, args:dict)->str:
+async def enable_testload(bus: BusScheduler, args:dict)->str:
     r = reply()
+    crate = bus.crate
     card = args['card']
     channel = args['channel']
     
     r.card = card
     r.channel = channel
     try:
-        crate.enable_testload(card, channel)
-        time.sleep(0.1)  # Allow time for the output to settle
-        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = crate.get_status(card, channel)
+        await bus.run(crate.enable_testload, card, channel)
+        await bus.settle(card, channel, conf.settle.afterSwitch)  # Allow time for the output to settle
+        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = await bus.run(crate.get_status, card, channel)
         r.status = "success"
     except Exception as e:
         logger.exception(e)
@@ -311,17 +781,18 @@ def enable_testload(crate: BiasCrate, args:dict)->str:
     return r.success_str()  
 
 
-def disable_testload(crate: BiasCrate, args:dict)->str:
+async def disable_testload(bus: BusScheduler, args:dict)->str:
     r = reply()
+    crate = bus.crate
     card = args['card']
     channel = args['channel']
    
     r.card = card
     r.channel = channel
     try:
-        crate.disable_testload(card, channel)
-        time.sleep(0.1)  # Allow time for the output to settle
-        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = crate.get_status(card, channel)
+        await bus.run(crate.disable_testload, card, channel)
+        await bus.settle(card, channel, conf.settle.afterSwitch)  # Allow time for the output to settle
+        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = await bus.run(crate.get_status, card, channel)
         r.status = "success"
     except Exception as e:
         logger.exception(e)
@@ -331,6 +802,26 @@ def disable_testload(crate: BiasCrate, args:dict)->str:
         return r.error_str() 
     return r.success_str() 
 
+def set_adc_profile(crate: BiasCrate, args:dict)->str:
+    """Select a named INA219 ADC profile (see adcProfiles in the config) for a card+channel."""
+    r = reply()
+    card = args['card']
+    channel = args['channel']
+
+    r.card = card
+    r.channel = channel
+    try:
+        crate.set_adc_profile(card, channel, args['profile'])
+        r.vbus, r.vshunt, r.current, r.outputEnabled, r.wiper = crate.get_status(card, channel)
+        r.status = "success"
+    except Exception as e:
+        logger.exception(e)
+        r.status = "error"
+        r.code = -35000 #TODO: Define error codes
+        r.errormessage = str(e)
+        return r.error_str()
+    return r.success_str()
+
 def get_available_cards(crate: BiasCrate, args:dict)->str:
     """Get a list of available cards."""
     r = {
@@ -349,6 +840,39 @@ def get_available_cards(crate: BiasCrate, args:dict)->str:
         return r.error_str()
     return json.dumps(r)
 
+def get_crate_status(crate: BiasCrate, args:dict)->str:
+    """
+    Snapshot of the whole crate in one reply. Optional args 'cards' and 'channels' (lists of ints) restrict
+    the snapshot, by default every channel of every available card is read.
+    """
+    try:
+        filters = {key: args[key] for key in ("cards", "channels") if key in args}
+        channels = filters.get("channels", list(range(1, 8 + 1)))
+        snapshot = crate.get_crate_status(**filters)
+    except Exception as e:
+        logger.exception(e)
+        r = reply()
+        r.status = "error"
+        r.code = -36000 #TODO: Define error codes
+        r.errormessage = str(e)
+        return r.error_str()
+    return json.dumps({"status": "success", "channels": channels, "cards": snapshot})
+
+def get_transfer_curve(crate: BiasCrate, args:dict)->str:
+    """Get the learned wiper -> vbus/current transfer curve of a card+channel."""
+    card = args['card']
+    channel = args['channel']
+    try:
+        curve = crate.get_transfer_curve(card, channel)
+    except Exception as e:
+        logger.exception(e)
+        r = reply()
+        r.status = "error"
+        r.code = -100 #TODO: Define error codes
+        r.errormessage = str(e)
+        return r.error_str()
+    return json.dumps({"status": "success", "card": card, "channel": channel, **curve})
+
 def load_config(crate: BiasCrate, args:dict):
     """
     Load the configuration from the configuration file into the Bias Crate.
@@ -361,17 +885,8 @@ def load_config(crate: BiasCrate, args:dict):
     r = reply()
     enable_outputs = args.get("enableOutputs", False)
     create_new_config = args.get("createNewConfig", False)
-    if not isinstance(enable_outputs, bool):
-        r.status = "error"
-        r.code = -202
-        r.errormessage = "enableOutputs must be a boolean value."
-        return r.error_str()
-    if not isinstance(create_new_config, bool):
-        r.status = "error"
-        r.code = -203
-        r.errormessage = "createNewConfig must be a boolean value."
-        return r.error_str()
-    if create_new_config:
+    dry_run = args.get("dryRun", False)
+    if create_new_config and not dry_run:
         logger.debug("Creating new configuration file.")
         OmegaConf.save(conf, CONFIGPATH+"config.yaml")
     else:
@@ -383,14 +898,24 @@ def load_config(crate: BiasCrate, args:dict):
             return r.error_str()
 
     try:
-        crate.load_config(enable_outputs)
-        r.status = "success"
-        return r.success_str()
+        changes = crate.load_config(enable_outputs, dry_run)
+    except ConfigError as e:
+        r.status = "error"
+        r.code = -102 #TODO: Define error codes
+        r.errormessage = f"Invalid configuration: {e}"
+        return r.error_str()
     except Exception as e:
         logger.exception(e)
         r.status = "error"
         r.code = -100
         r.errormessage = str(e)
+        return r.error_str()
+    return json.dumps({
+        "status": "success",
+        "dryRun": dry_run,
+        "transactions": sum(c["transactions"] for c in changes),
+        "changes": changes,
+    })
 
 def save_config(crate: BiasCrate, args:dict):
     """
@@ -424,7 +949,7 @@ def disable_all_outputs(crate: BiasCrate, args:dict):
     """
     r = reply()
     try:
-        crate.disable_all_outputs(True)
+        crate.emergency_disable(True)
         r.status = "success"
     except Exception as e:
         logger.exception(e)
@@ -435,56 +960,256 @@ def disable_all_outputs(crate: BiasCrate, args:dict):
     return r.success_str()
 
 
-# The command table maps command names to their corresponding functions and arguments.
+def get_metrics(crate: BiasCrate, args:dict)->str:
+    """Latency metrics collected by the crate, e.g. the worst case time for disableAllOutputs to turn everything off."""
+    return json.dumps({"status": "success", **crate.metrics})
+
+
+def _card_grouped(commands: list) -> list:
+    """
+    Execution order for an unordered batch: commands for the same card are grouped together (groups in order of
+    the card's first appearance, commands keep their relative order within a group). Commands without a card
+    (e.g. disableAllOutputs, loadConfig, getCrateStatus, macros) may touch any card, so they are barriers: they
+    run in their place and commands are only grouped between two of them.
+    """
+    order = []
+    groups = {}
+    for i, command in enumerate(commands):
+        args = command.get("args") if isinstance(command, dict) else None
+        card = args.get("card") if isinstance(args, dict) else None
+        if isinstance(card, int) and not isinstance(card, bool):
+            groups.setdefault(card, []).append(i)
+            continue
+        order += [j for group in groups.values() for j in group]
+        order.append(i)
+        groups = {}
+    return order + [j for group in groups.values() for j in group]
+
+
+async def batch(bus: BusScheduler, args: dict) -> str:
+    """
+    Execute a list of ordinary commands in one pass. Unless args['ordered'] is true the commands are grouped per card
+    so each card's repeater is switched to once. Results come back in the order the commands were given.
+    """
+    try:
+        commands = args['commands']
+        ordered = args.get('ordered', False)
+        if any(isinstance(c, dict) and c.get("command") == "batch" for c in commands):
+            raise ValueError("batch commands can't be nested.")
+    except ValueError as e:
+        r = reply()
+        r.status = "error"
+        r.code = -37100 #TODO: Define error codes
+        r.errormessage = str(e)
+        return r.error_str()
+
+    results = [None] * len(commands)
+    for i in (range(len(commands)) if ordered else _card_grouped(commands)):
+        request_id, _ = route(commands[i])
+        result = json.loads(await execute(bus, commands[i]))
+        results[i] = result if request_id is None else {"id": request_id, **result}
+    failed = sum(1 for res in results if res["status"] != "success")
+    if failed:
+        return json.dumps({"status": "error", "code": -37000, "msg": f"{failed} of {len(results)} commands failed",
+                           "results": results})
+    return json.dumps({"status": "success", "results": results})
+
+
+async def cancel(bus: BusScheduler, args: dict) -> str:
+    """Cancel the in-flight commands that were sent with id args['target']. Safety commands can't be cancelled."""
+    target = args['target']
+    n = cancel_operations(
+        lambda op: op.command.get('id') == target and op.command['command'] not in SAFETY_COMMANDS, "cancel")
+    if n == 0:
+        r = reply()
+        r.status = "error"
+        r.code = -39000 #TODO: Define error codes
+        r.errormessage = f"No command with id {target!r} in flight"
+        return r.error_str()
+    return json.dumps({"status": "success", "target": target, "cancelled": n})
+
+
+async def define_macro(bus: BusScheduler, args: dict) -> str:
+    """Register (or replace) a named macro. args['macro'] is the definition, see macros.py. Doesn't use the bus."""
+    try:
+        commands = [c for c in COMMAND_TABLE if c not in NOT_IN_MACROS]
+        macro_store.define(args['name'], args['macro'], commands)
+    except MacroError as e:
+        r = reply()
+        r.status = "error"
+        r.code = -38100 #TODO: Define error codes
+        r.errormessage = str(e)
+        return r.error_str()
+    return json.dumps({"status": "success", "name": args['name']})
+
+
+async def delete_macro(bus: BusScheduler, args: dict) -> str:
+    try:
+        macro_store.delete(args['name'])
+    except MacroError as e:
+        r = reply()
+        r.status = "error"
+        r.code = -38200 #TODO: Define error codes
+        r.errormessage = str(e)
+        return r.error_str()
+    return json.dumps({"status": "success", "name": args['name']})
+
+
+async def list_macros(bus: BusScheduler, args: dict) -> str:
+    return json.dumps({"status": "success", "macros": macro_store.macros})
+
+
+async def run_macro(bus: BusScheduler, args: dict) -> str:
+    """
+    Run a named macro. args['params'] optionally overrides the macro's parameters. The reply holds the reply of
+    every command the macro executed; if the macro was aborted the status is error (code -38000).
+    """
+
+    async def run_command(command: dict) -> dict:
+        return json.loads(await execute(bus, command))
+
+    runner = MacroRun(run_command, conf.macros.maxSteps, conf.macros.maxWait)
+    try:
+        params = args.get('params', {})
+        macro = macro_store.get(args['name'])
+        logger.info(f"Running macro {args['name']} with {params}")
+        results = await runner.run(macro, params, {"cards": list(bus.crate.cards)})
+    except MacroError as e:
+        logger.error(f"Macro {args['name']} aborted: {e}")
+        return json.dumps({"status": "error", "code": -38000, "msg": str(e), "steps": runner.steps,
+                           "results": runner.results})
+    return json.dumps({"status": "success", "steps": runner.steps, "results": results})
+
+
+async def get_schema(bus: BusScheduler, args: dict) -> str:
+    """The argument specs of every command (see schema.py) and whether it is a safety command. Doesn't use the bus."""
+    commands = {
+        name: {"args": entry["args"], "safety": name in SAFETY_COMMANDS} for name, entry in COMMAND_TABLE.items()
+    }
+    return json.dumps({"status": "success", "commands": commands})
+
+
+# Argument specs shared by several commands, see schema.py
+CARD = {"type": "int", "min": 1, "max": 18, "code": -8, "message": "Card number must be between 1 and 18"}
+CHANNEL = {"type": "int", "min": 1, "max": 8, "code": -9, "message": "Channel number must be between 1 and 8"}
+SEEK_OPTIONS = {
+    "tolerance": {"type": "number", "exclusiveMin": 0, "required": False},
+    "mode": {"type": "string", "choices": list(SEEK_MODES), "required": False},
+    "maxStep": {"type": "int", "min": 1, "required": False},
+}
+# [card, channel, target] entries, the range of the target is checked per entry by BiasCrate.seek_many_steps
+TARGETS = {"type": "list", "minItems": 1, "items": {"type": "list", "items": [CARD, CHANNEL, {"type": "number"}]}}
+
+# The command table maps command names to their corresponding functions and argument specs.
 # This allows for dynamic command execution based on the received command.
 COMMAND_TABLE = {
     "seekVoltage" : {
         "function": seek_voltage,
-        "args": ["card", "channel", "voltage"]
+        "args": {"card": CARD, "channel": CHANNEL, "voltage": {"type": "number", "min": 0, "max": 5}, **SEEK_OPTIONS}
     },
     "seekCurrent":{
         "function": seek_current,
-        "args": ["card", "channel", "current"]
+        "args": {"card": CARD, "channel": CHANNEL, "current": {"type": "number", "min": 0, "max": 200}, **SEEK_OPTIONS}
+    },
+    "seekVoltageMany": {
+        "function": seek_voltage_many,
+        "args": {"targets": TARGETS, **SEEK_OPTIONS}
+    },
+    "seekCurrentMany": {
+        "function": seek_current_many,
+        "args": {"targets": TARGETS, **SEEK_OPTIONS}
     },
     "getStatus": {
         "function": get_status,
-        "args": ["card", "channel"]
+        "args": {"card": CARD, "channel": CHANNEL, "maxAge": {"type": "number", "min": 0, "required": False}}
     }, 
     "enableOutput": {
         "function": enable_output,
-        "args": ["card", "channel"]
+        "args": {"card": CARD, "channel": CHANNEL}
     },
     "disableOutput": {
         "function": disable_output,
-        "args": ["card", "channel"]
+        "args": {"card": CARD, "channel": CHANNEL}
     },
     "enableTestload": {
         "function": enable_testload,
-        "args": ["card", "channel"]
+        "args": {"card": CARD, "channel": CHANNEL}
     },
     "disableTestload": {
         "function": disable_testload,
-        "args": ["card", "channel"]
+        "args": {"card": CARD, "channel": CHANNEL}
+    },
+    "setAdcProfile": {
+        "function": set_adc_profile,
+        "args": {"card": CARD, "channel": CHANNEL, "profile": {"type": "string", "choices": list(conf.adcProfiles)}}
     },
     "getAvailableCards": {
         "function": get_available_cards,
-        "args": []
+        "args": {}
+    },
+    "getCrateStatus": {
+        "function": get_crate_status,
+        "args": {
+            "cards": {"type": "list", "items": {"type": "int"}, "required": False},
+            "channels": {"type": "list", "items": CHANNEL, "required": False},
+        }
+    },
+    "getTransferCurve": {
+        "function": get_transfer_curve,
+        "args": {"card": CARD, "channel": CHANNEL}
     },
     "loadConfig": {
         "function": load_config,
-        "args": ["enableOutputs", "createNewConfig"]
+        "args": {
+            "enableOutputs": {"type": "bool", "code": -202},
+            "createNewConfig": {"type": "bool", "code": -203},
+            "dryRun": {"type": "bool", "required": False, "code": -204},
+        }
     },
     "saveConfig": {
         "function": save_config,
-        "args": []
+        "args": {}
     },
     "disableAllOutputs": {
         "function": disable_all_outputs,
-        "args": []
+        "args": {}
+    },
+    "getMetrics": {
+        "function": get_metrics,
+        "args": {}
+    },
+    "batch": {
+        "function": batch,
+        "args": {"commands": {"type": "list", "minItems": 1}, "ordered": {"type": "bool", "required": False}}
+    },
+    "defineMacro": {
+        "function": define_macro,
+        "args": {"name": {"type": "string"}, "macro": {"type": "dict"}}
+    },
+    "runMacro": {
+        "function": run_macro,
+        "args": {"name": {"type": "string"}, "params": {"type": "dict", "required": False}}
+    },
+    "deleteMacro": {
+        "function": delete_macro,
+        "args": {"name": {"type": "string"}}
+    },
+    "listMacros": {
+        "function": list_macros,
+        "args": {}
+    },
+    "cancel": {
+        "function": cancel,
+        "args": {"target": {"type": "any"}}
+    },
+    "getSchema": {
+        "function": get_schema,
+        "args": {}
     }
 
 }
-
+# Argument validators, compiled once from the specs above
+VALIDATORS = {name: compile_schema(name, entry["args"]) for name, entry in COMMAND_TABLE.items()}
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
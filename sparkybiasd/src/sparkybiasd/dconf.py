@@ -20,15 +20,113 @@ conf["redis"] = {
     "port": 6379,
     "commandChannel": "sparkommand",
     "replyChannel": "sparkreply",
+    "progressChannel": "sparkprogress",
+    # "pubsub" or "streams". With streams, commands are read from a consumer group and survive daemon restarts.
+    "transport": "pubsub",
+    "streams": {
+        "commandStream": "sparkommand-stream",
+        "replyStream": "sparkreply-stream",
+        "group": "sparkybiasd",
+        "consumer": "crate",
+        "batch": 64,  # Entries read per XREADGROUP
+        "block": 1000,  # ms a read waits for new entries
+        "maxLen": 10000,  # Approximate length reply streams are trimmed to
+    },
     "keyPrefix": "",
 }
+# I2C backend. "smbus2" is the real bus on the PI, "simulated" runs an in-process crate (see simbus.py)
+conf["hardware"] = {
+    "backend": "smbus2",
+    "device": "/dev/i2c-1",
+    "simulated": {
+        "cards": list(range(1, 18 + 1)),
+        "bitrate": 100_000,
+        "overhead": 50e-6,
+        "realtime": True,
+        "seed": 0,
+    },
+    # Debug aid: read back every LTC4302 after each open to check that only one card is connected.
+    # Always on when loglevel is DEBUG.
+    "checkBusOwnership": False,
+}
+# Learned wiper -> output curves, stored in CONFIGPATH/transfer_curves.yaml (see transfer.py)
+conf["transferCurves"] = {
+    "driftVolts": 0.05,
+    "driftMilliamps": 0.5,
+    "driftFraction": 0.05,
+    # Wiper codes to the nearest learned point within which a measurement is checked for drift
+    "driftSpan": 16,
+    "saveInterval": 30.0,
+    "maxPoints": 64,
+}
+# INA219 ADC profiles a channel can select with biasCards.cardN.chanM.adcProfile or the setAdcProfile command.
+# resolution: 9-12 bits, samples: hardware averaging 1-128 (12 bit only), busRange: 16/32 V, gain: 40/80/160/320 mV
+conf["adcProfiles"] = {
+    "default": {"resolution": 12, "samples": 1, "busRange": 32, "gain": 160},
+    "fast": {"resolution": 9, "samples": 1, "busRange": 32, "gain": 160},
+    "averaged": {"resolution": 12, "samples": 16, "busRange": 32, "gain": 160},
+    "lowNoise": {"resolution": 12, "samples": 128, "busRange": 32, "gain": 160},
+}
+# Upper bounds (seconds) for the adaptive settle waits. Waits end early once INA219 conversions of the bus voltage
+# agree within `threshold` volts with the conversion `window` seconds earlier `count` times in a row. `window`
+# should be at least the time constant of the regulators.
+conf["settle"] = {
+    "seekStep": 0.5,
+    "afterSeek": 0.2,
+    "afterSwitch": 0.1,
+    "threshold": 0.004,
+    "count": 2,
+    "window": 0.05,
+}
+# Limits for server side macros (see macros.py): steps executed per run, longest single wait in seconds
+conf["macros"] = {
+    "maxSteps": 10000,
+    "maxWait": 600.0,
+}
+# Direct socket transport next to redis (see sockets.py). An empty unixPath / tcpHost disables that listener.
+conf["sockets"] = {
+    "unixPath": "",
+    "tcpHost": "",
+    "tcpPort": 5577,
+    "maxFrame": 1_048_576,
+}
+# Seek progress events published to redis.progressChannel, at most one per channel every `interval` seconds.
+# `queueDepth` events can wait to be published, newer ones are dropped so the control loop never waits.
+conf["progress"] = {
+    "enabled": True,
+    "interval": 0.25,
+    "queueDepth": 1024,
+}
+# Redis hashes mirroring the crate state under redis.keyPrefix (see mirror.py), written at most every `interval` s
+conf["mirror"] = {
+    "enabled": True,
+    "interval": 0.1,
+}
+# Background telemetry sampler. getStatus with a maxAge argument is served from its ring buffer.
+conf["telemetry"] = {
+    "enabled": False,
+    "interval": 1.0,
+    "depth": 4096,
+    "navg": 2,
+    # Delta encoded telemetry frames added to a redis stream while the sampler runs (see telestream.py)
+    "stream": {
+        "enabled": True,
+        "name": "sparktelemetry-stream",
+        "interval": 1.0,
+        "keyframeEvery": 30,
+        "maxLen": 10000,
+        # Smallest change sent in a delta frame, volts / millivolts / milliamps. Above the conversion noise of the
+        # default ADC profile, so a steady output isn't resent
+        "deadband": {"vbus": 0.01, "vshunt": 0.15, "current": 0.15},
+    },
+}
 conf.biasCards = {}
 for i in range(1, 18 + 1):
     card = f"card{i}"
     conf.biasCards[card] = {}
     for j in range(1, 8 + 1):
         chan = f"chan{j}"
-        conf.biasCards[card][chan] = {"output": False, "wiper": 0}
+        conf.biasCards[card][chan] = {"output": False, "wiper": 0, "adcProfile": "default"}
 try:
     config_file = OmegaConf.load(CONFIGPATH+"config.yaml")
     # values from file are preferred to defaults
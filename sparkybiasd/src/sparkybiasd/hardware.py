@@ -7,8 +7,13 @@
 
 import smbus2
 import time
+import logging
+from collections import deque
+from dataclasses import dataclass
 import numpy as np
 
+logger = logging.getLogger(__name__)
+
 # Constants for the INA219
 INA219_CONFIG_BVOLTAGERANGE_32V = 0x2000
 INA219_CONFIG_GAIN_4_160MV = 0x1000
@@ -45,6 +50,68 @@ INA219CONFIG = MSBF(
 )
 INACALVALUE = MSBF(0x1000)
 
+# INA219 ADC resolution -> BADC/SADC field, and conversion time of one sample (datasheet table 5)
+INA219_ADC_RESOLUTION_BITS = {9: 0b0000, 10: 0b0001, 11: 0b0010, 12: 0b0011}
+INA219_ADC_CONVERSION_TIME = {9: 84e-6, 10: 148e-6, 11: 276e-6, 12: 532e-6}
+INA219_PGA_BITS = {40: 0b00, 80: 0b01, 160: 0b10, 320: 0b11}
+INA219_BUS_RANGE_BITS = {16: 0, 32: 1}
+
+
+@dataclass(frozen=True)
+class AdcProfile:
+    """
+    INA219 ADC settings for one channel. The same resolution/averaging is used for the bus and shunt ADCs.
+
+    Parameters:
+        name(str): Name of the profile (key in conf.adcProfiles)
+        resolution(int): ADC resolution in bits, 9 to 12
+        samples(int): Samples averaged in hardware, 1 to 128 (power of two, 12 bit only)
+        bus_range(int): Bus voltage range, 16 or 32 V
+        gain(int): PGA shunt range, 40, 80, 160 or 320 mV
+    """
+
+    name: str = "default"
+    resolution: int = 12
+    samples: int = 1
+    bus_range: int = 32
+    gain: int = 160
+
+    def __post_init__(self):
+        if self.resolution not in INA219_ADC_RESOLUTION_BITS:
+            raise ValueError(f"ADC resolution must be one of {list(INA219_ADC_RESOLUTION_BITS)}")
+        if self.samples not in (1, 2, 4, 8, 16, 32, 64, 128):
+            raise ValueError("ADC samples must be a power of two between 1 and 128")
+        if self.samples > 1 and self.resolution != 12:
+            raise ValueError("Hardware averaging is only available at 12 bit resolution")
+        if self.bus_range not in INA219_BUS_RANGE_BITS:
+            raise ValueError(f"Bus range must be one of {list(INA219_BUS_RANGE_BITS)}")
+        if self.gain not in INA219_PGA_BITS:
+            raise ValueError(f"PGA gain must be one of {list(INA219_PGA_BITS)}")
+
+    def adc_bits(self) -> int:
+        if self.samples > 1:
+            return 0b1000 | (self.samples.bit_length() - 1)
+        return INA219_ADC_RESOLUTION_BITS[self.resolution]
+
+    def config_word(self) -> int:
+        """Value of the INA219 config register, MSB first like INA219CONFIG"""
+        adc = self.adc_bits()
+        return MSBF(
+            (INA219_BUS_RANGE_BITS[self.bus_range] << 13)
+            | (INA219_PGA_BITS[self.gain] << 11)
+            | (adc << 7)
+            | (adc << 3)
+            | INA219_CONFIG_MODE_SANDBVOLT_CONTINUOUS
+        )
+
+    def conversion_time(self) -> float:
+        """Seconds for one complete bus + shunt conversion"""
+        return 2 * INA219_ADC_CONVERSION_TIME[self.resolution] * self.samples
+
+    def software_samples(self, navg: int) -> int:
+        """Number of register reads needed to average `navg` samples when the chip already averages `samples`"""
+        return max(1, navg // self.samples)
+
 INA219ADDRTABLE = {
     1: 0x40,
     2: 0x41,
@@ -65,6 +132,71 @@ AD5144ADDRTABLE = {
     7: 0x23,
     8: 0x2F,
 }
+# Wiper code (0-1023) -> values of the four AD5144 RDACs of a channel. The code is spread over the RDACs in
+# thermometer fashion: RDAC1 holds code % 256 and the next code // 256 RDACs are full scale.
+WIPER_RDAC_TABLE = tuple(
+    tuple([code % 256] + [255] * (code // 256) + [0] * (3 - code // 256)) for code in range(1023 + 1)
+)
+AD5144_WRITE_RDAC = 0b0001_0000
+
+
+def open_bus(backend: str = "smbus2", device: str = "/dev/i2c-1", **sim_kwargs):
+    """Open the I2C bus used by every BiasCard.
+
+    Parameters:
+        backend(str): "smbus2" for the real bus on the PI, "simulated" for an in-process simulated crate
+        device(str): I2C device node, only used by the smbus2 backend
+        sim_kwargs: Passed through to simbus.SimulatedBus when backend is "simulated"
+
+    Returns:
+        An object implementing the smbus2.SMBus API
+    """
+    if backend == "smbus2":
+        return smbus2.SMBus(device)
+    if backend == "simulated":
+        from .simbus import SimulatedBus
+
+        return SimulatedBus(**sim_kwargs)
+    raise ValueError(f"Unknown I2C backend '{backend}'")
+
+
+class SettleCheck:
+    """
+    Decides when an output has settled from fresh bus voltage conversions. Conversions are only a conversion time
+    apart, so a slowly settling regulator moves less than any useful threshold between two of them. Each
+    conversion is therefore compared to the one taken at least `window` seconds before it; the output is settled
+    once `count` successive comparisons agree within `threshold` volts. `window` should be at least the time
+    constant of the regulator.
+
+    Parameters:
+        threshold(float): Largest change in V over `window` of a settled output
+        count(int): Successive comparisons that have to agree
+        window(float): Seconds between the two conversions of a comparison
+    """
+
+    def __init__(self, threshold: float = 0.004, count: int = 2, window: float = 0.05):
+        self.threshold = threshold
+        self.count = count
+        self.window = window
+        self.readings = deque()
+        self.stable = 0
+
+    def update(self, t: float, vbus: float) -> bool:
+        """Add the conversion `vbus` taken at time `t` (seconds). Returns True once the output has settled."""
+        readings = self.readings
+        while len(readings) > 1 and t - readings[1][0] >= self.window:
+            readings.popleft()
+        if readings and t - readings[0][0] >= self.window:
+            if abs(vbus - readings[0][1]) <= self.threshold:
+                self.stable += 1
+            else:
+                self.stable = 0
+        readings.append((t, vbus))
+        return self.stable >= self.count
+
+    def poll_interval(self, conv: float) -> float:
+        """Time between two polls: every conversion, but no more often than needed to fill a window"""
+        return max(0.9 * conv, self.window / 4)
 
 
 class BiasCard:
@@ -72,13 +204,42 @@ class BiasCard:
     Represents an individual bias card within a bias supply.
     On init, attempts to connect LTC4302 (Address 0) I2C bus. This is the gate between the PI at 3v3 and the rest of the
     system at 5V.
+
+    All cards share the class level iicBus. It is opened on first use (the PI's /dev/i2c-1) unless something like
+    BiasCrate has already installed a different backend with `BiasCard.iicBus = open_bus(...)`.
     """
 
-    iicBus = smbus2.SMBus("/dev/i2c-1")
+    iicBus = None
+    # Seconds between read backs of the INA219 calibration registers. A mismatch means the card lost power.
+    # Also the longest a held card goes without a successful transaction before its repeater is rewritten.
+    verify_interval = 10.0
+    # Card whose LTC4302 is currently connected (None when every card is isolated) and whether the backplane
+    # repeater (address 0) has been connected on this bus. Shared by all cards like iicBus.
+    selected = None
+    backplane_connected = False
+    # When set, close() leaves the card connected. It is only disconnected once a different card is opened,
+    # which saves two repeater writes per operation when consecutive operations address the same card.
+    hold_selection = False
 
     def __init__(self, address) -> None:
-
-        self.set_repeater(0, True, False, True)
+        if BiasCard.iicBus is None:
+            BiasCard.iicBus = open_bus()
+            BiasCard.forget_selection()
+        # Last value written to each INA219 register, per channel. Writes of an unchanged value are skipped.
+        self.ina_shadow = {ch: {} for ch in range(1, 8 + 1)}
+        self.adc_profiles = {ch: AdcProfile() for ch in range(1, 8 + 1)}
+        self._last_verify = time.monotonic()
+        # Last time an operation on the connected card succeeded. A card that lost power comes back with its
+        # repeater disconnected and fails every transaction, so success proves the repeater is still connected.
+        self._last_seen = 0.0
+        # Last values written to the AD5144 RDACs of each channel and to the expander ports (None = unknown).
+        # Only registers whose value changes are written.
+        self.rdac_shadow = {ch: [None] * 4 for ch in range(1, 8 + 1)}
+        self.expander_shadow = None
+
+        if not BiasCard.backplane_connected:
+            self.set_repeater(0, True, False, True)
+            BiasCard.backplane_connected = True
         self.address = address
         self.open()
         self.channel_enables = 0
@@ -124,6 +285,7 @@ class BiasCard:
         w4 = BiasCard.iicBus.read_byte(AD5144ADDRTABLE[chan])
 
         tot = w1 + w2 + w3 + w4
+        self.rdac_shadow[chan] = [w1, w2, w3, w4]
         self.wiper_states[chan - 1] = tot
         return tot
 
@@ -137,33 +299,108 @@ class BiasCard:
             # len does not eq 2?
             pass
 
-    def close(self):
-        """Close i2c bus on ltc4302 repeater"""
+    def close(self, force: bool = False):
+        """
+        Close i2c bus on ltc4302 repeater. With hold_selection set this is deferred unless `force` is given.
+        Called without `force` only after the operation on the card succeeded (see BiasCrate.board_open).
+        """
+        if BiasCard.hold_selection and not force:
+            if BiasCard.selected == self.address:
+                self._last_seen = time.monotonic()
+            return
+        if BiasCard.selected == self.address:
+            BiasCard.selected = None
         self.set_repeater(self.address, False, True, True)
 
     def open(self):
-        """Open i2c bus on ltc4302 repeater"""
-        self.set_repeater(self.address, True, False, True)
+        """
+        Open i2c bus on ltc4302 repeater. A different card that is still connected is disconnected first so that
+        only one card is ever on the bus. Re-opening the selected card is skipped unless it went verify_interval
+        without a successful operation, so that a card that lost power (and with it the repeater state) gets
+        reconnected.
+        """
+        if BiasCard.selected == self.address and time.monotonic() - self._last_seen < self.verify_interval:
+            return
+        try:
+            if BiasCard.selected not in (None, self.address):
+                BiasCard.release()
+            self.set_repeater(self.address, True, False, True)
+        except OSError:
+            # Card went away; once it answers again its registers can't be trusted until verified
+            self.lost()
+            raise
+        BiasCard.selected = self.address
+        self._last_seen = time.monotonic()
+
+    def lost(self):
+        """Forget that this card is connected after a failed transaction; the next open() reconnects and verifies it."""
+        if BiasCard.selected == self.address:
+            BiasCard.selected = None
+        self._last_verify = 0.0
+        self._last_seen = 0.0
+        self.forget_shadows()
+
+    def forget_shadows(self):
+        """Mark the RDAC and expander shadows unknown so that the next writes go out in full."""
+        self.rdac_shadow = {ch: [None] * 4 for ch in range(1, 8 + 1)}
+        self.expander_shadow = None
+
+    @classmethod
+    def release(cls):
+        """Disconnect whichever card is still connected."""
+        if cls.selected is None:
+            return
+        card, cls.selected = cls.selected, None
+        try:
+            cls.iicBus.write_byte(0x60 + card, 0b0_11_00000)  # Bus disconnected, GPIO1 and GPIO2 high like close()
+        except OSError:
+            # A card that stopped answering is isolated from the bus anyway
+            logger.warning(f"Card {card} did not answer while being disconnected")
+
+    @classmethod
+    def forget_selection(cls):
+        """Reset the tracked repeater state, e.g. after installing a new iicBus."""
+        cls.selected = None
+        cls.backplane_connected = False
+
+    @classmethod
+    def check_selection(cls, addresses) -> None:
+        """
+        Debug check of the bus ownership invariant: reads back the repeater of every card in `addresses` and
+        raises AssertionError unless exactly the tracked card (or none) is connected.
+        """
+        connected = [a for a in addresses if cls.iicBus.read_byte(0x60 + a) & 0b1_00_00000]
+        expected = [] if cls.selected is None else [cls.selected]
+        if connected != expected:
+            raise AssertionError(f"Bus ownership violated: cards {connected} connected, expected {expected}")
 
     def enable_all_chan(self):
         """Enables the output of all of the card's bias supply lines."""
-        for i in range(1, 8 + 1):
-            self.enable_chan(i, True)
+        self.channel_enables = 0xFF
+        self._write_expander()
 
     def enable_all_testloads(self):
         """Enables the output of all of the card's bias supply lines."""
-        for i in range(1, 8 + 1):
-            self.enable_testload(i, True)
+        self.test_enables = 0xFF
+        self._write_expander()
 
     def disable_all_chan(self):
         """Creates an OPEN on all of this card's bias supply lines."""
-        for i in range(1, 8 + 1):
-            self.enable_chan(i, False)
+        self.channel_enables = 0
+        self._write_expander()
 
     def disable_all_testloads(self):
         """Creates an OPEN on all of this card's bias supply lines."""
-        for i in range(1, 8 + 1):
-            self.enable_testload(i, False)
+        self.test_enables = 0
+        self._write_expander()
+
+    def _write_expander(self):
+        """Write channel_enables/test_enables to the (active low) expander ports unless they already hold them."""
+        ports = (~self.channel_enables & 0xFF, ~self.test_enables & 0xFF)
+        if ports == self.expander_shadow:
+            return
+        BiasCard.iicBus.write_byte_data(0x27, ports[0], ports[1])
+        self.expander_shadow = ports
 
     def enable_testload(self, channel: int, en: bool = True):
         """
@@ -182,7 +419,7 @@ class BiasCard:
             p = self.test_enables & (~(1 << (channel - 1)))
 
         self.test_enables = p & 0xFF
-        BiasCard.iicBus.write_byte_data(0x27, ~self.channel_enables, ~self.test_enables)
+        self._write_expander()
 
     def enable_chan(self, channel: int, en: bool = True):
         """
@@ -201,7 +438,7 @@ class BiasCard:
             p = self.channel_enables & (~(1 << (channel - 1)))
 
         self.channel_enables = p & 0xFF
-        BiasCard.iicBus.write_byte_data(0x27, ~self.channel_enables, ~self.test_enables)
+        self._write_expander()
 
     def set_repeater(
         self, address: int, en_bus: bool, en_gpio1: bool, en_gpio2: bool
@@ -230,53 +467,21 @@ class BiasCard:
         BiasCard.iicBus.write_byte(0x60 + address, cmd)
 
     def set_wiper(self, channel, value):
+        """Set the wiper code (0-1023) of a channel, writing only the RDACs whose value changes."""
         assert value >= 0 and value <= 1023, f"Invalid value of {value}"
-        div = value // 256
-        rem = value % 256
-        x = 0
-        for _ in range(div):
-            x = (x | 255) << 8
-        x = x + rem
-
-        BiasCard.iicBus.write_byte_data(AD5144ADDRTABLE[channel], 0b00010000, x & 0xFF)
-        BiasCard.iicBus.write_byte_data(
-            AD5144ADDRTABLE[channel], 0b00010001, (x >> 8) & 0xFF
-        )
-        BiasCard.iicBus.write_byte_data(
-            AD5144ADDRTABLE[channel], 0b00010010, (x >> 16) & 0xFF
-        )
-        BiasCard.iicBus.write_byte_data(
-            AD5144ADDRTABLE[channel], 0b00010011, (x >> 24) & 0xFF
-        )
+        addr = AD5144ADDRTABLE[channel]
+        shadow = self.rdac_shadow[channel]
+        for rdac, x in enumerate(WIPER_RDAC_TABLE[value]):
+            if shadow[rdac] != x:
+                BiasCard.iicBus.write_byte_data(addr, AD5144_WRITE_RDAC | rdac, x)
+                shadow[rdac] = x
         self.wiper_states[channel - 1] = value
 
     def set_wiper_max(self, channel):
-        x = 0xFF_FF_FF_FF
-        BiasCard.iicBus.write_byte_data(AD5144ADDRTABLE[channel], 0b00010000, x & 0xFF)
-        BiasCard.iicBus.write_byte_data(
-            AD5144ADDRTABLE[channel], 0b00010001, (x >> 8) & 0xFF
-        )
-        BiasCard.iicBus.write_byte_data(
-            AD5144ADDRTABLE[channel], 0b00010010, (x >> 16) & 0xFF
-        )
-        BiasCard.iicBus.write_byte_data(
-            AD5144ADDRTABLE[channel], 0b00010011, (x >> 24) & 0xFF
-        )
-        self.wiper_states[channel - 1] = 1023
+        self.set_wiper(channel, 1023)
 
     def set_wiper_min(self, channel):
-        x = 0
-        BiasCard.iicBus.write_byte_data(AD5144ADDRTABLE[channel], 0b00010000, x & 0xFF)
-        BiasCard.iicBus.write_byte_data(
-            AD5144ADDRTABLE[channel], 0b00010001, (x >> 8) & 0xFF
-        )
-        BiasCard.iicBus.write_byte_data(
-            AD5144ADDRTABLE[channel], 0b00010010, (x >> 16) & 0xFF
-        )
-        BiasCard.iicBus.write_byte_data(
-            AD5144ADDRTABLE[channel], 0b00010011, (x >> 24) & 0xFF
-        )
-        self.wiper_states[channel - 1] = 0
+        self.set_wiper(channel, 0)
 
     def init_currsense(self, chan: int, currentDivider: float = 100.0) -> None:
         """Initializes an INA219 current sense chip for a given channel
@@ -292,18 +497,61 @@ class BiasCard:
         self.ina219_currentDivider_mA = currentDivider
         self.ina219_powerMultiplier_mW = 2
 
+        # Forget what we think the chip holds so that both registers are written
+        self.ina_shadow[chan].clear()
         # Set Calibration register to 'Cal' calculated above
-        BiasCard.iicBus.write_word_data(
-            INA219ADDRTABLE[chan], INA219_REG_CALIBRATION, INACALVALUE
-        )
-        BiasCard.iicBus.write_word_data(
-            INA219ADDRTABLE[chan], INA219_REG_CONFIG, INA219CONFIG
-        )
+        self._ina_write(chan, INA219_REG_CALIBRATION, INACALVALUE)
+        self._ina_write(chan, INA219_REG_CONFIG, self.adc_profiles[chan].config_word())
+
+    def set_adc_profile(self, chan: int, profile: AdcProfile) -> None:
+        """Select the INA219 ADC profile of a channel. The config register is only written if it changes."""
+        assert chan > 0 and chan < 9, "Expected channel 1 through 8"
+        self.adc_profiles[chan] = profile
+        self._ina_write(chan, INA219_REG_CONFIG, profile.config_word())
+
+    def _ina_write(self, chan: int, register: int, value: int) -> None:
+        """Write an INA219 register (value already MSB first) unless the shadow says it already holds value."""
+        if self.ina_shadow[chan].get(register) == value:
+            return
+        BiasCard.iicBus.write_word_data(INA219ADDRTABLE[chan], register, value)
+        self.ina_shadow[chan][register] = value
+
+    def _ina_prepare(self, chan: int) -> None:
+        """Make sure the calibration register is set before reading current or power."""
+        if time.monotonic() - self._last_verify > self.verify_interval:
+            self.verify_currsense()
+        self._ina_write(chan, INA219_REG_CALIBRATION, INACALVALUE)
+
+    def verify_currsense(self) -> list:
+        """
+        Read back the calibration register of every INA219 and compare it with the shadow. Chips that
+        don't match (reset by a power loss) are re-initialized. If every chip was reset, the whole card
+        lost power: the expander is back to all outputs off and the wipers are re-read.
+
+        Returns:
+            List of channels whose INA219 had to be re-initialized
+        """
+        self._last_verify = time.monotonic()
+        reset = []
+        for chan in range(1, 8 + 1):
+            expected = self.ina_shadow[chan].get(INA219_REG_CALIBRATION)
+            actual = BiasCard.iicBus.read_word_data(INA219ADDRTABLE[chan], INA219_REG_CALIBRATION)
+            if expected != actual:
+                reset.append(chan)
+                self.init_currsense(chan, self.ina219_currentDivider_mA)
+        if len(reset) == 8:
+            logger.error(f"Card {self.address} appears to have lost power, outputs are disabled")
+            self.channel_enables = 0
+            self.test_enables = 0
+            self.expander_shadow = (0xFF, 0xFF)  # Power on state of the ports, all outputs off
+            for chan in range(1, 8 + 1):
+                self.read_ad5144(chan)
+        elif reset:
+            logger.warning(f"Card {self.address} INA219 on channels {reset} lost calibration, re-initialized")
+        return reset
 
     def _ina_getCurrent_raw(self, chan):
-        BiasCard.iicBus.write_word_data(
-            INA219ADDRTABLE[chan], INA219_REG_CALIBRATION, INACALVALUE
-        )
+        self._ina_prepare(chan)
         val = MSBF(
             BiasCard.iicBus.read_word_data(INA219ADDRTABLE[chan], INA219_REG_CURRENT)
         )
@@ -311,9 +559,7 @@ class BiasCard:
         return val
 
     def _ina_getPower_raw(self, chan):
-        BiasCard.iicBus.write_word_data(
-            INA219ADDRTABLE[chan], INA219_REG_CALIBRATION, INACALVALUE
-        )
+        self._ina_prepare(chan)
         val = MSBF(
             BiasCard.iicBus.read_word_data(INA219ADDRTABLE[chan], INA219_REG_POWER)
         )
@@ -331,9 +577,7 @@ class BiasCard:
         return val
 
     def _ina_getBusVoltage_raw(self, chan):
-        BiasCard.iicBus.write_word_data(
-            INA219ADDRTABLE[chan], INA219_REG_CALIBRATION, INACALVALUE
-        )
+        # Bus voltage doesn't depend on the calibration register
         val = MSBF(
             BiasCard.iicBus.read_word_data(INA219ADDRTABLE[chan], INA219_REG_BUSVOLTAGE)
         )
@@ -344,6 +588,7 @@ class BiasCard:
 
     def get_shunt(self, chan: int, navg: int = 6) -> float:
         """Reads a current monitor for it's shunt voltage for a given channel."""
+        navg = self.adc_profiles[chan].software_samples(navg)
         val = np.zeros(navg)
         for ind, _ in enumerate(val):
             val[ind] = 0.01 * self._ina_getShuntVoltage_raw(chan)
@@ -355,6 +600,7 @@ class BiasCard:
 
     def get_bus(self, chan: int, navg: int = 6) -> float:
         """Reads a current monitor for it's bus voltage for a given channel"""
+        navg = self.adc_profiles[chan].software_samples(navg)
         val = np.zeros(navg)
         for ind, _ in enumerate(val):
             val[ind] = self._ina_getBusVoltage_raw(chan) * 0.001
@@ -363,6 +609,7 @@ class BiasCard:
 
     def get_current(self, chan: int, navg: int = 6) -> float:
         """Reads a current monitor for the bias's current draw for a given channel"""
+        navg = self.adc_profiles[chan].software_samples(navg)
         val = np.zeros(navg)
         for ind, _ in enumerate(val):
             val[ind] = self._ina_getCurrent_raw(chan) / (self.ina219_currentDivider_mA)
@@ -371,3 +618,110 @@ class BiasCard:
             return 0.0
         else:
             return m
+
+    def measure(self, chan: int, navg: int = 6) -> tuple:
+        """
+        Reads bus voltage, shunt voltage and current of a channel in a single pass. Each register is read with
+        one smbus2.i2c_rdwr combined transaction (pointer write, repeated start, read), see _read_register.
+
+        Returns:
+            (vbus in V, vshunt in mV, current in mA), each averaged over navg samples
+            (hardware averaged samples of the active AdcProfile count towards navg)
+        """
+        return self.measure_many([chan], navg)[chan]
+
+    def measure_many(self, chans: list, navg: int = 6) -> dict:
+        """
+        Like measure() for several channels of the card at once, preparing every INA219 once up front.
+
+        Returns:
+            {channel: (vbus in V, vshunt in mV, current in mA)}
+        """
+        regs = (INA219_REG_BUSVOLTAGE, INA219_REG_SHUNTVOLTAGE, INA219_REG_CURRENT)
+        counts = {}
+        pending = []
+        for chan in chans:
+            counts[chan] = self.adc_profiles[chan].software_samples(navg)
+            self._ina_prepare(chan)
+            addr = INA219ADDRTABLE[chan]
+            pending += [(chan, addr, reg) for _ in range(counts[chan]) for reg in regs]
+
+        raw = {chan: [] for chan in chans}
+        for chan, addr, reg in pending:
+            raw[chan].append(self._read_register(addr, reg))
+
+        out = {}
+        for chan in chans:
+            words = np.frombuffer(b"".join(raw[chan]), dtype=">i2").reshape(counts[chan], len(regs)).astype(np.int32)
+            vbus = float(np.average((words[:, 0] & 0xFFFF) >> 3) * 4 * 0.001)
+            vshunt = float(np.average(words[:, 1]) * 0.01)
+            current = float(np.average(words[:, 2]) / self.ina219_currentDivider_mA)
+            out[chan] = (vbus, max(vshunt, 0.0), current if current >= 0.1 else 0.0)
+        return out
+
+    @staticmethod
+    def _read_register(addr: int, reg: int) -> bytes:
+        """
+        Read a 16 bit register (MSB first) as a pointer write and a read joined by a repeated start. The Pi's
+        i2c-bcm2835 driver only accepts a read as the last message of a combined transaction (EOPNOTSUPP
+        otherwise), so every register read is a transaction of its own.
+        """
+        rd = smbus2.i2c_msg.read(addr, 2)
+        BiasCard.iicBus.i2c_rdwr(smbus2.i2c_msg.write(addr, [reg]), rd)
+        return bytes(rd)
+
+    def poll_conversion(self, chan: int) -> tuple:
+        """
+        Read the bus voltage register and, if its CNVR flag is set, the power register to clear the flag. A set
+        flag means the bus voltage is from a conversion that completed since the previous fresh poll.
+
+        Returns:
+            (fresh, vbus in V)
+        """
+        addr = INA219ADDRTABLE[chan]
+        val = int.from_bytes(self._read_register(addr, INA219_REG_BUSVOLTAGE), "big")
+        fresh = bool(val & 0b10)
+        if fresh:
+            self._read_register(addr, INA219_REG_POWER)
+        return fresh, (val >> 3) * 4 * 0.001
+
+    def wait_conversion(self, chan: int, timeout: float):
+        """Poll CNVR until a new conversion completes. Returns the bus voltage or None on timeout."""
+        conv = self.adc_profiles[chan].conversion_time()
+        deadline = time.monotonic() + timeout
+        while True:
+            fresh, vbus = self.poll_conversion(chan)
+            if fresh:
+                return vbus
+            if time.monotonic() >= deadline:
+                return None
+            time.sleep(min(conv / 8, max(deadline - time.monotonic(), 0)))
+
+    def settle(
+        self, chan: int, timeout: float, threshold: float = 0.004, count: int = 2, window: float = 0.05
+    ) -> float:
+        """
+        Wait until a channel's output stops changing: `count` successive fresh conversions of the bus voltage
+        within `threshold` volts of the conversion `window` seconds before them (see SettleCheck). Returns early
+        as soon as that happens, otherwise after `timeout` seconds (never less than three conversions of the
+        active AdcProfile).
+
+        Returns:
+            Seconds spent waiting
+        """
+        conv = self.adc_profiles[chan].conversion_time()
+        timeout = max(timeout, 3 * conv)
+        check = SettleCheck(threshold, count, window)
+        start = time.monotonic()
+        self.poll_conversion(chan)  # Clear a CNVR left over from before the change
+        while True:
+            remaining = timeout - (time.monotonic() - start)
+            if remaining <= 0:
+                break
+            vbus = self.wait_conversion(chan, remaining)
+            if vbus is None:
+                break
+            if check.update(time.monotonic(), vbus):
+                break
+            time.sleep(min(check.poll_interval(conv), max(timeout - (time.monotonic() - start), 0)))
+        return time.monotonic() - start
@@ -0,0 +1,245 @@
+"""
+@authors: Cody Roberson (carobers@asu.edu)
+@Documantation:
+    Server side command macros. A macro is a named, declarative sequence of ordinary daemon commands with loops over
+    cards/channels, waits and checks on measured values. It runs inside the daemon, next to the hardware, so a
+    bias-up procedure costs one round trip instead of one per step.
+
+    Macros are plain json/yaml data, nothing is evaluated. A macro is a dict with optional "params" (default values
+    of variables the caller may override) and a list of "steps". Each step is one of:
+
+        {"command": "seekVoltage", "args": {...}, "save": "name", "onError": "abort" | "continue"}
+        {"forEach": {"card": [1, 2], "channel": [1, 2, 3]}, "do": [steps]}
+        {"wait": seconds}
+        {"if": condition, "then": [steps], "else": [steps]}
+        {"check": condition, "message": "text"}
+
+    A condition is {"left": value, "op": "<" | "<=" | ">" | ">=" | "==" | "!=", "right": value}. Anywhere a value is
+    expected, a string "$name" or "$name.field" refers to a loop variable, a parameter, a saved command reply or the
+    builtin "$cards" (the available cards). A failed check or command (unless onError is "continue") aborts the macro.
+"""
+
+import asyncio
+import itertools
+import logging
+import operator
+import os
+
+from omegaconf import OmegaConf
+
+logger = logging.getLogger(__name__)
+
+STEP_KINDS = ("command", "forEach", "wait", "if", "check")
+OPERATORS = {
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "==": operator.eq,
+    "!=": operator.ne,
+}
+
+
+class MacroError(ValueError):
+    """Invalid macro definition, or a macro that had to be aborted"""
+
+
+def validate_macro(macro: dict, commands) -> None:
+    """
+    Check the structure of a macro definition.
+
+    Parameters:
+        macro(dict): The macro definition
+        commands: Names of the commands a macro may use
+
+    Raises:
+        MacroError describing the first problem found
+    """
+    if not isinstance(macro, dict):
+        raise MacroError("A macro must be a dictionary with 'steps'")
+    unknown = set(macro) - {"params", "steps", "description"}
+    if unknown:
+        raise MacroError(f"Unknown macro keys {sorted(unknown)}")
+    if not isinstance(macro.get("params", {}), dict):
+        raise MacroError("'params' must be a dictionary of default values")
+    _validate_steps(macro.get("steps"), commands, "steps")
+
+
+def _validate_steps(steps, commands, path: str):
+    if not isinstance(steps, list) or len(steps) == 0:
+        raise MacroError(f"{path} must be a non-empty list of steps")
+    for i, step in enumerate(steps):
+        where = f"{path}[{i}]"
+        if not isinstance(step, dict):
+            raise MacroError(f"{where} must be a dictionary")
+        kinds = [k for k in STEP_KINDS if k in step]
+        if len(kinds) != 1:
+            raise MacroError(f"{where} must have exactly one of {list(STEP_KINDS)}")
+        kind = kinds[0]
+        if kind == "command":
+            if step["command"] not in commands:
+                raise MacroError(f"{where}: command '{step['command']}' can't be used in a macro")
+            if not isinstance(step.get("args", {}), dict):
+                raise MacroError(f"{where}: 'args' must be a dictionary")
+            if "save" in step and not isinstance(step["save"], str):
+                raise MacroError(f"{where}: 'save' must be a variable name")
+            if step.get("onError", "abort") not in ("abort", "continue"):
+                raise MacroError(f"{where}: 'onError' must be 'abort' or 'continue'")
+        elif kind == "forEach":
+            if not isinstance(step["forEach"], dict) or len(step["forEach"]) == 0:
+                raise MacroError(f"{where}: 'forEach' must map variable names to lists")
+            _validate_steps(step.get("do"), commands, f"{where}.do")
+        elif kind == "wait":
+            wait = step["wait"]
+            if not isinstance(wait, str) and (isinstance(wait, bool) or not isinstance(wait, (int, float)) or wait < 0):
+                raise MacroError(f"{where}: 'wait' must be a non-negative number of seconds")
+        elif kind == "if":
+            _validate_condition(step["if"], where)
+            _validate_steps(step.get("then"), commands, f"{where}.then")
+            if "else" in step:
+                _validate_steps(step["else"], commands, f"{where}.else")
+        elif kind == "check":
+            _validate_condition(step["check"], where)
+
+
+def _validate_condition(condition, where: str):
+    if not isinstance(condition, dict) or set(condition) != {"left", "op", "right"}:
+        raise MacroError(f"{where}: a condition needs exactly 'left', 'op' and 'right'")
+    if condition["op"] not in OPERATORS:
+        raise MacroError(f"{where}: unknown operator '{condition['op']}', expected one of {list(OPERATORS)}")
+
+
+def resolve(value, scope: dict):
+    """Substitute "$name" / "$name.field" references in `value` from `scope`."""
+    if isinstance(value, str) and value.startswith("$"):
+        name, *fields = value[1:].split(".")
+        if name not in scope:
+            raise MacroError(f"Unknown variable '{value}'")
+        value = scope[name]
+        for field in fields:
+            if not isinstance(value, dict) or field not in value:
+                raise MacroError(f"'{value}' has no field '{field}'")
+            value = value[field]
+        return value
+    if isinstance(value, list):
+        return [resolve(v, scope) for v in value]
+    if isinstance(value, dict):
+        return {k: resolve(v, scope) for k, v in value.items()}
+    return value
+
+
+def evaluate(condition: dict, scope: dict) -> bool:
+    left = resolve(condition["left"], scope)
+    right = resolve(condition["right"], scope)
+    try:
+        return bool(OPERATORS[condition["op"]](left, right))
+    except TypeError as e:
+        raise MacroError(f"Can't compare {left!r} {condition['op']} {right!r}") from e
+
+
+class MacroRun:
+    """
+    Executes one macro invocation.
+
+    Parameters:
+        execute: Coroutine function running a command envelope ({"command", "args"}) and returning the reply dict
+        max_steps(int): Upper bound on executed steps, loops included
+        max_wait(float): Upper bound on a single wait step in seconds
+    """
+
+    def __init__(self, execute, max_steps: int = 10000, max_wait: float = 600.0):
+        self.execute = execute
+        self.max_steps = max_steps
+        self.max_wait = max_wait
+        self.steps = 0
+        self.results = []
+
+    async def run(self, macro: dict, params: dict, builtins: dict) -> list:
+        """Run the macro. Returns the reply of every command executed, raises MacroError if aborted."""
+        unknown = set(params) - set(macro.get("params", {}))
+        if unknown:
+            raise MacroError(f"Unknown macro parameters {sorted(unknown)}")
+        scope = {**builtins, **macro.get("params", {}), **params}
+        await self._run_steps(macro["steps"], scope)
+        return self.results
+
+    async def _run_steps(self, steps: list, scope: dict):
+        for step in steps:
+            self.steps += 1
+            if self.steps > self.max_steps:
+                raise MacroError(f"Macro exceeded {self.max_steps} steps")
+            if "command" in step:
+                await self._command(step, scope)
+            elif "forEach" in step:
+                names = list(step["forEach"])
+                values = [resolve(step["forEach"][n], scope) for n in names]
+                for n, v in zip(names, values):
+                    if not isinstance(v, list):
+                        raise MacroError(f"forEach variable '{n}' must be a list")
+                for combination in itertools.product(*values):
+                    await self._run_steps(step["do"], {**scope, **dict(zip(names, combination))})
+            elif "wait" in step:
+                wait = resolve(step["wait"], scope)
+                if isinstance(wait, bool) or not isinstance(wait, (int, float)) or not (0 <= wait <= self.max_wait):
+                    raise MacroError(f"wait must be between 0 and {self.max_wait} seconds, got {wait!r}")
+                await asyncio.sleep(wait)
+            elif "if" in step:
+                branch = step["then"] if evaluate(step["if"], scope) else step.get("else", [])
+                await self._run_steps(branch, scope)
+            elif "check" in step:
+                if not evaluate(step["check"], scope):
+                    c = step["check"]
+                    detail = f"{c['left']} = {resolve(c['left'], scope)!r} {c['op']} {resolve(c['right'], scope)!r}"
+                    raise MacroError(f"Check failed: {step.get('message', detail)}")
+
+    async def _command(self, step: dict, scope: dict):
+        command = {"command": step["command"], "args": resolve(step.get("args", {}), scope)}
+        result = await self.execute(command)
+        self.results.append({"command": step["command"], **result})
+        if "save" in step:
+            scope[step["save"]] = result
+        if result.get("status") != "success" and step.get("onError", "abort") == "abort":
+            raise MacroError(f"{step['command']} {command['args']} failed: {result.get('msg', result)}")
+
+
+class MacroStore:
+    """
+    Named macros, persisted to a yaml file.
+
+    Parameters:
+        path(str): yaml file the macros are kept in
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.macros: dict[str, dict] = {}
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            self.macros = OmegaConf.to_container(OmegaConf.load(self.path)) or {}
+        except Exception as e:
+            logger.error(f"Could not load macros from {self.path}: {e}")
+
+    def save(self):
+        OmegaConf.save(OmegaConf.create(self.macros), self.path)
+
+    def define(self, name: str, macro: dict, commands):
+        if not isinstance(name, str) or not name:
+            raise MacroError("Macro name must be a non-empty string")
+        validate_macro(macro, commands)
+        self.macros[name] = macro
+        self.save()
+
+    def delete(self, name: str):
+        if name not in self.macros:
+            raise MacroError(f"Unknown macro '{name}'")
+        del self.macros[name]
+        self.save()
+
+    def get(self, name: str) -> dict:
+        if name not in self.macros:
+            raise MacroError(f"Unknown macro '{name}'")
+        return self.macros[name]
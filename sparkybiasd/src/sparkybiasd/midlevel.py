@@ -1,10 +1,14 @@
-from .hardware import BiasCard
-import numpy as np
+from .hardware import INA219_REG_CONFIG, WIPER_RDAC_TABLE, AdcProfile, BiasCard, open_bus
+from .seek import WiperSeek, seek_settings
+from .transfer import TransferCurves
+from .telemetry import TelemetryBuffer, TelemetrySampler
 from omegaconf import OmegaConf
 from  .dconf import conf
 from .dconf import CONFIGPATH
 import time
+import threading
 import logging
+from contextlib import contextmanager
 
 logger = logging.getLogger(__name__)
 
@@ -29,99 +33,429 @@ def grab_board(func):
         if card not in self.cards:
             raise Exception(f"Card {card} not found in BiasCrate")
         board = self.cards[card]
-        try:
-            board.open()
-            res = func(self, board, *args, **kwargs)
-            board.close()
-        except Exception as e:
-            board.close()
-            raise e
-        return res
+        with self.board_open(board):
+            return func(self, board, *args, **kwargs)
 
+    wrapper.__doc__ = func.__doc__
     return wrapper
 
 
+def hold_bus(func):
+    """
+    Wrapper for crate wide operations that open and close cards themselves. Holds the crate's bus lock
+    so the telemetry sampler can't switch repeaters in the middle of the operation.
+    """
+
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+class Preempted(Exception):
+    """A crate wide operation stopped early because a safety command is waiting for the bus"""
+
+
+class ConfigError(ValueError):
+    """A setting in the configuration file that can't be applied to the crate"""
+
+
+def adc_profile(name: str) -> AdcProfile:
+    """Build the AdcProfile named `name` in conf.adcProfiles"""
+    if name not in conf.adcProfiles:
+        raise ValueError(f"Unknown ADC profile '{name}', expected one of {list(conf.adcProfiles.keys())}")
+    p = conf.adcProfiles[name]
+    return AdcProfile(name, p.resolution, p.samples, p.busRange, p.gain)
+
+
 class BiasCrate:
-    def __init__(self):
+    def __init__(self, bus=None, curve_path: str = CONFIGPATH + "transfer_curves.yaml"):
         """
         Repesents the collection of BiasCards within the BiasCrate. Implements the high level
         functions the user may want to use. For future me or other users: If you add more functions,
         simply add the grab_board decorator and supply the parameters self, board, channel.
+
+        Parameters:
+            bus: smbus2.SMBus compatible object to use. Defaults to the backend selected by conf.hardware
+            curve_path(str): Where learned transfer curves are persisted
         """
+        if bus is None:
+            hw = conf.hardware
+            bus = open_bus(hw.backend, hw.device, **OmegaConf.to_container(hw.simulated))
+        BiasCard.iicBus = bus
+        BiasCard.forget_selection()
+        # Keep the last card connected between operations, see BiasCard.open()
+        BiasCard.hold_selection = True
+        self.bus = bus
+        # Read back every repeater after each open to verify only the selected card is on the bus (debug aid)
+        self.check_bus = conf.hardware.checkBusOwnership or conf.loglevel <= logging.DEBUG
+        # Clock used for latency metrics (replaceable, e.g. by the simulated bus' virtual clock)
+        self.clock = time.monotonic
+        # Called with a progress event (dict) while seeks run, see _report_progress. Runs on the bus thread.
+        self.progress = None
+        self._progress_last = {}
+        # Called without arguments after every telemetry sweep, on the sampler thread
+        self.sweep_done = None
+        self.metrics = {
+            "emergencyDisable": {"count": 0, "lastSafe": 0.0, "worstSafe": 0.0, "lastTotal": 0.0, "worstTotal": 0.0},
+        }
+        # Serializes bus access between commands and the telemetry sampler thread
+        self.lock = threading.RLock()
+        # Set while a safety command for the whole crate waits for the bus, sweeps over the crate stop at the next
+        # card when set
+        self.preempt = threading.Event()
+        # (card, channel) of the outputs a safety command waits to disable, loadConfig stops before their cards
+        self.preempted_outputs = set()
+        self.telemetry = TelemetryBuffer(conf.telemetry.depth)
+        self.sampler = TelemetrySampler(self.sweep_telemetry, conf.telemetry.interval)
         self.cards: dict[int, BiasCard] = {}
         self.config = {}
+        tc = conf.transferCurves
+        self.curves = TransferCurves(
+            curve_path,
+            drift_abs={"vbus": tc.driftVolts, "current": tc.driftMilliamps},
+            drift_fraction=tc.driftFraction,
+            drift_span=tc.driftSpan,
+            save_interval=tc.saveInterval,
+            max_points=tc.maxPoints,
+        )
         for i in range(1, 18 + 1):
             try:
                 bc = BiasCard(i)
                 self.cards[i] = bc
             except OSError:
                 continue
+            self._apply_adc_profiles(bc)
 
-    @grab_board
-    def seek_voltage(self, board: BiasCard, channel: int, voltage: float, increment=1):
-        """set channel to specified voltage (in TBD Units)"""
-        assert voltage >= 0, "Can't generate negative voltages"
-        assert voltage <= 5, "Voltage spec out of range"
-        assert channel > 0 and channel <= 8, "Expected Channel 1 through 8"
-        assert increment > 0, "Increment must be a positive integer"
-        logger.info(f"Seeking voltage {voltage} on channel {channel}. This may take a while.")
-        wiper = board.wiper_states[channel - 1]
+    @contextmanager
+    def board_open(self, board: BiasCard):
+        """Hold the bus lock with `board` connected for the duration of a with block (see grab_board)."""
+        with self.lock:
+            try:
+                board.open()
+                if self.check_bus:
+                    BiasCard.check_selection(self.cards)
+                yield board
+                board.close()
+            except Exception as e:
+                if isinstance(e, OSError):
+                    board.lost()
+                board.close(force=True)
+                raise e
+
+    def _apply_adc_profiles(self, board: BiasCard, settings=None):
+        """Select the ADC profile configured for each channel of a card (conf.biasCards unless `settings` given)."""
+        settings = settings if settings is not None else conf.biasCards[f"card{board.address}"]
+        try:
+            board.open()
+            for j in range(1, 8 + 1):
+                board.set_adc_profile(j, adc_profile(settings[f"chan{j}"].get("adcProfile", "default")))
+        finally:
+            board.close()
+
+    def _record(self, board: BiasCard, channel: int, vbus: float = None, current: float = None):
+        """Add a measurement to the channel's transfer curves. Disabled outputs read zero and are ignored."""
+        if board.is_chan_enabled(channel):
+            self.curves.record(board.address, channel, board.wiper_states[channel - 1], vbus, current)
+
+    def _seek_start(self, board: BiasCard, channel: int, seek: WiperSeek, quantity: str) -> bool:
+        """
+        If the channel's transfer curve covers the target, jump the wiper straight to the predicted code
+        so the seek only has to fine tune from there.
+
+        Returns:
+            True if the wiper was moved and the output needs time to settle
+        """
         logger.debug(f"Current wiper states: {board.wiper_states}")
-        cv = np.round(board.get_bus(channel), 6)
-        limit = 2048
-        while limit > 0:
-            limit -= 1
-            time.sleep(0.06)  # Allow bus to reach proper voltage
-            cv = np.round(board.get_bus(channel), 6)
-            delta = np.round(abs(voltage - cv), 6)
-            logger.debug(f"wiper = {wiper}; cv = {cv}; delta= {delta} ")
-            if delta < 0.01:
+        if not board.is_chan_enabled(channel):
+            return False
+        prediction = self.curves.predict_wiper(board.address, channel, quantity, seek.target)
+        if prediction is None:
+            return False
+        wiper, seek.slope = prediction
+        logger.debug(f"Transfer curve predicts wiper {wiper} for {seek.target}")
+        if wiper == board.wiper_states[channel - 1]:
+            return False
+        board.set_wiper(channel, wiper)
+        return True
+
+    def _seek_measure(self, board: BiasCard, channel: int, seek: WiperSeek, quantity: str, navg: int):
+        """Measure the channel at its current wiper and feed the result to the seek."""
+        wiper = board.wiper_states[channel - 1]
+        vbus, vshunt, current = board.measure(channel, navg)
+        self._record(board, channel, vbus, current)
+        value = vbus if quantity == "vbus" else current
+        logger.debug(f"wiper = {wiper}; value = {value}; delta= {abs(seek.target - value)} ")
+        seek.observe(wiper, value)
+        if self.progress is not None:
+            self._report_progress(board, channel, seek, quantity, wiper, value)
+
+    def _report_progress(self, board: BiasCard, channel: int, seek: WiperSeek, quantity: str, wiper: int, value):
+        """
+        Pass a seek progress event to self.progress. Rate limited to one event per channel every
+        conf.progress.interval seconds; the first and last measurement of a seek are always reported.
+        """
+        now = self.clock()
+        key = (board.address, channel)
+        last = self._progress_last.get(key)
+        if not seek.done and seek.iterations > 1 and last is not None and now - last < conf.progress.interval:
+            return
+        self._progress_last[key] = now
+        try:
+            self.progress({
+                "card": board.address, "channel": channel, "quantity": quantity, "target": seek.target,
+                "iteration": seek.iterations, "wiper": wiper, "value": value, "delta": value - seek.target,
+                "done": seek.done,
+            })
+        except Exception as e:
+            logger.warning(f"Progress callback failed: {e}")
+
+    def _seek_finish(self, board: BiasCard, channel: int, seek: WiperSeek) -> tuple:
+        """Leave the wiper at the best code found. Returns (wiper, measured value, iterations)"""
+        if board.wiper_states[channel - 1] != seek.result:
+            board.set_wiper(channel, seek.result)
+        logger.debug(f"Seek finished after {seek.iterations} measurements at wiper {seek.result}")
+        return seek.result, seek.points[seek.result], seek.iterations
+
+    def _settle(self, board: BiasCard, channel: int, timeout: float) -> float:
+        """Adaptive settle of an open board's channel, bounded by `timeout` seconds (see BiasCard.settle)"""
+        return board.settle(channel, timeout, conf.settle.threshold, conf.settle.count, conf.settle.window)
+
+    @staticmethod
+    def _slowest(moves: dict):
+        """
+        The channel whose wiper moved the most. Every channel settles at the same time, so once the
+        biggest step has settled the others have too.
+
+        Parameters:
+            moves(dict): (card, channel) -> number of wiper codes moved
+
+        Returns:
+            (card, channel) or None if nothing moved
+        """
+        moves = {k: v for k, v in moves.items() if v}
+        if not moves:
+            return None
+        return max(moves, key=moves.get)
+
+    def run_steps(self, steps):
+        """
+        Drive a step generator (seek_steps, seek_many_steps) to completion, waiting for each requested settle
+        in place. Returns the generator's result.
+        """
+        with self.lock:
+            try:
+                request = next(steps)
+                while True:
+                    if request is not None:
+                        self.settle_output(*request)
+                    request = steps.send(None)
+            except StopIteration as done:
+                result = done.value
+        self.curves.flush()
+        return result
+
+    def seek_steps(
+        self, card: int, channel: int, quantity: str, target: float, tolerance: float = None, mode: str = "normal",
+        max_step: int = None, settle: float = None
+    ):
+        """
+        Generator doing the bus work of a seek. Whenever the wiper has moved it yields (card, channel, timeout);
+        the caller lets that output settle (at most `timeout` seconds) before resuming it. This lets a caller
+        (run_steps, scheduler.BusScheduler) decide what happens on the bus while the output settles. Step
+        generators may also yield None, a point where the caller can run other bus work without settling.
+
+        Parameters:
+            quantity(str): "vbus" or "current"
+            target(float): V for "vbus", mA for "current"
+            tolerance, mode, max_step: See seek_voltage
+            settle(float): Upper bound in seconds on the settle wait after each wiper change,
+                defaults to conf.settle.seekStep
+
+        Returns (as the generator's return value):
+            (wiper, measured value, iterations)
+        """
+        assert quantity in ("vbus", "current"), "Expected quantity 'vbus' or 'current'"
+        limit, unit = (5, "Voltage") if quantity == "vbus" else (200, "Current")
+        assert target >= 0, f"Can't generate negative {unit.lower()}s"
+        assert target <= limit, f"{unit} spec out of range"
+        assert channel > 0 and channel <= 8, "Expected Channel 1 through 8"
+        if card not in self.cards:
+            raise Exception(f"Card {card} not found in BiasCrate")
+        settle = conf.settle.seekStep if settle is None else settle
+        tolerance, navg = seek_settings(mode, tolerance)
+        logger.info(f"Seeking {quantity} {target} on card {card} channel {channel}.")
+        seek = WiperSeek(target, tolerance, max_step=max_step)
+        board = self.cards[card]
+
+        with self.board_open(board):
+            moved = self._seek_start(board, channel, seek, quantity)
+        if moved:
+            yield card, channel, settle
+        while True:
+            with self.board_open(board):
+                self._seek_measure(board, channel, seek, quantity, navg)
+                if not seek.done:
+                    board.set_wiper(channel, seek.next_wiper())
+            if seek.done:
                 break
+            yield card, channel, settle  # Allow bus to reach proper voltage
+        with self.board_open(board):
+            res = self._seek_finish(board, channel, seek)
+        return res
 
-            if (cv - voltage) > 0:
-                wiper -= increment
-                if wiper < 0:
-                    wiper = 0
-                board.set_wiper(channel, wiper)
-                continue
+    def seek_many(
+        self, targets: list, quantity: str, tolerance: float = None, mode: str = "normal", max_step: int = None,
+        settle: float = None
+    ) -> list:
+        """
+        Seek several card+channels at once. Seeks advance in rounds: every wiper is stepped, the crate settles
+        once, then every channel is measured. Cards are opened once per phase, so the settle time of one channel
+        overlaps with the I/O of all the others instead of being paid per channel.
+
+        Parameters:
+            targets(list): (card, channel, target) tuples, target in V for "vbus" or mA for "current"
+            quantity(str): "vbus" or "current"
+            tolerance, mode, max_step: Same as seek_voltage
+            settle(float): Upper bound on each round's settle wait, defaults to conf.settle.seekStep
+
+        Returns:
+            One dict per target, in order. Either {"card", "channel", "target", "wiper", "value", "iterations"}
+            or {"card", "channel", "target", "error"} for entries that could not be seeked.
+        """
+        return self.run_steps(self.seek_many_steps(targets, quantity, tolerance, mode, max_step, settle))
 
-            if (cv - voltage) < 0:
-                wiper += increment
-                board.set_wiper(channel, wiper)
-                continue
+    def seek_many_steps(
+        self, targets: list, quantity: str, tolerance: float = None, mode: str = "normal", max_step: int = None,
+        settle: float = None
+    ):
+        """
+        Generator form of seek_many, taking the same arguments and returning its result. After each phase that
+        moved wipers it yields one settle request, for the channel that moved the most in that phase, and it
+        yields None after every card. See seek_steps for how the requests are handled.
+        """
+        assert quantity in ("vbus", "current"), "Expected quantity 'vbus' or 'current'"
+        settle = conf.settle.seekStep if settle is None else settle
+        tolerance, navg = seek_settings(mode, tolerance)
+        results = []
+        seeks: dict[int, dict[int, WiperSeek]] = {}
+        for card, channel, target in targets:
+            entry = {"card": card, "channel": channel, "target": target}
+            results.append(entry)
+            limit = 5 if quantity == "vbus" else 200
+            if card not in self.cards:
+                entry["error"] = f"Card {card} not found in BiasCrate"
+            elif not (0 < channel <= 8):
+                entry["error"] = "Expected Channel 1 through 8"
+            elif not (0 <= target <= limit):
+                entry["error"] = f"Target {target} out of range 0 to {limit}"
+            elif channel in seeks.get(card, {}):
+                entry["error"] = "Duplicate card+channel in targets"
+            elif not self.cards[card].is_chan_enabled(channel):
+                entry["error"] = "Output is disabled, cannot seek."
+            else:
+                seeks.setdefault(card, {})[channel] = WiperSeek(target, tolerance, max_step=max_step)
+        logger.info(f"Seeking {quantity} on {sum(len(s) for s in seeks.values())} channels.")
+
+        moves = {}
+        for card in sorted(seeks):
+            board = self.cards[card]
+            with self.board_open(board):
+                for channel, seek in seeks[card].items():
+                    before = board.wiper_states[channel - 1]
+                    self._seek_start(board, channel, seek, quantity)
+                    moves[(card, channel)] = abs(board.wiper_states[channel - 1] - before)
+            yield None  # Let waiting bus work (e.g. safety commands) in between cards
+        if self._slowest(moves):
+            yield *self._slowest(moves), settle
+
+        rounds = 0
+        while True:
+            moves = {}  # Only this round's steps decide which channel to settle on
+            active = {c: {ch: s for ch, s in chans.items() if not s.done} for c, chans in seeks.items()}
+            active = {c: chans for c, chans in active.items() if chans}
+            if not active:
+                break
+            rounds += 1
+            for card in sorted(active):
+                board = self.cards[card]
+                with self.board_open(board):
+                    for channel, seek in active[card].items():
+                        self._seek_measure(board, channel, seek, quantity, navg)
+                        if not seek.done:
+                            before = board.wiper_states[channel - 1]
+                            board.set_wiper(channel, seek.next_wiper())
+                            moves[(card, channel)] = abs(board.wiper_states[channel - 1] - before)
+                yield None
+            if self._slowest(moves):
+                yield *self._slowest(moves), settle  # One settle for every channel that was stepped this round
+
+        final = {}
+        for card in sorted(seeks):
+            board = self.cards[card]
+            with self.board_open(board):
+                for channel, seek in seeks[card].items():
+                    before = board.wiper_states[channel - 1]
+                    final[(card, channel)] = self._seek_finish(board, channel, seek)
+                    moves[(card, channel)] = abs(board.wiper_states[channel - 1] - before)
+            yield None
+        if self._slowest(moves):
+            yield *self._slowest(moves), conf.settle.afterSeek
+        logger.debug(f"Batch seek finished after {rounds} rounds")
+
+        for entry in results:
+            if "error" not in entry:
+                entry["wiper"], entry["value"], entry["iterations"] = final[(entry["card"], entry["channel"])]
+        return results
+
+    def seek_voltage(
+        self, card: int, channel: int, voltage: float, tolerance: float = None, mode: str = "normal",
+        max_step: int = None
+    ) -> tuple:
+        """set channel to specified voltage (in Volts)
+
+        Parameters:
+            tolerance(float): Acceptable error in V, defaults to the tolerance of `mode`
+            mode(str): Precision mode, one of seek.SEEK_MODES
+            max_step(int): Optional limit on how far the wiper may move per iteration
+
+        Returns:
+            (wiper, measured voltage, iterations)
+        """
+        return self.run_steps(self.seek_steps(card, channel, "vbus", voltage, tolerance, mode, max_step))
+
+    def seek_current(
+        self, card: int, channel: int, current: float, tolerance: float = None, mode: str = "normal",
+        max_step: int = None
+    ) -> tuple:
+        """set channel to specified current (in mA Units)
+
+        Parameters:
+            tolerance(float): Acceptable error in mA, defaults to the tolerance of `mode`
+            mode(str): Precision mode, one of seek.SEEK_MODES
+            max_step(int): Optional limit on how far the wiper may move per iteration
+
+        Returns:
+            (wiper, measured current, iterations)
+        """
+        return self.run_steps(self.seek_steps(card, channel, "current", current, tolerance, mode, max_step))
 
     @grab_board
-    def seek_current(self, board: BiasCard, channel: int, current: float, increment=1):
-        """set channel to specified current (in mA Units)"""
-        assert current >= 0, "Can't generate negative voltages"
-        assert current <= 200, "Voltage spec out of range"
+    def settle_output(self, board: BiasCard, channel: int, timeout: float) -> float:
+        """Wait (at most `timeout` seconds) for a card+channel's output to stop changing. Returns the time waited."""
         assert channel > 0 and channel <= 8, "Expected Channel 1 through 8"
-        assert increment > 0, "Increment must be a positive integer"
-        logger.info(f"Seeking current {current} on channel {channel}. This may take a while...")
-        wiper = board.wiper_states[channel - 1]
-        logger.debug(f"Current wiper states: {board.wiper_states}")
-        ci = np.round(board.get_bus(channel), 6)
-        limit = 2048
-        while limit > 0:
-            limit -= 1
-            time.sleep(0.06)  # Allow bus to reach proper current
-            ci = np.round(board.get_current(channel), 6)
-            delta = np.round(abs(current - ci), 6)
-            logger.debug(f"wiper = {wiper}; ci = {ci}; delta= {delta} ")
-            if delta < 0.01:
-                break
+        return self._settle(board, channel, timeout)
 
-            if (ci - current) > 0:
-                wiper -= increment
-                if wiper < 0:
-                    wiper = 0
-                board.set_wiper(channel, wiper)
-                continue
+    @grab_board
+    def poll_output(self, board: BiasCard, channel: int) -> tuple:
+        """One CNVR poll of a card+channel (see BiasCard.poll_conversion). Returns (fresh, vbus)"""
+        return board.poll_conversion(channel)
 
-            if (ci - current) < 0:
-                wiper += increment
-                board.set_wiper(channel, wiper)
-                continue
+    def conversion_time(self, card: int, channel: int) -> float:
+        """Seconds per INA219 conversion with the channel's active ADC profile"""
+        return self.cards[card].adc_profiles[channel].conversion_time()
 
     @grab_board
     def disable_output(self, board: BiasCard, channel: int, zero_wiper: bool = False):
@@ -150,30 +484,235 @@ class BiasCrate:
         assert channel > 0 and channel <= 8, "Expected Channel 1 through 8"
         board.enable_testload(channel)
 
-    @grab_board
-    def get_status(self, board:BiasCard, channel: int) -> tuple:
-        """Get the status of a card+channel"""
-        assert channel > 0 and channel <= 8, "Expected Channel 1 through 8"
-        vbus = board.get_bus(channel)
-        time.sleep(0.01)  # Allow bus to settle
-        vshunt = board.get_shunt(channel)
-        time.sleep(0.01)  # Allow bus to settle
-        current = board.get_current(channel)
-        time.sleep(0.01)  # Allow bus to settle
+    def _sample(self, board: BiasCard, channel: int, navg: int = 6) -> tuple:
+        """Measure an open board's channel, feeding the transfer curves and the telemetry buffer."""
+        vbus, vshunt, current = board.measure(channel, navg)
         OutputEnabled = board.is_chan_enabled(channel)
+        testload = (board.test_enables & (1 << (channel - 1))) != 0
         wiper = board.wiper_states[channel - 1]
+        self._record(board, channel, vbus, current)
+        self.telemetry.append(board.address, channel, vbus, vshunt, current, OutputEnabled, testload, wiper)
         return vbus, vshunt, current, OutputEnabled, wiper
 
+    @grab_board
+    def _read_status(self, board: BiasCard, channel: int) -> tuple:
+        return self._sample(board, channel)
+
+    def cached_status(self, card: int, channel: int, max_age: float):
+        """The status of a card+channel from the telemetry buffer, without touching the bus
+
+        Parameters:
+            max_age(float): Oldest sample to accept, in seconds. The sample must also have been taken with the
+                current output/testload/wiper state
+
+        Returns:
+            (vbus, vshunt, current, OutputEnabled, wiper), or None if the buffer can't answer
+        """
+        if card not in self.cards:
+            return None
+        sample = self.telemetry.newest(card, channel)
+        board = self.cards[card]
+        if (
+            sample is not None
+            and time.time() - sample["time"] <= max_age
+            and sample["enabled"] == board.is_chan_enabled(channel)
+            and sample["testload"] == ((board.test_enables & (1 << (channel - 1))) != 0)
+            and sample["wiper"] == board.wiper_states[channel - 1]
+        ):
+            return (
+                float(sample["vbus"]), float(sample["vshunt"]), float(sample["current"]),
+                bool(sample["enabled"]), int(sample["wiper"])
+            )
+        return None
+
+    def get_status(self, card: int, channel: int, max_age: float = None) -> tuple:
+        """Get the status of a card+channel
+
+        Parameters:
+            max_age(float): If given, a telemetry sample at most this many seconds old, taken with the same
+                output/testload/wiper state, is returned instead of reading the hardware (see cached_status)
+
+        Returns:
+            (vbus, vshunt, current, OutputEnabled, wiper)
+        """
+        assert channel > 0 and channel <= 8, "Expected Channel 1 through 8"
+        if max_age is not None:
+            status = self.cached_status(card, channel, max_age)
+            if status is not None:
+                return status
+        status = self._read_status(card, channel)
+        self.curves.flush()
+        return status
+
+    def sweep_telemetry(self, navg: int = None):
+        """Measure every enabled channel of every present card into the telemetry buffer.
+        The bus lock is taken per card so commands can run in between. A pending emergency disable ends the sweep."""
+        navg = conf.telemetry.navg if navg is None else navg
+        for card in list(self.cards):
+            if self.preempt.is_set():
+                logger.debug("Telemetry sweep preempted by a safety command")
+                break
+            board = self.cards[card]
+            with self.lock:
+                try:
+                    board.open()
+                    for channel in range(1, 8 + 1):
+                        if board.is_chan_enabled(channel) and not self.preempt.is_set():
+                            self._sample(board, channel, navg)
+                except OSError as e:
+                    board.lost()
+                    logger.warning(f"Telemetry sweep of card {card} failed: {e}")
+                finally:
+                    try:
+                        board.close()
+                    except OSError:
+                        pass
+        self.curves.flush()
+        if self.sweep_done is not None:
+            self.sweep_done()
+
+    def start_telemetry(self, interval: float = None):
+        """Start the background telemetry sampler (interval defaults to conf.telemetry.interval)"""
+        if interval is not None:
+            self.sampler.interval = interval
+        self.sampler.start()
+
+    def stop_telemetry(self):
+        self.sampler.stop()
+
+    def get_crate_status(self, cards: list = None, channels: list = None, navg: int = 6) -> list:
+        """
+        Snapshot of many channels. Each card's repeater is opened once and all requested channels are measured
+        with BiasCard.measure_many.
+
+        Parameters:
+            cards(list): Cards to read, defaults to every card in the crate
+            channels(list): Channels to read on each card, defaults to 1 through 8
+
+        Returns:
+            One dict per card: {"card", "outputEnables", "testloadEnables" (bitmasks, bit 0 = channel 1),
+            "vbus", "vshunt", "current", "wiper" (lists in the order of `channels`)}
+
+        Raises:
+            Preempted if disableAllOutputs starts waiting for the bus before every card has been read
+        """
+        cards = list(self.cards) if cards is None else list(cards)
+        channels = list(range(1, 8 + 1)) if channels is None else list(channels)
+        for card in cards:
+            if card not in self.cards:
+                raise Exception(f"Card {card} not found in BiasCrate")
+        for channel in channels:
+            assert channel > 0 and channel <= 8, "Expected Channel 1 through 8"
+
+        snapshot = []
+        with self.lock:
+            for card in cards:
+                if self.preempt.is_set():
+                    raise Preempted(f"Crate status preempted by a safety command after {len(snapshot)} cards")
+                board = self.cards[card]
+                try:
+                    board.open()
+                    readings = board.measure_many(channels, navg)
+                except OSError:
+                    board.lost()
+                    raise
+                finally:
+                    board.close()
+                entry = {
+                    "card": card,
+                    "outputEnables": board.channel_enables,
+                    "testloadEnables": board.test_enables,
+                    "vbus": [],
+                    "vshunt": [],
+                    "current": [],
+                    "wiper": [],
+                }
+                for channel in channels:
+                    vbus, vshunt, current = readings[channel]
+                    wiper = board.wiper_states[channel - 1]
+                    self._record(board, channel, vbus, current)
+                    self.telemetry.append(
+                        card, channel, vbus, vshunt, current, board.is_chan_enabled(channel),
+                        (board.test_enables & (1 << (channel - 1))) != 0, wiper
+                    )
+                    entry["vbus"].append(vbus)
+                    entry["vshunt"].append(vshunt)
+                    entry["current"].append(current)
+                    entry["wiper"].append(wiper)
+                snapshot.append(entry)
+        self.curves.flush()
+        return snapshot
+
+    def get_transfer_curve(self, card: int, channel: int) -> dict:
+        """Learned transfer curve of a card+channel: {"vbus": {"wiper": [...], "value": [...]}, "current": {...}}"""
+        assert channel > 0 and channel <= 8, "Expected Channel 1 through 8"
+        if card not in self.cards:
+            raise Exception(f"Card {card} not found in BiasCrate")
+        return self.curves.as_dict(card, channel)
+
+    @grab_board
+    def set_adc_profile(self, board: BiasCard, channel: int, profile: str):
+        """Select a named INA219 ADC profile (from conf.adcProfiles) for a card+channel"""
+        assert channel > 0 and channel <= 8, "Expected Channel 1 through 8"
+        board.set_adc_profile(channel, adc_profile(profile))
+
+    @hold_bus
     def disable_all_outputs(self, zero_digital_pot: bool = False):
         """Disable all outputs in the bias crate"""
-        for c in self.cards:
-            self.cards[c].open()
-            self.cards[c].disable_all_chan()
-            if zero_digital_pot:
-                for i in range(1, 8 + 1):
-                    self.cards[c].set_wiper_min(i)
-            self.cards[c].close()
+        self.emergency_disable(zero_digital_pot)
 
+    @hold_bus
+    def emergency_disable(self, zero_digital_pot: bool = True) -> dict:
+        """
+        Fast path crate shutdown. First every card gets a single expander write that turns all of its outputs off,
+        bypassing the expander shadow. Only once the whole crate is safe are the wipers zeroed, again writing every
+        RDAC regardless of the shadow. A card that fails
+        doesn't stop the others from being shut down; the failures are raised at the end.
+
+        Returns:
+            {"safe": seconds until every output was off, "total": seconds including zeroing the wipers}
+        """
+        start = self.clock()
+        failed = []
+        for c, board in self.cards.items():
+            try:
+                board.open()
+                board.channel_enables = 0
+                board.expander_shadow = None
+                board._write_expander()
+                board.close()
+            except OSError as e:
+                board.lost()
+                failed.append(c)
+                logger.error(f"Emergency disable of card {c} failed: {e}")
+        safe = self.clock() - start
+        if zero_digital_pot:
+            for c, board in self.cards.items():
+                if c in failed:
+                    continue
+                try:
+                    board.open()
+                    # Write every RDAC like the expander above, a power event may have left the shadow stale
+                    board.rdac_shadow = {ch: [None] * 4 for ch in range(1, 8 + 1)}
+                    for i in range(1, 8 + 1):
+                        board.set_wiper_min(i)
+                    board.close()
+                except OSError as e:
+                    board.lost()
+                    failed.append(c)
+                    logger.error(f"Zeroing the wipers of card {c} failed: {e}")
+        total = self.clock() - start
+
+        m = self.metrics["emergencyDisable"]
+        m["count"] += 1
+        m["lastSafe"], m["lastTotal"] = safe, total
+        m["worstSafe"], m["worstTotal"] = max(m["worstSafe"], safe), max(m["worstTotal"], total)
+        logger.info(f"Emergency disable: all outputs off after {safe * 1000:.1f} ms, done after {total * 1000:.1f} ms")
+        if failed:
+            raise Exception(f"Emergency disable failed on cards {sorted(set(failed))}")
+        return {"safe": safe, "total": total}
+
+    @hold_bus
     def max_output(self):
         """Set Wipers to max output"""
         for c in self.cards:
@@ -182,6 +721,7 @@ class BiasCrate:
                 self.cards[c].set_wiper_max(i)
             self.cards[c].close()
 
+    @hold_bus
     def min_output(self):
         """Set Wipers to min output"""
         for c in self.cards:
@@ -190,6 +730,7 @@ class BiasCrate:
                 self.cards[c].set_wiper_min(i)
             self.cards[c].close()
 
+    @hold_bus
     def enable_all_outputs(self):
         """enable the outputs in the bias crate"""
         for c in self.cards:
@@ -197,6 +738,7 @@ class BiasCrate:
             self.cards[c].enable_all_chan()
             self.cards[c].close()
 
+    @hold_bus
     def enable_all_testloads(self):
         """enable the outputs in the bias crate"""
         for c in self.cards:
@@ -204,6 +746,7 @@ class BiasCrate:
             self.cards[c].enable_all_testloads()
             self.cards[c].close()
 
+    @hold_bus
     def disable_all_testloads(self):
         """enable the outputs in the bias crate"""
         for c in self.cards:
@@ -211,16 +754,20 @@ class BiasCrate:
             self.cards[c].disable_all_testloads()
             self.cards[c].close()
 
+    @hold_bus
     def get_avail_cards(self):
         """List connected cards"""
 
         # Check on all of the cards that could (or should) be present in the system.
+        # Disconnect the held card so that open() below actually talks to every repeater
+        BiasCard.release()
         for i in range(1, 18 + 1):
             # If the card isn't already known, try to create it and see if it exists.
             if i not in self.cards:
                 try:
                     card = BiasCard(i)
                     self.cards[i] = card
+                    self._apply_adc_profiles(card)
                     logger.warning(f"Card {i} was not previously known, but has been found in the system.")
                 except OSError:
                     logger.debug(f"Card {i} not found in system")
@@ -260,58 +807,135 @@ class BiasCrate:
                     chan = f"chan{j}"
                     conf.biasCards[card][chan] = {
                         "output": self.cards[i].is_chan_enabled(j),
-                        "wiper": self.cards[i].wiper_states[j - 1]
+                        "wiper": self.cards[i].wiper_states[j - 1],
+                        "adcProfile": self.cards[i].adc_profiles[j].name,
                     }
             OmegaConf.save(conf, config_path)
+            self.curves.flush(force=True)
 
 
         except Exception as e:
             logger.error(f"Error loading config: {e}")
             raise e
 
-    def load_config(self, enable_outputs: bool = True):
+    @hold_bus
+    def load_config(self, enable_outputs: bool = True, dry_run: bool = False) -> list:
         """Load config from yaml file, apply settings to the cards.
         There is a flag called enable_outputs that will enable the outputs
         of the channels if set to True in config. If set to False, the outputs will be disabled regardless
         of the configuration in the YAML file. 
         The wipers however, will always be set to the configured value in the YAML file.
 
+        Only settings that differ from the known hardware state are written (see plan_config). On each card,
+        outputs that get disabled are switched off before the wipers move and newly enabled outputs are switched
+        on after.
+
+        Parameters:
+            dry_run(bool): Only compute the changes, don't touch the hardware
+
+        Returns:
+            The per card changes, see plan_config
         """
         logger.info("Loading configuration from YAML file...")
         conf = OmegaConf.load(CONFIGPATH+"config.yaml")
 
         try:
-            # Iterate through all configured cards
-            # If the cards is present in the conf, but not the system, skip it
             # TODO: Need config validation. 
-        
-            for i in range(1, 18 + 1):
-                if i not in self.cards:
-                    logger.debug(f"Card {i} not found in system, skipping configuration.")
-                    continue
-                card = f"card{i}"
-                logger.debug(f"Open card {i} for configuration")
-
-                self.cards[i].open()
-                for j in range(1, 8 + 1):
-                    chan = f"chan{j}"
-
-                    chan_setting = conf.biasCards[card][chan]
-                    output = chan_setting.get("output", False)
-                    wiper = chan_setting.get("wiper", 0)
-                    if output and enable_outputs:
-                        logger.debug(f"Enabling output for card {i}, channel {j} with wiper {wiper}")
-                        self.cards[i].enable_chan(j)
-                    else:
-                        logger.debug(f"Disabling output for card {i}, channel {j}")
-                        self.cards[i].enable_chan(j, False)
-                    logger.debug(f"Setting wiper for card {i}, channel {j} to {wiper}")
-
-                    
-                    self.cards[i].set_wiper(j, wiper)
-                self.cards[i].close()
-
-                    
+            plan = self.plan_config(conf.biasCards, enable_outputs)
+            if dry_run:
+                return plan
+            for n, change in enumerate(plan):
+                i = change["card"]
+                if self.preempt.is_set() or any(c == i for c, _ in list(self.preempted_outputs)):
+                    raise Preempted(f"loadConfig preempted by a safety command after {n} of {len(plan)} cards")
+                board = self.cards[i]
+                logger.debug(f"Open card {i} for configuration, {change['transactions']} transactions planned")
+                try:
+                    board.open()
+                    if "outputEnables" in change:
+                        board.channel_enables &= change["outputEnables"]["to"]
+                        board._write_expander()
+                    for chan, wiper in change["wipers"].items():
+                        logger.debug(f"Setting wiper for card {i}, channel {chan} to {wiper['to']}")
+                        board.set_wiper(int(chan[len("chan"):]), wiper["to"])
+                    for chan, profile in change["adcProfiles"].items():
+                        board.set_adc_profile(int(chan[len("chan"):]), adc_profile(profile["to"]))
+                    if "outputEnables" in change:
+                        board.channel_enables = change["outputEnables"]["to"]
+                        board._write_expander()
+                except OSError:
+                    board.lost()
+                    try:
+                        board.close(force=True)
+                    except OSError:
+                        pass
+                    raise
+                board.close()
         except Exception as e:
             logger.error(f"Error loading config: {e}")
-            raise e
\ No newline at end of file
+            raise e
+        return plan
+
+    def plan_config(self, settings, enable_outputs: bool = True) -> list:
+        """
+        Difference between the per card settings (as in conf.biasCards) and the known state of the hardware.
+        Cards in the settings that aren't in the crate are skipped.
+
+        Raises:
+            ConfigError for a wiper that isn't an integer from 0 to 1023 or an unknown ADC profile, before
+            anything is written
+
+        Returns:
+            One dict per card that needs changes: {"card", "outputEnables": {"from", "to"} (bitmasks, only if they
+            change), "wipers": {"chanN": {"from", "to"}}, "adcProfiles": {"chanN": {"from", "to"}},
+            "transactions": I2C transactions needed to apply them, including repeater switching}
+        """
+        plan = []
+        selected = BiasCard.selected
+        for i in range(1, 18 + 1):
+            if i not in self.cards:
+                logger.debug(f"Card {i} not found in system, skipping configuration.")
+                continue
+            board = self.cards[i]
+            card = settings[f"card{i}"]
+            change = {"card": i, "wipers": {}, "adcProfiles": {}}
+            transactions = 0
+            mask = 0
+            for j in range(1, 8 + 1):
+                chan = f"chan{j}"
+                chan_setting = card[chan]
+                if chan_setting.get("output", False) and enable_outputs:
+                    mask |= 1 << (j - 1)
+                wiper = chan_setting.get("wiper", 0)
+                if isinstance(wiper, bool) or not isinstance(wiper, int) or not 0 <= wiper <= 1023:
+                    raise ConfigError(f"card{i}.{chan}.wiper must be an integer from 0 to 1023, got {wiper!r}")
+                shadow = board.rdac_shadow[j]
+                writes = sum(1 for have, want in zip(shadow, WIPER_RDAC_TABLE[wiper]) if have != want)
+                if writes or board.wiper_states[j - 1] != wiper:
+                    change["wipers"][chan] = {"from": board.wiper_states[j - 1], "to": wiper}
+                    transactions += writes
+                try:
+                    profile = adc_profile(chan_setting.get("adcProfile", "default"))
+                except ValueError as e:
+                    raise ConfigError(f"card{i}.{chan}.adcProfile: {e}") from e
+                if profile != board.adc_profiles[j]:
+                    change["adcProfiles"][chan] = {"from": board.adc_profiles[j].name, "to": profile.name}
+                    transactions += board.ina_shadow[j].get(INA219_REG_CONFIG) != profile.config_word()
+
+            # Expander states written on the way: outputs switched off first, then the final enables
+            ports = board.expander_shadow
+            for step in (board.channel_enables & mask, mask):
+                want = (~step & 0xFF, ~board.test_enables & 0xFF)
+                if want != ports:
+                    transactions += 1
+                    ports = want
+            if mask != board.channel_enables or board.expander_shadow != ports:
+                change["outputEnables"] = {"from": board.channel_enables, "to": mask}
+
+            if "outputEnables" in change or change["wipers"] or change["adcProfiles"]:
+                if selected != i:
+                    transactions += 1 if selected is None else 2
+                    selected = i
+                change["transactions"] = transactions
+                plan.append(change)
+        return plan
@@ -0,0 +1,107 @@
+"""
+@authors: Cody Roberson (carobers@asu.edu)
+@Documantation:
+    Live mirror of the crate state in redis, so read only clients (dashboards) don't need to send commands or use
+    the I2C bus to see it. For every channel of every present card the daemon keeps a hash
+
+        <keyPrefix>card<N>:chan<M>  outputEnabled, testloadEnabled, wiper, vbus, vshunt, current, measured, updated
+
+    and the hash <keyPrefix>crate holds the same state of every channel as json under "card<N>:chan<M>", plus
+    "cards" and "updated", so the whole crate is one HGETALL. vbus/vshunt/current are the newest measurement in
+    the telemetry buffer, `measured` its unix time; they are missing until a channel was measured.
+
+    Commands and telemetry sweeps mark the cards they touched. A background task writes the marked cards with one
+    pipelined round trip, at most once every conf.mirror.interval seconds.
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+import redis.exceptions
+
+from .midlevel import BiasCrate
+
+logger = logging.getLogger(__name__)
+
+
+class StateMirror:
+    """
+    Writes the known state of the crate to redis hashes.
+
+    Parameters:
+        crate(BiasCrate): Crate to mirror
+        r: redis.asyncio client
+        prefix(str): Prepended to every key, conf.redis.keyPrefix
+        interval(float): Shortest time in seconds between two writes
+    """
+
+    def __init__(self, crate: BiasCrate, r, prefix: str = "", interval: float = 0.1):
+        self.crate = crate
+        self.r = r
+        self.prefix = prefix
+        self.interval = interval
+        self.dirty = set()
+        self._wake = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        self.stats = {"writes": 0, "keys": 0}
+
+    def key(self, card: int, channel: int) -> str:
+        return f"{self.prefix}card{card}:chan{channel}"
+
+    def mark(self, cards=None):
+        """Schedule a write of `cards` (all cards if None). Must be called on the event loop."""
+        self.dirty.update(self.crate.cards if cards is None else (c for c in cards if c in self.crate.cards))
+        self._wake.set()
+
+    def mark_threadsafe(self, cards=None):
+        """mark() for other threads, e.g. the telemetry sampler"""
+        self._loop.call_soon_threadsafe(self.mark, cards)
+
+    def state(self, card: int, channel: int) -> dict:
+        """Mirrored fields of a card+channel"""
+        board = self.crate.cards[card]
+        bit = 1 << (channel - 1)
+        state = {
+            "outputEnabled": int(board.is_chan_enabled(channel)),
+            "testloadEnabled": int((board.test_enables & bit) != 0),
+            "wiper": int(board.wiper_states[channel - 1]),
+        }
+        sample = self.crate.telemetry.newest(card, channel)
+        if sample is not None:
+            state["vbus"] = float(sample["vbus"])
+            state["vshunt"] = float(sample["vshunt"])
+            state["current"] = float(sample["current"])
+            state["measured"] = float(sample["time"])
+        return state
+
+    async def flush(self):
+        """Write every marked card in one pipelined round trip"""
+        cards, self.dirty = sorted(self.dirty), set()
+        if not cards:
+            return
+        now = time.time()
+        crate = {"cards": json.dumps(list(self.crate.cards)), "updated": now}
+        pipe = self.r.pipeline(transaction=False)
+        for card in cards:
+            for channel in range(1, 8 + 1):
+                state = self.state(card, channel)
+                pipe.hset(self.key(card, channel), mapping={**state, "updated": now})
+                crate[f"card{card}:chan{channel}"] = json.dumps(state)
+        pipe.hset(f"{self.prefix}crate", mapping=crate)
+        await pipe.execute()
+        self.stats["writes"] += 1
+        self.stats["keys"] += 8 * len(cards) + 1
+
+    async def run(self):
+        """Write marked cards until cancelled"""
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            try:
+                await self.flush()
+            except redis.exceptions.RedisError as e:
+                logger.warning(f"Could not update the state mirror: {e}")
+                self.mark()  # Retry everything after the interval
+            await asyncio.sleep(self.interval)
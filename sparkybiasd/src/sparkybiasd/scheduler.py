@@ -0,0 +1,221 @@
+"""
+@authors: Cody Roberson (carobers@asu.edu)
+@Documantation:
+    Bus scheduler for the asyncio daemon. Commands are received and parsed concurrently, but every piece of
+    hardware work is handed to a single scheduler task as a job. Jobs run one at a time on a dedicated worker
+    thread, so I2C transactions are serialized while the event loop stays free to accept more commands.
+
+    Long operations are split into jobs. Seeks run as step generators (BiasCrate.seek_steps) and their settle
+    waits happen on the event loop between jobs, so the bus is free for other commands while an output settles.
+
+    Jobs are queued by priority. Safety commands (see daemon.SAFETY_COMMANDS) run their jobs at SAFETY priority,
+    so they start as soon as the job on the bus has finished. While they are pending they preempt the crate work
+    they conflict with: a job for one output (see `safety_scope`) adds it to BiasCrate.preempted_outputs so
+    loadConfig stops before that card, a job for the whole crate sets BiasCrate.preempt so every crate wide sweep
+    stops early.
+
+    Jobs of different commands interleave on the bus, so commands that drive the same output also hold that
+    output's lock in ChannelLocks while they run (see daemon.execute).
+"""
+
+import asyncio
+import contextlib
+import contextvars
+import functools
+import itertools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from .dconf import conf
+from .hardware import SettleCheck
+from .midlevel import BiasCrate
+
+logger = logging.getLogger(__name__)
+
+SAFETY = 0
+NORMAL = 1
+# Priority of the bus jobs queued by the current task
+priority = contextvars.ContextVar("priority", default=NORMAL)
+# (card, channel) the SAFETY jobs of the current task are for, None for the whole crate
+safety_scope = contextvars.ContextVar("safety_scope", default=None)
+
+
+class BusScheduler:
+    """
+    Serializes the hardware work of concurrently running commands.
+
+    Parameters:
+        crate(BiasCrate): Crate all jobs operate on
+    """
+
+    def __init__(self, crate: BiasCrate):
+        self.crate = crate
+        self.queue: asyncio.PriorityQueue = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="bus")
+        self._task = None
+        self._order = itertools.count()  # FIFO within a priority
+        self._safety_pending = {}  # safety_scope -> number of pending SAFETY jobs
+        self.locks = ChannelLocks()
+        self.stats = {"jobs": 0, "busyTime": 0.0, "safetyJobs": 0}
+
+    def start(self):
+        """Start the scheduler task on the running event loop"""
+        self.queue = asyncio.PriorityQueue()
+        self._task = asyncio.get_running_loop().create_task(self._run(), name="bus-scheduler")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.executor.shutdown(wait=True)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        Queue `func(*args, **kwargs)` as a bus job and wait for its result. The job's priority is taken from the
+        `priority` context variable. The job runs in a copy of the caller's context, so callbacks made from it
+        (e.g. BiasCrate.progress) can see the caller's context variables. Cancelling the caller while the job
+        is still queued drops the job.
+        """
+        future = asyncio.get_running_loop().create_future()
+        level = priority.get()
+        scope = safety_scope.get() if level == SAFETY else None
+        if level == SAFETY:
+            self._safety_pending[scope] = self._safety_pending.get(scope, 0) + 1
+            if scope is None:
+                self.crate.preempt.set()
+            else:
+                self.crate.preempted_outputs.add(scope)
+        job = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+        await self.queue.put((level, next(self._order), job, future, scope))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            level, _, job, future, scope = await self.queue.get()
+            if future.cancelled():
+                self._safety_done(level, scope)
+                continue
+            start = loop.time()
+            try:
+                result = await loop.run_in_executor(self.executor, job)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self.stats["jobs"] += 1
+                self.stats["busyTime"] += loop.time() - start
+                if level == SAFETY:
+                    self.stats["safetyJobs"] += 1
+                self._safety_done(level, scope)
+
+    def _safety_done(self, level: int, scope):
+        if level == SAFETY:
+            self._safety_pending[scope] -= 1
+            if self._safety_pending[scope] == 0:
+                del self._safety_pending[scope]
+                if scope is None:
+                    self.crate.preempt.clear()
+                else:
+                    self.crate.preempted_outputs.discard(scope)
+
+    async def drive(self, generator):
+        """
+        Async counterpart of BiasCrate.run_steps. Each step of the generator runs as one bus job and the
+        settle waits it requests are done cooperatively. Between two steps other jobs, safety jobs first, get
+        the bus, and cancelling the caller stops the generator there. Transfer curve points the steps recorded
+        are saved afterwards, off the bus thread.
+
+        Returns:
+            The generator's result
+        """
+        steps = _Steps(generator)
+        request = await self.run(_advance, steps)
+        while request is not _DONE:
+            if request is not None:
+                card, channel, timeout = request
+                await self.settle(card, channel, timeout)
+            request = await self.run(_advance, steps)
+        await asyncio.get_running_loop().run_in_executor(None, self.crate.curves.flush)
+        return steps.result
+
+    async def settle(self, card: int, channel: int, timeout: float) -> float:
+        """
+        Cooperative version of BiasCard.settle: wait for `conf.settle.count` successive fresh conversions within
+        `conf.settle.threshold` volts of the conversion `conf.settle.window` seconds before them, at most
+        `timeout` seconds. Only the CNVR polls use the bus.
+
+        Returns:
+            Seconds spent waiting
+        """
+        loop = asyncio.get_running_loop()
+        conv = self.crate.conversion_time(card, channel)
+        timeout = max(timeout, 3 * conv)
+        check = SettleCheck(conf.settle.threshold, conf.settle.count, conf.settle.window)
+        start = loop.time()
+        await self.run(self.crate.poll_output, card, channel)  # Clear a CNVR left over from before the change
+        while True:
+            remaining = timeout - (loop.time() - start)
+            if remaining <= 0:
+                break
+            await asyncio.sleep(min(max(conv, check.poll_interval(conv)), remaining))
+            fresh, vbus = await self.run(self.crate.poll_output, card, channel)
+            if fresh and check.update(loop.time(), vbus):
+                break
+        return loop.time() - start
+
+
+class ChannelLocks:
+    """
+    One lock per (card, channel). A command holds the locks of the outputs it drives while it runs, so the steps
+    of two commands never interleave on one output. Locks are taken in sorted order, so commands that need
+    several of them can't deadlock.
+    """
+
+    def __init__(self):
+        self._locks: dict[tuple, asyncio.Lock] = {}
+
+    def locked(self, card: int, channel: int) -> bool:
+        lock = self._locks.get((card, channel))
+        return lock is not None and lock.locked()
+
+    @contextlib.asynccontextmanager
+    async def hold(self, keys):
+        """Hold the locks of every (card, channel) in `keys` for the duration of an async with block"""
+        held = []
+        try:
+            for key in sorted(set(keys)):
+                lock = self._locks.setdefault(key, asyncio.Lock())
+                await lock.acquire()
+                held.append(lock)
+            yield
+        finally:
+            for lock in reversed(held):
+                lock.release()
+
+
+_DONE = object()
+
+
+class _Steps:
+    """Wraps a step generator so its return value survives being advanced on the worker thread."""
+
+    def __init__(self, generator):
+        self.generator = generator
+        self.result = None
+
+
+def _advance(steps):
+    """Run one step; returns the next settle request, None or _DONE (StopIteration can't cross into a Future)."""
+    try:
+        return next(steps.generator)
+    except StopIteration as done:
+        steps.result = done.value
+        return _DONE
@@ -0,0 +1,191 @@
+"""
+@authors: Cody Roberson (carobers@asu.edu)
+@Documantation:
+    Declarative argument schemas of the daemon commands (see daemon.COMMAND_TABLE). A command declares each of
+    its arguments with a spec:
+
+        {"type": "int" | "number" | "bool" | "string" | "list" | "dict" | "any",
+         "required": True (default) or False, "min": lowest value, "max": highest value,
+         "exclusiveMin": value has to be above this, "choices": [values], "items": spec of every list item or a
+         list of specs, one per position of a fixed length list, "minItems": shortest list, "code": error code,
+         "message": text of a range error}
+
+    compile_schema() turns the specs of a command into a validator once, at import. Validating a message is then
+    a single pass over precompiled checks. Values are coerced to the declared type where nothing is lost
+    ("3" -> 3, 2.0 -> 2 for an int, 2 -> 2.0 for a number, "true" -> True). A null optional argument is dropped,
+    so handlers see it as left out, and arguments that aren't declared are passed through untouched. The specs are
+    plain data, so they can be sent to clients as they are (getSchema).
+"""
+
+import math
+
+TYPE_ERROR = -13  # Default code of an argument that fails its spec #TODO: Define error codes
+MISSING = -7
+
+TYPE_NAMES = {
+    "int": "an integer",
+    "number": "a number",
+    "bool": "a boolean",
+    "string": "a string",
+    "list": "a list",
+    "dict": "a dictionary",
+    "any": "anything",
+}
+
+
+class SchemaError(ValueError):
+    """An argument that doesn't match its spec. `code` is the error code of the reply."""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(message)
+        self.code = code
+
+
+def _int(value):
+    if isinstance(value, bool):
+        raise TypeError
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        return int(value.strip())
+    raise TypeError
+
+
+def _number(value):
+    if isinstance(value, bool):
+        raise TypeError
+    if isinstance(value, (int, float)):
+        value = float(value)
+    elif isinstance(value, str):
+        value = float(value.strip())
+    else:
+        raise TypeError
+    if not math.isfinite(value):
+        raise ValueError
+    return value
+
+
+def _bool(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    raise TypeError
+
+
+def _instance(kind):
+    def coerce(value):
+        if not isinstance(value, kind):
+            raise TypeError
+        return value
+
+    return coerce
+
+
+COERCE = {
+    "int": _int,
+    "number": _number,
+    "bool": _bool,
+    "string": _instance(str),
+    "list": _instance(list),
+    "dict": _instance(dict),
+    "any": lambda value: value,
+}
+
+
+# Values of exactly these classes need no coercion
+EXACT = {"int": int, "number": float, "bool": bool, "string": str, "list": list, "dict": dict}
+
+
+def compile_spec(name: str, spec: dict):
+    """
+    Compile the spec of one argument.
+
+    Returns:
+        A function taking the argument's value and returning it coerced to the declared type, raising SchemaError
+    """
+    if spec["type"] not in COERCE:
+        raise ValueError(f"Unknown type '{spec['type']}' of argument '{name}'")
+    coerce = COERCE[spec["type"]]
+    code = spec.get("code", TYPE_ERROR)
+    lo, hi, choices = spec.get("min"), spec.get("max"), spec.get("choices")
+    above = spec.get("exclusiveMin")
+    items = spec.get("items")
+    if isinstance(items, list):
+        positions = [compile_spec(f"{name}[{i}]", s) for i, s in enumerate(items)]
+        items = None
+    elif items is not None:
+        positions = None
+        items = compile_spec(f"{name}[]", items)
+    else:
+        positions = None
+    min_items = spec.get("minItems")
+    type_error = f"'{name}' must be {TYPE_NAMES[spec['type']]}"
+    if lo is not None and hi is not None:
+        range_error = spec.get("message", f"'{name}' must be between {lo} and {hi}")
+    elif lo is not None:
+        range_error = spec.get("message", f"'{name}' must be at least {lo}")
+    elif hi is not None:
+        range_error = spec.get("message", f"'{name}' must be at most {hi}")
+    else:
+        range_error = spec.get("message", f"'{name}' must be greater than {above}")
+    choice_error = f"'{name}' must be one of {choices}"
+
+    exact = EXACT.get(spec["type"])
+    finite = spec["type"] == "number"
+    limited = lo is not None or hi is not None or above is not None
+
+    def check(value):
+        if value.__class__ is not exact or (finite and value - value != 0.0):  # _number rejects NaN / infinity
+            try:
+                value = coerce(value)
+            except (TypeError, ValueError):
+                raise SchemaError(code, f"{type_error}, got {value!r}") from None
+        if limited and ((lo is not None and value < lo) or (hi is not None and value > hi)
+                        or (above is not None and value <= above)):
+            raise SchemaError(code, range_error)
+        if choices is not None and value not in choices:
+            raise SchemaError(code, choice_error)
+        if min_items is not None and len(value) < min_items:
+            raise SchemaError(code, f"'{name}' must have at least {min_items} items")
+        if items is not None:
+            value = [items(item) for item in value]
+        elif positions is not None:
+            if len(value) != len(positions):
+                raise SchemaError(code, f"'{name}' must have {len(positions)} items, got {value!r}")
+            value = [check(item) for check, item in zip(positions, value)]
+        return value
+
+    return check
+
+
+def compile_schema(command: str, specs: dict):
+    """
+    Compile the argument specs of a command.
+
+    Returns:
+        A function taking the args dict of a message and returning a copy with the declared arguments coerced
+        and null optional ones dropped, raising SchemaError for the first argument that is missing or doesn't
+        match its spec
+    """
+    checks = {name: compile_spec(name, spec) for name, spec in specs.items()}
+    required = tuple(name for name, spec in specs.items() if spec.get("required", True))
+
+    def validate(args: dict) -> dict:
+        for name in required:
+            if name not in args:
+                raise SchemaError(MISSING, f"Missing argument '{name}' for command '{command}'")
+        valid = dict(args)
+        for name, value in args.items():
+            check = checks.get(name)
+            if check is None:
+                continue
+            if value is None and name not in required:
+                del valid[name]
+            else:
+                valid[name] = check(value)
+        return valid
+
+    return validate
@@ -0,0 +1,138 @@
+"""
+@authors: Cody Roberson (carobers@asu.edu)
+@Documantation:
+    Convergent wiper seek. The output of a bias channel (voltage or current) is a monotonic, increasing function
+    of the AD5144 wiper code, so a setpoint can be found with a bracketed secant search (regula falsi) that falls back
+    to bisection whenever interpolation stops shrinking the bracket. A full range seek takes ~10 measurements instead
+    of one per wiper code.
+
+    WiperSeek does no I/O; the caller sets the wiper it proposes, waits, measures and feeds the result back.
+    This keeps the algorithm usable from the blocking BiasCrate seeks as well as anything that wants to interleave
+    several seeks.
+"""
+
+WIPER_MIN = 0
+WIPER_MAX = 1023
+
+# Named precision modes for seeks. tolerance is in the unit being sought (V or mA),
+# navg is the number of INA219 samples averaged per measurement.
+SEEK_MODES = {
+    "fast": {"tolerance": 0.05, "navg": 2},
+    "normal": {"tolerance": 0.01, "navg": 6},
+    "precise": {"tolerance": 0.002, "navg": 16},
+}
+
+
+def seek_settings(mode: str = "normal", tolerance: float = None) -> tuple:
+    """Resolve a precision mode and an optional tolerance override.
+
+    Returns:
+        (tolerance, navg)
+    """
+    if mode not in SEEK_MODES:
+        raise ValueError(f"Unknown seek mode '{mode}', expected one of {list(SEEK_MODES)}")
+    settings = SEEK_MODES[mode]
+    if tolerance is None:
+        tolerance = settings["tolerance"]
+    if tolerance <= 0:
+        raise ValueError("Tolerance must be positive")
+    return tolerance, settings["navg"]
+
+
+class WiperSeek:
+    """
+    State of a single seek.
+
+    Parameters:
+        target(float): Value being sought
+        tolerance(float): Seek is done once |measured - target| <= tolerance
+        max_iterations(int): Upper bound on the number of measurements
+        max_step(int): Optional limit on how far the wiper may move in one step
+        slope(float): Optional expected output change per wiper code (e.g. from a learned transfer curve),
+            used to fine tune from the first measurement instead of bisecting the whole range
+    """
+
+    def __init__(
+        self, target: float, tolerance: float = 0.01, max_iterations: int = 64, max_step: int = None,
+        slope: float = None
+    ):
+        self.target = target
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        assert max_step is None or max_step > 0, "max_step must be a positive integer"
+        self.max_step = max_step
+        self.slope = slope
+        self.points: dict[int, float] = {}
+        self.history: list[int] = []
+        self.widths: list[int] = []
+        self.lo = WIPER_MIN
+        self.hi = WIPER_MAX
+        self.iterations = 0
+        self.done = False
+        self.result = None
+
+    @property
+    def best(self) -> int:
+        """Measured wiper code closest to the target so far"""
+        return min(self.points, key=lambda w: abs(self.points[w] - self.target))
+
+    def observe(self, wiper: int, value: float):
+        """Record a measurement taken with the wiper at `wiper`."""
+        self.points[wiper] = value
+        self.history.append(wiper)
+        self.iterations += 1
+
+        if abs(value - self.target) <= self.tolerance:
+            self._finish(wiper)
+            return
+        if value < self.target:
+            self.lo = max(self.lo, wiper)
+        else:
+            self.hi = min(self.hi, wiper)
+        self.widths.append(self.hi - self.lo)
+
+        if self.lo >= self.hi:
+            # Noise put the point on the wrong side of an existing one; the bracket is as small as it gets.
+            self._finish(self.best)
+        elif self.hi - self.lo <= 1 and self.lo in self.points and self.hi in self.points:
+            self._finish(self.best)
+        elif self.iterations >= self.max_iterations:
+            self._finish(self.best)
+
+    def _finish(self, wiper: int):
+        self.done = True
+        self.result = wiper
+
+    def _interpolate(self):
+        flo, fhi = self.points.get(self.lo), self.points.get(self.hi)
+        if flo is not None and fhi is not None and fhi != flo:
+            return self.lo + (self.target - flo) * (self.hi - self.lo) / (fhi - flo)
+        if len(self.history) >= 2:
+            w1, w2 = self.history[-2], self.history[-1]
+            f1, f2 = self.points[w1], self.points[w2]
+            if f1 != f2 and w1 != w2:
+                return w2 + (self.target - f2) * (w2 - w1) / (f2 - f1)
+        if self.slope and self.history:
+            w = self.history[-1]
+            return w + (self.target - self.points[w]) / self.slope
+        if flo is not None and flo > 0 and self.lo > 0:
+            # Single point below the target, assume the output is proportional to the wiper
+            return self.lo * self.target / flo
+        return None
+
+    def next_wiper(self) -> int:
+        """Wiper code to try next"""
+        if self.hi - self.lo <= 1:
+            # Bracket collapsed, measure whichever end is still unknown
+            return self.lo if self.lo not in self.points else self.hi
+
+        guess = self._interpolate()
+        slow = len(self.widths) >= 3 and self.widths[-1] > self.widths[-3] // 2
+        if guess is None or slow or not (self.lo < guess < self.hi):
+            guess = (self.lo + self.hi) / 2
+        wiper = min(max(int(round(guess)), self.lo + 1), self.hi - 1)
+
+        if self.max_step is not None and self.history:
+            last = self.history[-1]
+            wiper = min(max(wiper, last - self.max_step), last + self.max_step)
+        return wiper
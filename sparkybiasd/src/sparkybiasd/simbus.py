@@ -0,0 +1,452 @@
+"""
+@authors: Cody Roberson (carobers@asu.edu)
+@Documantation:
+    In-process simulation of a bias crate's I2C bus. SimulatedBus implements the subset of the smbus2.SMBus API
+    used by hardware.py, so BiasCard and BiasCrate can run (and be benchmarked) on any Linux box.
+
+    What is modeled:
+        - LTC4302 repeaters at 0x60 + card address. Card side devices only respond while the card's repeater is
+          connected. If more than one repeater is connected, writes reach every connected card and reads are the
+          wired-AND of every responder (this is counted as a collision).
+        - The 16 bit port expander at 0x27 (port 0 = output enables, port 1 = testloads, both active low).
+        - AD5144 quad digital pots; a channel's wiper code is the sum of its four RDAC registers (0 to 1020).
+        - INA219 current monitors with config, calibration, CNVR/OVF flags, conversion timing and hardware averaging
+          taken from the config register.
+        - A per channel regulator whose output follows a monotonic wiper code -> voltage transfer curve with
+          first order settling, a 51 ohm test load and an optional user load.
+
+    Every transaction costs `overhead + nbytes * 9 / bitrate` seconds. With realtime=True the bus actually sleeps for
+    that long, otherwise the time is added to a virtual clock so that tests run fast but the chips still see time pass.
+"""
+
+import errno
+import math
+import random
+import time
+
+REPEATER_BASE_ADDRESS = 0x60
+EXPANDER_ADDRESS = 0x27
+INA219_ADDRESSES = (0x40, 0x41, 0x42, 0x43, 0x44, 0x45, 0x46, 0x47)
+AD5144_ADDRESSES = (0x20, 0x28, 0x2C, 0x22, 0x2A, 0x2E, 0x23, 0x2F)
+
+INA219_POR_CONFIG = 0x399F
+INA219_PGA_MV = (40.0, 80.0, 160.0, 320.0)
+I2C_M_RD = 0x0001
+
+TESTLOAD_OHMS = 51.0
+RDAC_FULL_SCALE = 4 * 255
+
+
+def ina219_adc_setting(bits: int) -> tuple:
+    """Decode a 4 bit INA219 BADC/SADC field.
+
+    Returns:
+        (conversion time in seconds, number of samples averaged)
+    """
+    if bits & 0b1000:
+        samples = 1 << (bits & 0b0111)
+        return 532e-6 * samples, samples
+    return (84e-6, 148e-6, 276e-6, 532e-6)[bits & 0b0011], 1
+
+
+def _remote_io_error(address: int) -> OSError:
+    return OSError(errno.EREMOTEIO, f"Remote I/O error (no ACK from 0x{address:02X})")
+
+
+class SimulatedChannel:
+    """One bias channel: regulator, AD5144 and INA219."""
+
+    def __init__(self, bus, rng: random.Random) -> None:
+        self.bus = bus
+        self.rng = rng
+        self.v_offset = rng.uniform(0.0, 0.02)
+        self.v_span = rng.uniform(4.4, 4.9)
+        self.gamma = rng.uniform(1.0, 1.15)
+        self.tau = bus.settle_tau
+        self.shunt_ohms = 1.0
+        self.load_ohms = None
+        self.enabled = False
+        self.testload = False
+        self.power_on()
+
+    def power_on(self):
+        """Reset the chips on this channel to their power on state."""
+        self.rdac = [self.bus.rdac_por] * 4
+        self.readback = 0
+        self.ina_config = INA219_POR_CONFIG
+        self.ina_calibration = 0
+        self.ina_pointer = 0
+        self.conv_start = self.bus.now()
+        self.conv_index = -1
+        self.sample = (0.0, 0.0)
+        self.cnvr_cleared = -1
+        now = self.bus.now()
+        v = self.transfer(self.code)
+        self.history = [(now, v, v)]
+
+    @property
+    def code(self) -> int:
+        return sum(self.rdac)
+
+    def transfer(self, code: int) -> float:
+        """Steady state regulator output (V) for a wiper code."""
+        x = min(max(code, 0), RDAC_FULL_SCALE) / RDAC_FULL_SCALE
+        return self.v_offset + self.v_span * x**self.gamma
+
+    def regulator_voltage(self, t: float) -> float:
+        for t0, v_from, v_to in reversed(self.history):
+            if t0 <= t:
+                return v_to + (v_from - v_to) * math.exp(-(t - t0) / self.tau)
+        return self.history[0][1]
+
+    def write_rdac(self, index: int, value: int):
+        now = self.bus.now()
+        v_now = self.regulator_voltage(now)
+        self.rdac[index] = value & 0xFF
+        self.history.append((now, v_now, self.transfer(self.code)))
+        del self.history[:-8]
+
+    def load_ohms_effective(self):
+        loads = []
+        if self.testload:
+            loads.append(TESTLOAD_OHMS)
+        if self.load_ohms:
+            loads.append(self.load_ohms)
+        if not loads:
+            return None
+        return 1.0 / sum(1.0 / r for r in loads)
+
+    def output(self, t: float) -> tuple:
+        """(bus voltage V, current A) seen by the INA219 at time t."""
+        if not self.enabled:
+            return 0.0, 0.0
+        v = self.regulator_voltage(t)
+        r = self.load_ohms_effective()
+        if r is None:
+            return v, 0.0
+        return v, v / (r + self.shunt_ohms)
+
+    # INA219
+    def _timing(self) -> tuple:
+        badc = (self.ina_config >> 7) & 0xF
+        sadc = (self.ina_config >> 3) & 0xF
+        t_bus, n_bus = ina219_adc_setting(badc)
+        t_shunt, n_shunt = ina219_adc_setting(sadc)
+        return t_bus + t_shunt, n_bus, n_shunt
+
+    def _update_conversion(self):
+        mode = self.ina_config & 0b111
+        t_conv, n_bus, n_shunt = self._timing()
+        if mode in (0, 4):
+            return
+        done = int((self.bus.now() - self.conv_start) // t_conv)
+        if mode < 4:
+            done = min(done, 1)
+        index = done - 1
+        if index < 0 or index == self.conv_index:
+            return
+        t_sample = self.conv_start + done * t_conv
+        v, i = self.output(t_sample)
+        v += self.rng.gauss(0.0, self.bus.noise_bus_v / math.sqrt(n_bus))
+        vshunt = i * self.shunt_ohms + self.rng.gauss(0.0, self.bus.noise_shunt_v / math.sqrt(n_shunt))
+        self.conv_index = index
+        self.sample = (v, vshunt)
+
+    def ina_read(self, register: int) -> int:
+        """Returns the 16 bit value of an INA219 register (MSB first semantics)."""
+        self._update_conversion()
+        v, vshunt = self.sample
+        pga_mv = INA219_PGA_MV[(self.ina_config >> 11) & 0b11]
+        brng_v = 32.0 if self.ina_config & 0x2000 else 16.0
+        shunt_limit = int(pga_mv * 100)
+        shunt_raw = max(-shunt_limit, min(shunt_limit, round(vshunt / 10e-6)))
+        bus_raw = max(0, min(int(brng_v / 0.004), round(v / 0.004)))
+        current_raw = int(shunt_raw * self.ina_calibration / 4096)
+        overflow = abs(current_raw) > 0x7FFF or abs(round(vshunt / 10e-6)) > shunt_limit
+        current_raw = max(-0x8000, min(0x7FFF, current_raw))
+        if register == 0x00:
+            return self.ina_config
+        if register == 0x01:
+            return shunt_raw & 0xFFFF
+        if register == 0x02:
+            cnvr = 1 if self.conv_index > self.cnvr_cleared else 0
+            return (bus_raw << 3) | (cnvr << 1) | (1 if overflow else 0)
+        if register == 0x03:
+            self.cnvr_cleared = self.conv_index
+            return min(0xFFFF, abs(current_raw) * bus_raw // 5000)
+        if register == 0x04:
+            return current_raw & 0xFFFF
+        if register == 0x05:
+            return self.ina_calibration
+        raise _remote_io_error(INA219_ADDRESSES[0])
+
+    def ina_write(self, register: int, value: int):
+        value &= 0xFFFF
+        if register == 0x00:
+            if value & 0x8000:
+                self.ina_config = INA219_POR_CONFIG
+                self.ina_calibration = 0
+            else:
+                self.ina_config = value
+            self.conv_start = self.bus.now()
+            self.conv_index = -1
+            self.cnvr_cleared = -1
+        elif register == 0x05:
+            self.ina_calibration = value & 0xFFFE
+        else:
+            # Shunt, bus, power and current registers are read only
+            pass
+
+
+class SimulatedCard:
+    """One bias card: LTC4302 repeater, port expander and 8 channels."""
+
+    def __init__(self, bus, address: int, rng: random.Random) -> None:
+        self.bus = bus
+        self.address = address
+        self.channels = {ch: SimulatedChannel(bus, rng) for ch in range(1, 8 + 1)}
+        self.power_on()
+
+    def power_on(self):
+        """Reset the card to its power on state: repeater disconnected, outputs and testloads off."""
+        self.connected = False
+        self.gpio = 0
+        self.ports = [0xFF, 0xFF]
+        for ch in self.channels.values():
+            ch.power_on()
+        self._apply_ports()
+
+    def _apply_ports(self):
+        for ch, c in self.channels.items():
+            c.enabled = not (self.ports[0] >> (ch - 1)) & 1
+            c.testload = not (self.ports[1] >> (ch - 1)) & 1
+
+    def responds_to(self, address: int) -> bool:
+        return address == EXPANDER_ADDRESS or address in INA219_ADDRESSES or address in AD5144_ADDRESSES
+
+    def write(self, address: int, data: list):
+        """Handle a write of raw bytes to a card side device."""
+        if address == EXPANDER_ADDRESS:
+            for i, b in enumerate(data[:2]):
+                self.ports[i] = b & 0xFF
+            self._apply_ports()
+        elif address in AD5144_ADDRESSES:
+            ch = self.channels[AD5144_ADDRESSES.index(address) + 1]
+            if len(data) < 2:
+                return
+            command, value = data[0] >> 4, data[1]
+            if command == 0b0001:
+                ch.write_rdac(data[0] & 0b11, value)
+            elif command == 0b0011:
+                ch.readback = ch.rdac[data[0] & 0b11] if (value & 0b11) in (0b01, 0b11) else 0
+        elif address in INA219_ADDRESSES:
+            ch = self.channels[INA219_ADDRESSES.index(address) + 1]
+            if data:
+                ch.ina_pointer = data[0]
+            if len(data) >= 3:
+                ch.ina_write(data[0], (data[1] << 8) | data[2])
+
+    def read(self, address: int, length: int) -> list:
+        """Handle a read of raw bytes from a card side device."""
+        if address == EXPANDER_ADDRESS:
+            return [self.ports[i % 2] for i in range(length)]
+        if address in AD5144_ADDRESSES:
+            ch = self.channels[AD5144_ADDRESSES.index(address) + 1]
+            return [ch.readback] * length
+        ch = self.channels[INA219_ADDRESSES.index(address) + 1]
+        value = ch.ina_read(ch.ina_pointer)
+        out = []
+        for i in range(length):
+            out.append((value >> 8) & 0xFF if i % 2 == 0 else value & 0xFF)
+        return out
+
+
+class SimulatedBus:
+    """
+    Drop in replacement for smbus2.SMBus that talks to a simulated bias crate.
+
+    Parameters:
+        cards(list): Card addresses (1-18) that are present in the crate
+        bitrate(int): I2C clock in Hz, used for the per byte transaction time
+        overhead(float): Fixed cost in seconds of every transaction (ioctl, start/stop)
+        realtime(bool): Actually sleep for the transaction time instead of advancing a virtual clock
+        seed(int): Seed for the channel models and measurement noise
+        settle_tau(float): Regulator settling time constant in seconds
+        noise_bus_v(float): RMS noise of a single bus voltage conversion in volts
+        noise_shunt_v(float): RMS noise of a single shunt voltage conversion in volts
+        rdac_por(int): Power on value of every AD5144 RDAC register
+    """
+
+    def __init__(
+        self,
+        cards=range(1, 18 + 1),
+        bitrate: int = 100_000,
+        overhead: float = 50e-6,
+        realtime: bool = True,
+        seed: int = 0,
+        settle_tau: float = 0.005,
+        noise_bus_v: float = 0.002,
+        noise_shunt_v: float = 20e-6,
+        rdac_por: int = 0,
+    ) -> None:
+        self.bitrate = bitrate
+        self.overhead = overhead
+        self.realtime = realtime
+        self.settle_tau = settle_tau
+        self.noise_bus_v = noise_bus_v
+        self.noise_shunt_v = noise_shunt_v
+        self.rdac_por = rdac_por
+        self._virtual = 0.0
+        rng = random.Random(seed)
+        self.backplane_gpio = 0
+        self.backplane_connected = False
+        self.cards = {a: SimulatedCard(self, a, rng) for a in cards}
+        self.reset_stats()
+
+    # Simulation helpers
+    def now(self) -> float:
+        return time.monotonic() + self._virtual
+
+    def advance(self, seconds: float):
+        """Move the virtual clock forward, e.g. to let outputs settle without sleeping."""
+        self._virtual += seconds
+
+    def reset_stats(self):
+        """Zero the transaction counters."""
+        self.stats = {
+            "transactions": 0,
+            "bytes": 0,
+            "busTime": 0.0,
+            "collisions": 0,
+            "ops": {},
+        }
+
+    def channel(self, card: int, channel: int) -> SimulatedChannel:
+        return self.cards[card].channels[channel]
+
+    def power_cycle(self, card: int):
+        """Simulate a card losing and regaining power."""
+        self.cards[card].power_on()
+
+    def connected_cards(self) -> list:
+        return [c for c in self.cards.values() if c.connected]
+
+    def _transaction(self, op: str, nbytes: int):
+        cost = self.overhead + nbytes * 9 / self.bitrate
+        self.stats["transactions"] += 1
+        self.stats["bytes"] += nbytes
+        self.stats["busTime"] += cost
+        self.stats["ops"][op] = self.stats["ops"].get(op, 0) + 1
+        if self.realtime:
+            time.sleep(cost)
+        else:
+            self._virtual += cost
+
+    def _targets(self, address: int) -> list:
+        targets = [c for c in self.connected_cards() if c.responds_to(address)]
+        if not targets:
+            raise _remote_io_error(address)
+        if len(targets) > 1:
+            self.stats["collisions"] += 1
+        return targets
+
+    def _write(self, address: int, data: list):
+        if REPEATER_BASE_ADDRESS <= address <= REPEATER_BASE_ADDRESS + 18:
+            card = address - REPEATER_BASE_ADDRESS
+            cmd = data[0] if data else 0
+            if card == 0:
+                self.backplane_connected = bool(cmd & 0x80)
+                self.backplane_gpio = cmd & 0x60
+                return
+            if card not in self.cards:
+                raise _remote_io_error(address)
+            self.cards[card].connected = bool(cmd & 0x80)
+            self.cards[card].gpio = cmd & 0x60
+            return
+        for c in self._targets(address):
+            c.write(address, list(data))
+
+    def _read(self, address: int, length: int) -> list:
+        if REPEATER_BASE_ADDRESS <= address <= REPEATER_BASE_ADDRESS + 18:
+            card = address - REPEATER_BASE_ADDRESS
+            if card == 0:
+                return [0x80 * self.backplane_connected | self.backplane_gpio] * length
+            if card not in self.cards:
+                raise _remote_io_error(address)
+            c = self.cards[card]
+            return [0x80 * c.connected | c.gpio] * length
+        out = [0xFF] * length
+        for c in self._targets(address):
+            out = [a & b for a, b in zip(out, c.read(address, length))]
+        return out
+
+    # smbus2.SMBus API
+    def open(self, bus=None):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write_quick(self, i2c_addr, force=None):
+        self._transaction("write_quick", 1)
+        self._write(i2c_addr, [])
+
+    def write_byte(self, i2c_addr, value, force=None):
+        self._transaction("write_byte", 2)
+        self._write(i2c_addr, [value & 0xFF])
+
+    def read_byte(self, i2c_addr, force=None):
+        self._transaction("read_byte", 2)
+        return self._read(i2c_addr, 1)[0]
+
+    def write_byte_data(self, i2c_addr, register, value, force=None):
+        self._transaction("write_byte_data", 3)
+        self._write(i2c_addr, [register & 0xFF, value & 0xFF])
+
+    def read_byte_data(self, i2c_addr, register, force=None):
+        self._transaction("read_byte_data", 4)
+        self._write(i2c_addr, [register & 0xFF])
+        return self._read(i2c_addr, 1)[0]
+
+    def write_word_data(self, i2c_addr, register, value, force=None):
+        # SMBus words go out LSB first
+        self._transaction("write_word_data", 4)
+        self._write(i2c_addr, [register & 0xFF, value & 0xFF, (value >> 8) & 0xFF])
+
+    def read_word_data(self, i2c_addr, register, force=None):
+        self._transaction("read_word_data", 5)
+        self._write(i2c_addr, [register & 0xFF])
+        lo, hi = self._read(i2c_addr, 2)
+        return lo | (hi << 8)
+
+    def write_i2c_block_data(self, i2c_addr, register, data, force=None):
+        self._transaction("write_i2c_block_data", 2 + len(data))
+        self._write(i2c_addr, [register & 0xFF] + [d & 0xFF for d in data])
+
+    def read_i2c_block_data(self, i2c_addr, register, length, force=None):
+        self._transaction("read_i2c_block_data", 3 + length)
+        if i2c_addr != EXPANDER_ADDRESS:
+            self._write(i2c_addr, [register & 0xFF])
+        return self._read(i2c_addr, length)
+
+    def i2c_rdwr(self, *i2c_msgs):
+        """Combined transaction, messages are separated by repeated starts. Like the Pi's i2c-bcm2835 driver, only
+        the last message may be a read."""
+        if any(m.flags & I2C_M_RD for m in i2c_msgs[:-1]):
+            raise OSError(errno.EOPNOTSUPP, "Operation not supported (read before the last message)")
+        self._transaction("i2c_rdwr", sum(1 + m.len for m in i2c_msgs))
+        for m in i2c_msgs:
+            if m.flags & I2C_M_RD:
+                for i, b in enumerate(self._read(m.addr, m.len)):
+                    m.buf[i] = bytes([b])
+            else:
+                self._write(m.addr, list(m))
+
+
+__all__ = ["SimulatedBus", "SimulatedCard", "SimulatedChannel"]
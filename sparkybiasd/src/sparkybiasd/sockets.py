@@ -0,0 +1,164 @@
+"""
+@authors: Cody Roberson (carobers@asu.edu)
+@Documantation:
+    Direct socket transport, next to redis, for clients on the Pi or the LAN that don't want two hops through the
+    redis server per command. The daemon listens on a Unix domain socket and/or a TCP port (see conf.sockets).
+
+    Every message is a frame: a 4 byte big endian payload length followed by the payload, a command envelope as
+    json or msgpack (msgpack needs the optional msgpack package). A json payload starts with '{', anything else is
+    taken as msgpack. The reply to a command uses the same encoding as the command. A connection may have any
+    number of commands in flight; replies are sent as the commands finish, so pipelining clients match them by id.
+"""
+
+import asyncio
+import json
+import logging
+import os
+import struct
+
+try:
+    import msgpack
+except ImportError:  # Optional, json frames work without it
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+HEADER = struct.Struct(">I")
+
+
+class FrameError(ValueError):
+    """A frame that can't be read or decoded"""
+
+
+def encode_frame(payload: bytes) -> bytes:
+    return HEADER.pack(len(payload)) + payload
+
+
+async def read_frame(reader: asyncio.StreamReader, max_size: int):
+    """
+    Read one frame.
+
+    Returns:
+        The payload, or None if the connection was closed between frames
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise FrameError("Connection closed in the middle of a frame header") from e
+        return None
+    (size,) = HEADER.unpack(header)
+    if size > max_size:
+        raise FrameError(f"Frame of {size} bytes exceeds the limit of {max_size}")
+    try:
+        return await reader.readexactly(size)
+    except asyncio.IncompleteReadError as e:
+        raise FrameError("Connection closed in the middle of a frame") from e
+
+
+def decode_payload(payload: bytes) -> tuple:
+    """
+    Decode a command payload.
+
+    Returns:
+        (command, True if it was msgpack)
+    """
+    if payload.lstrip()[:1] == b"{":
+        try:
+            return json.loads(payload.decode()), False
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            raise FrameError(f"Command is not valid json: {e}") from e
+    if msgpack is None:
+        raise FrameError("Command is not json and msgpack is not installed")
+    try:
+        return msgpack.unpackb(payload, raw=False), True
+    except Exception as e:
+        raise FrameError(f"Command is not valid msgpack: {e}") from e
+
+
+class SocketServer:
+    """
+    Unix socket / TCP listener that runs the commands it receives through `handler`.
+
+    Parameters:
+        handler: Coroutine function taking a decoded command envelope and returning (reply channel, json reply
+            string), e.g. daemon.respond. The reply channel is ignored, replies go back on the connection.
+        max_frame(int): Largest accepted payload in bytes, bigger frames close the connection
+    """
+
+    def __init__(self, handler, max_frame: int = 1_048_576):
+        self.handler = handler
+        self.max_frame = max_frame
+        self.servers = []
+        self.unix_path = None
+
+    async def start(self, unix_path: str = "", tcp_host: str = "", tcp_port: int = 0):
+        """Listen on `unix_path` and on `tcp_host`:`tcp_port`, an empty path or host skips that listener."""
+        if unix_path:
+            if os.path.exists(unix_path):
+                os.unlink(unix_path)  # Left behind by a previous run
+            self.servers.append(await asyncio.start_unix_server(self._connection, path=unix_path))
+            self.unix_path = unix_path
+            logger.info(f"Listening for commands on {unix_path}")
+        if tcp_host:
+            self.servers.append(await asyncio.start_server(self._connection, tcp_host, tcp_port))
+            logger.info(f"Listening for commands on {tcp_host}:{self.tcp_port}")
+
+    @property
+    def tcp_port(self):
+        """Port of the TCP listener (useful when started with port 0), None without one"""
+        for server in self.servers:
+            for sock in server.sockets:
+                if isinstance(sock.getsockname(), tuple):
+                    return sock.getsockname()[1]
+        return None
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        self.servers = []
+        if self.unix_path is not None and os.path.exists(self.unix_path):
+            os.unlink(self.unix_path)
+        self.unix_path = None
+
+    async def _connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info("peername") or "unix socket"
+        logger.debug(f"Client connected: {peer}")
+        tasks = set()
+        try:
+            while True:
+                payload = await read_frame(reader, self.max_frame)
+                if payload is None:
+                    break
+                task = asyncio.create_task(self._command(payload, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except (FrameError, ConnectionError) as e:
+            logger.warning(f"Closing connection to {peer}: {e}")
+        finally:
+            # Commands already received still run, like commands whose redis client went away
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+            logger.debug(f"Client disconnected: {peer}")
+
+    async def _command(self, payload: bytes, writer: asyncio.StreamWriter):
+        try:
+            command, binary = decode_payload(payload)
+        except FrameError as e:
+            response, binary = json.dumps({"status": "error", "code": -2, "msg": str(e)}), False
+        else:
+            _, response = await self.handler(command)
+        data = msgpack.packb(json.loads(response)) if binary else response.encode()
+        if writer.is_closing():
+            return
+        writer.write(encode_frame(data))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
@@ -0,0 +1,128 @@
+"""
+@authors: Cody Roberson (carobers@asu.edu)
+@Documantation:
+    In-memory telemetry for the bias crate. A background TelemetrySampler sweeps the enabled channels of every
+    present card at a fixed interval and stores each measurement in a preallocated TelemetryBuffer (a numpy ring
+    buffer). getStatus can be served from the buffer when the newest sample of a channel is recent enough, so
+    monitoring clients no longer compete with control commands for the I2C bus.
+"""
+
+import logging
+import threading
+import time
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_DTYPE = np.dtype(
+    [
+        ("time", "f8"),
+        ("card", "u1"),
+        ("channel", "u1"),
+        ("vbus", "f4"),
+        ("vshunt", "f4"),
+        ("current", "f4"),
+        ("enabled", "?"),
+        ("testload", "?"),
+        ("wiper", "i2"),
+    ]
+)
+
+
+class TelemetryBuffer:
+    """
+    Fixed size ring buffer of channel samples.
+
+    Parameters:
+        depth(int): Number of samples kept before the oldest are overwritten
+    """
+
+    def __init__(self, depth: int = 4096):
+        self.data = np.zeros(depth, dtype=SAMPLE_DTYPE)
+        self.depth = depth
+        self.head = 0
+        self.count = 0
+        # Row of the newest sample of every card/channel, -1 if there is none
+        self.latest = np.full((18 + 1, 8 + 1), -1, dtype=np.int64)
+        self.lock = threading.Lock()
+
+    def append(
+        self, card: int, channel: int, vbus: float, vshunt: float, current: float, enabled: bool, testload: bool,
+        wiper: int, t: float = None
+    ):
+        with self.lock:
+            row = self.head
+            old = self.data[row]
+            if self.count == self.depth and self.latest[old["card"], old["channel"]] == row:
+                self.latest[old["card"], old["channel"]] = -1
+            self.data[row] = (
+                time.time() if t is None else t, card, channel, vbus, vshunt, current, enabled, testload, wiper
+            )
+            self.latest[card, channel] = row
+            self.head = (row + 1) % self.depth
+            self.count = min(self.count + 1, self.depth)
+
+    def newest(self, card: int, channel: int):
+        """Newest sample of a card+channel as a numpy record, or None"""
+        with self.lock:
+            row = self.latest[card, channel]
+            return None if row < 0 else self.data[row].copy()
+
+    def snapshot(self) -> np.ndarray:
+        """Newest sample of every card+channel that has one, ordered by card and channel"""
+        with self.lock:
+            rows = self.latest[self.latest >= 0]
+            return self.data[rows].copy()
+
+    def since(self, t: float) -> np.ndarray:
+        """All samples newer than `t`, oldest first"""
+        with self.lock:
+            if self.count < self.depth:
+                ordered = self.data[: self.count]
+            else:
+                ordered = np.concatenate((self.data[self.head:], self.data[: self.head]))
+            return ordered[ordered["time"] > t].copy()
+
+
+class TelemetrySampler:
+    """
+    Background thread that calls `sweep()` every `interval` seconds.
+
+    Parameters:
+        sweep: Callable doing one pass over the crate
+        interval(float): Seconds between the start of two sweeps
+    """
+
+    def __init__(self, sweep, interval: float = 1.0):
+        self.sweep = sweep
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="telemetry", daemon=True)
+        self._thread.start()
+        logger.info(f"Telemetry sampler started, interval {self.interval} s")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            start = time.monotonic()
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.exception(f"Telemetry sweep failed: {e}")
+            self._stop.wait(max(0.0, self.interval - (time.monotonic() - start)))
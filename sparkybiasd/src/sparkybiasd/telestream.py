@@ -0,0 +1,141 @@
+"""
+@authors: Cody Roberson (carobers@asu.edu)
+@Documantation:
+    Push telemetry. Every conf.telemetry.stream.interval seconds the daemon adds a frame built from the telemetry
+    buffer to a redis stream (conf.telemetry.stream.name), so monitoring clients can XREAD instead of polling
+    getStatus. A frame has the fields
+
+        seq       Number of the frame, counting from 0 at daemon start. Only added frames are counted, so a gap
+                  between two entries means frames in between were lost or trimmed
+        time      Unix time the frame was built
+        keyframe  1 if the frame holds every measured channel, 0 if it only holds the changed ones
+        channels  json object "<card>:<channel>" -> [time, vbus, vshunt, current, enabled, testload, wiper]
+
+    Every `keyframeEvery`-th interval gives a keyframe. The others are deltas: a channel is only included when one of
+    vbus / vshunt / current moved more than its deadband, or its output, testload or wiper changed, since the
+    channel was last sent. Deltas are compared to the last sent values, not the last frame, so slow drift is
+    still sent once it adds up to a deadband. Empty deltas are not added at all. A client starts from the newest
+    keyframe and applies the deltas after it. The stream is capped at about `maxLen` entries.
+"""
+
+import asyncio
+import json
+import logging
+import time
+
+import numpy as np
+import redis.exceptions
+
+from .midlevel import BiasCrate
+from .telemetry import SAMPLE_DTYPE
+
+logger = logging.getLogger(__name__)
+
+
+class TelemetryStream:
+    """
+    Publishes delta encoded telemetry frames of a crate to a redis stream.
+
+    Parameters:
+        crate(BiasCrate): Crate whose telemetry buffer is published
+        r: redis.asyncio client
+        stream(str): Name of the stream
+        interval(float): Seconds between two frames
+        keyframe_every(int): Every how many frames a keyframe is sent
+        max_len(int): Approximate cap of the stream length (XADD MAXLEN ~)
+        deadband(dict): Smallest change of "vbus" (V), "vshunt" (mV) and "current" (mA) that is sent in a delta frame
+    """
+
+    def __init__(
+        self, crate: BiasCrate, r, stream: str, interval: float = 1.0, keyframe_every: int = 30,
+        max_len: int = 10000, deadband: dict = None
+    ):
+        self.crate = crate
+        self.r = r
+        self.stream = stream
+        self.interval = interval
+        self.keyframe_every = max(1, keyframe_every)
+        self.max_len = max_len
+        deadband = deadband or {}
+        self.deadband = {k: float(deadband.get(k, 0.0)) for k in ("vbus", "vshunt", "current")}
+        self.seq = 0  # seq of the next added frame
+        self.ticks = 0  # Frames built, added or not, for the keyframe cadence
+        # Last sent sample of every card/channel
+        self.sent = np.zeros((18 + 1, 8 + 1), dtype=SAMPLE_DTYPE)
+        self.known = np.zeros((18 + 1, 8 + 1), dtype=bool)
+        self.stats = {"frames": 0, "keyframes": 0, "channels": 0, "skipped": 0}
+
+    def samples(self) -> np.ndarray:
+        """Newest measurement of every channel, with the switch states and wiper the crate has now"""
+        samples = self.crate.telemetry.snapshot()
+        for sample in samples:
+            board = self.crate.cards.get(int(sample["card"]))
+            if board is None:
+                continue
+            channel = int(sample["channel"])
+            sample["enabled"] = board.is_chan_enabled(channel)
+            sample["testload"] = (board.test_enables & (1 << (channel - 1))) != 0
+            sample["wiper"] = board.wiper_states[channel - 1]
+        return samples
+
+    def frame(self):
+        """
+        Build the next frame.
+
+        Returns:
+            Fields of the frame for XADD, or None if it is a delta without changes
+        """
+        samples = self.samples()
+        keyframe = self.ticks % self.keyframe_every == 0
+        self.ticks += 1
+        if not keyframe:
+            sent = self.sent[samples["card"], samples["channel"]]
+            changed = ~self.known[samples["card"], samples["channel"]]
+            for field, band in self.deadband.items():
+                changed |= np.abs(samples[field] - sent[field]) > band
+            for field in ("enabled", "testload", "wiper"):
+                changed |= samples[field] != sent[field]
+            samples = samples[changed]
+        if not keyframe and len(samples) == 0:
+            self.stats["skipped"] += 1
+            return None
+        self.sent[samples["card"], samples["channel"]] = samples
+        self.known[samples["card"], samples["channel"]] = True
+        channels = {
+            f"{s['card']}:{s['channel']}": [
+                float(s["time"]), float(s["vbus"]), float(s["vshunt"]), float(s["current"]), int(s["enabled"]),
+                int(s["testload"]), int(s["wiper"])
+            ]
+            for s in samples
+        }
+        self.stats["frames"] += 1
+        self.stats["keyframes"] += keyframe
+        self.stats["channels"] += len(channels)
+        return {
+            "seq": self.seq,
+            "time": time.time(),
+            "keyframe": int(keyframe),
+            "channels": json.dumps(channels, separators=(",", ":")),
+        }
+
+    def resync(self):
+        """Make the next frame a keyframe, e.g. after frames were lost"""
+        self.ticks += -self.ticks % self.keyframe_every
+
+    async def publish(self):
+        """Build a frame and add it to the stream"""
+        fields = self.frame()
+        if fields is not None:
+            await self.r.xadd(self.stream, fields, maxlen=self.max_len, approximate=True)
+            self.seq += 1
+
+    async def run(self):
+        """Publish a frame every `interval` seconds until cancelled"""
+        while True:
+            start = time.monotonic()
+            try:
+                await self.publish()
+            except redis.exceptions.RedisError as e:
+                logger.warning(f"Could not publish telemetry: {e}")
+                self.resync()
+            await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - start)))
@@ -0,0 +1,226 @@
+"""
+@authors: Cody Roberson (carobers@asu.edu)
+@Documantation:
+    Learned wiper code -> output transfer curves. Every measurement the daemon already takes on an enabled channel
+    (seek iterations and status reads) is recorded as a point on that channel's bus voltage and current curves.
+    Seeks use the curve to jump straight to a predicted wiper code and only fine tune from there.
+
+    A curve is thrown away when a new measurement drifts too far from what the curve predicts (different load,
+    card swapped, testload toggled, ...). Only predictions from a point within `driftSpan` wiper codes count, as
+    the straight line between points further apart doesn't follow the channel's nonlinearity closely enough. A curve keeps at most `maxPoints` points; past that the point in the
+    densest part of the curve is dropped. Curves are persisted next to config.yaml, at most every saveInterval
+    seconds. BiasCrate flushes them once it has released the bus lock, so writing the file never holds up the bus.
+"""
+
+import bisect
+import logging
+import os
+import threading
+import time
+
+from omegaconf import OmegaConf
+
+logger = logging.getLogger(__name__)
+
+QUANTITIES = ("vbus", "current")
+
+
+class TransferCurve:
+    """
+    Measured points of one quantity (V or mA) against wiper code for one channel.
+
+    Parameters:
+        points(dict): Initial wiper -> value points
+        max_points(int): Most points kept (at least 3), None for no limit
+    """
+
+    def __init__(self, points: dict = None, max_points: int = None):
+        self.points: dict[int, float] = dict(points or {})
+        self.max_points = None if max_points is None else max(3, max_points)
+        self._sorted = None
+        self.thin()
+
+    def __len__(self):
+        return len(self.points)
+
+    def clear(self):
+        self.points.clear()
+        self._sorted = None
+
+    def add(self, wiper: int, value: float):
+        self.points[wiper] = value
+        self._sorted = None
+        self.thin(keep=wiper)
+
+    def thin(self, keep: int = None):
+        """Drop points until at most max_points are left. The end points and `keep` are never dropped, of the
+        others the one with the closest neighbours goes first, so the curve keeps covering its range."""
+        if self.max_points is None:
+            return
+        while len(self.points) > self.max_points:
+            wipers = sorted(self.points)
+            drop = min(
+                (i for i in range(1, len(wipers) - 1) if wipers[i] != keep),
+                key=lambda i: wipers[i + 1] - wipers[i - 1],
+            )
+            del self.points[wipers[drop]]
+            self._sorted = None
+
+    def sorted_points(self) -> list:
+        if self._sorted is None:
+            self._sorted = sorted(self.points.items())
+        return self._sorted
+
+    def predict(self, wiper: int):
+        """Interpolated value at `wiper`, None if wiper is outside of the measured range."""
+        if wiper in self.points:
+            return self.points[wiper]
+        pts = self.sorted_points()
+        i = bisect.bisect_left(pts, (wiper,))
+        if i == 0 or i == len(pts):
+            return None
+        (w1, f1), (w2, f2) = pts[i - 1], pts[i]
+        return f1 + (f2 - f1) * (wiper - w1) / (w2 - w1)
+
+    def distance(self, wiper: int):
+        """Wiper codes from `wiper` to the nearest point, None for an empty curve."""
+        pts = self.sorted_points()
+        i = bisect.bisect_left(pts, (wiper,))
+        return min((abs(pts[j][0] - wiper) for j in (i - 1, i) if 0 <= j < len(pts)), default=None)
+
+    def inverse(self, target: float):
+        """
+        Predict the wiper code that produces `target`.
+
+        Returns:
+            (wiper, slope in units per wiper code) or None if the target is outside of the measured range
+        """
+        pts = self.sorted_points()
+        for (w1, f1), (w2, f2) in zip(pts, pts[1:]):
+            if f1 <= target <= f2 and f2 > f1:
+                slope = (f2 - f1) / (w2 - w1)
+                return int(round(w1 + (target - f1) / slope)), slope
+        return None
+
+
+class TransferCurves:
+    """
+    Transfer curves for every card and channel in the crate.
+
+    Parameters:
+        path(str): yaml file the curves are persisted to
+        drift_abs(dict): Absolute drift (per quantity) beyond which a curve is invalidated
+        drift_fraction(float): Relative drift beyond which a curve is invalidated
+        drift_span(int): Only measurements within this many wiper codes of a point are checked for drift
+        save_interval(float): Minimum time in seconds between non forced saves
+        max_points(int): Most points kept per curve, None for no limit
+    """
+
+    def __init__(
+        self,
+        path: str,
+        drift_abs: dict = None,
+        drift_fraction: float = 0.05,
+        drift_span: int = 16,
+        save_interval: float = 30.0,
+        max_points: int = 64,
+    ):
+        self.path = path
+        self.drift_abs = drift_abs or {"vbus": 0.05, "current": 0.5}
+        self.drift_fraction = drift_fraction
+        self.drift_span = drift_span
+        self.save_interval = save_interval
+        self.max_points = max_points
+        # Curves are recorded on the bus thread and the telemetry sampler, and saved from either
+        self.lock = threading.RLock()
+        self.curves: dict[tuple, dict[str, TransferCurve]] = {}
+        self.dirty = False
+        self.last_save = 0.0
+        self.load()
+
+    def get(self, card: int, channel: int, quantity: str) -> TransferCurve:
+        key = (card, channel)
+        if key not in self.curves:
+            self.curves[key] = {q: TransferCurve(max_points=self.max_points) for q in QUANTITIES}
+        return self.curves[key][quantity]
+
+    def record(self, card: int, channel: int, wiper: int, vbus: float = None, current: float = None):
+        """Add a measurement of an enabled channel to its curves, invalidating curves that have drifted."""
+        with self.lock:
+            for quantity, value in (("vbus", vbus), ("current", current)):
+                if value is None:
+                    continue
+                curve = self.get(card, channel, quantity)
+                distance = curve.distance(wiper)
+                predicted = curve.predict(wiper) if distance is not None and distance <= self.drift_span else None
+                if predicted is not None:
+                    allowed = max(self.drift_abs[quantity], self.drift_fraction * abs(predicted))
+                    if abs(value - predicted) > allowed:
+                        logger.info(
+                            f"Card {card} channel {channel} {quantity} drifted at wiper {wiper} "
+                            f"({value} vs predicted {predicted}), invalidating transfer curve"
+                        )
+                        curve.clear()
+                curve.add(wiper, value)
+                self.dirty = True
+
+    def predict_wiper(self, card: int, channel: int, quantity: str, target: float):
+        """(wiper, slope) expected to produce `target`, or None if the curve can't tell."""
+        with self.lock:
+            return self.get(card, channel, quantity).inverse(target)
+
+    def as_dict(self, card: int, channel: int) -> dict:
+        out = {}
+        with self.lock:
+            for q in QUANTITIES:
+                pts = self.get(card, channel, q).sorted_points()
+                out[q] = {"wiper": [p[0] for p in pts], "value": [p[1] for p in pts]}
+        return out
+
+    def invalidate(self, card: int, channel: int = None):
+        """Forget the curves of a card, or of a single channel of that card."""
+        with self.lock:
+            for (c, ch), curves in self.curves.items():
+                if c == card and (channel is None or ch == channel):
+                    for curve in curves.values():
+                        curve.clear()
+                    self.dirty = True
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            data = OmegaConf.to_container(OmegaConf.load(self.path))
+        except Exception as e:
+            logger.error(f"Could not load transfer curves from {self.path}: {e}")
+            return
+        for cardkey, chans in (data or {}).items():
+            for chankey, quantities in chans.items():
+                card, channel = int(cardkey[len("card"):]), int(chankey[len("chan"):])
+                for q in QUANTITIES:
+                    pts = quantities.get(q, {})
+                    curve = self.get(card, channel, q)
+                    curve.points.update(zip(pts.get("wiper", []), pts.get("value", [])))
+                    curve.thin()  # Files written before maxPoints existed can hold any number of points
+        logger.debug(f"Loaded transfer curves for {len(self.curves)} channels")
+
+    def save(self):
+        """Write the curves. Only copying them holds the lock, the file is written without it."""
+        data = {}
+        with self.lock:
+            for (card, channel), curves in sorted(self.curves.items()):
+                if not any(len(c) for c in curves.values()):
+                    continue
+                data.setdefault(f"card{card}", {})[f"chan{channel}"] = self.as_dict(card, channel)
+            self.dirty = False
+            self.last_save = time.monotonic()
+        try:
+            OmegaConf.save(OmegaConf.create(data), self.path)
+        except Exception:
+            self.dirty = True
+            raise
+
+    def flush(self, force: bool = False):
+        """Save if there are unsaved points and either `force` is set or save_interval has passed."""
+        if self.dirty and (force or time.monotonic() - self.last_save >= self.save_interval):
+            self.save()
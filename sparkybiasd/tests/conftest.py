@@ -0,0 +1,25 @@
+import pytest
+
+from sparkybiasd.midlevel import BiasCrate
+from sparkybiasd.simbus import SimulatedBus
+
+
+def sim_crate(tmp_path, cards, enabled=()):
+    """BiasCrate on a simulated bus with `cards` present and the (card, channel) outputs in `enabled` turned on"""
+    bus = SimulatedBus(cards=cards, realtime=False)
+    crate = BiasCrate(bus, curve_path=str(tmp_path / "transfer_curves.yaml"))
+    for card, channel in enabled:
+        crate.enable_output(card, channel)
+    return crate, bus
+
+
+@pytest.fixture
+def simCrate(tmp_path):
+    """Fixture to create a BiasCrate on a simulated bus with two cards, channel 1 of each enabled."""
+    yield sim_crate(tmp_path, [1, 2], enabled=[(1, 1), (2, 1)])
+
+
+@pytest.fixture
+def sparseCrate(tmp_path):
+    """Fixture to create a BiasCrate on a simulated bus with cards 1, 2 and 5 present and every output off."""
+    yield sim_crate(tmp_path, [1, 2, 5])
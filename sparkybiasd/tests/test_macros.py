@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+import pytest
+
+from sparkybiasd import daemon
+from sparkybiasd.macros import MacroError, MacroStore, validate_macro
+from sparkybiasd.midlevel import BiasCrate
+from sparkybiasd.scheduler import BusScheduler
+from sparkybiasd.simbus import SimulatedBus
+
+BIAS_UP = {
+    "params": {"volts": 1.0, "channels": [1, 2]},
+    "steps": [
+        {
+            "forEach": {"card": "$cards", "channel": "$channels"},
+            "do": [
+                {"command": "enableOutput", "args": {"card": "$card", "channel": "$channel"}},
+                {"command": "seekVoltage", "args": {"card": "$card", "channel": "$channel", "voltage": "$volts"},
+                 "save": "seek"},
+                {"check": {"left": "$seek.vbus", "op": ">=", "right": 0.5}, "message": "output did not come up"},
+            ],
+        },
+        {"wait": 0.01},
+        {"command": "getStatus", "args": {"card": 1, "channel": 1}, "save": "status"},
+        {"if": {"left": "$status.vbus", "op": ">", "right": 10}, "then": [{"command": "disableAllOutputs"}]},
+    ],
+}
+
+
+@pytest.fixture
+def macroDaemon(tmp_path, monkeypatch):
+    """Simulated crate plus an empty macro store in tmp_path"""
+    bus = SimulatedBus(cards=[1, 2], realtime=False)
+    crate = BiasCrate(bus, curve_path=str(tmp_path / "transfer_curves.yaml"))
+    monkeypatch.setattr(daemon, "macro_store", MacroStore(str(tmp_path / "macros.yaml")))
+    yield crate, bus
+
+
+def send(crate, *commands):
+    async def scenario():
+        scheduler = BusScheduler(crate)
+        scheduler.start()
+        try:
+            return [json.loads(await daemon.execute(scheduler, c)) for c in commands]
+        finally:
+            await scheduler.stop()
+
+    return asyncio.run(scenario())
+
+
+def test_macro_runs_loops_and_checks(macroDaemon):
+    crate, bus = macroDaemon
+    defined, ran = send(
+        crate,
+        {"command": "defineMacro", "args": {"name": "biasUp", "macro": BIAS_UP}},
+        {"command": "runMacro", "args": {"name": "biasUp", "params": {"volts": 2.0}}},
+    )
+    assert defined["status"] == "success"
+    assert ran["status"] == "success", ran
+    seeks = [r for r in ran["results"] if r["command"] == "seekVoltage"]
+    assert [(r["card"], r["channel"]) for r in seeks] == [(1, 1), (1, 2), (2, 1), (2, 2)]
+    assert all(r["vbus"] == pytest.approx(2.0, abs=0.02) for r in seeks)
+    assert ran["results"][-1]["command"] == "getStatus", "Expected the if branch not to run"
+    assert "biasUp" in MacroStore(daemon.macro_store.path).macros, "Expected the macro to be persisted"
+
+
+def test_failed_check_aborts_macro(macroDaemon):
+    crate, bus = macroDaemon
+    _, ran = send(
+        crate,
+        {"command": "defineMacro", "args": {"name": "biasUp", "macro": BIAS_UP}},
+        {"command": "runMacro", "args": {"name": "biasUp", "params": {"volts": 0.2}}},
+    )
+    assert ran["status"] == "error" and ran["code"] == -38000
+    assert "output did not come up" in ran["msg"]
+    assert len(ran["results"]) == 2, "Expected the macro to stop at the first failed check"
+
+
+@pytest.mark.parametrize(
+    "macro",
+    [
+        {"steps": []},
+        {"steps": [{"command": "batch", "args": {"commands": []}}]},
+        {"steps": [{"command": "getStatus", "wait": 1}]},
+        {"steps": [{"check": {"left": 1, "op": "=~", "right": 2}}]},
+        {"steps": [{"forEach": {"card": [1]}, "do": []}]},
+        {"steps": [{"wait": -1}]},
+    ],
+)
+def test_invalid_macros_are_rejected(macro):
+    with pytest.raises(MacroError):
+        validate_macro(macro, ["getStatus"])
@@ -0,0 +1,95 @@
+import asyncio
+import json
+
+import pytest
+
+from sparkybiasd import daemon
+from sparkybiasd.mirror import StateMirror
+from sparkybiasd.scheduler import BusScheduler
+
+
+class FakeRedis:
+    """Keeps the hashes written through pipelines and counts the round trips."""
+
+    def __init__(self):
+        self.hashes = {}
+        self.round_trips = 0
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+
+class FakePipeline:
+    def __init__(self, r):
+        self.r = r
+        self.queued = []
+
+    def hset(self, name, mapping):
+        self.queued.append((name, mapping))
+
+    async def execute(self):
+        self.r.round_trips += 1
+        for name, mapping in self.queued:
+            self.r.hashes.setdefault(name, {}).update(mapping)
+
+
+def mirrored(crate, coro_factory, prefix="bias:"):
+    """Run coro_factory(scheduler, mirror, r) with a StateMirror installed like serve() does."""
+    r = FakeRedis()
+
+    async def scenario():
+        scheduler = BusScheduler(crate)
+        scheduler.start()
+        daemon.state_mirror = StateMirror(crate, r, prefix, interval=0.01)
+        writer = asyncio.create_task(daemon.state_mirror.run())
+        try:
+            return await coro_factory(scheduler, daemon.state_mirror, r)
+        finally:
+            writer.cancel()
+            daemon.state_mirror = None
+            await scheduler.stop()
+
+    return asyncio.run(scenario()), r
+
+
+def test_mirror_writes_every_channel_in_one_round_trip(simCrate):
+    crate, bus = simCrate
+
+    async def scenario(scheduler, mirror, r):
+        mirror.mark()
+        await mirror.flush()
+
+    _, r = mirrored(crate, scenario)
+    assert r.round_trips == 1
+    assert set(r.hashes) == {f"bias:card{c}:chan{ch}" for c in (1, 2) for ch in range(1, 9)} | {"bias:crate"}
+    assert r.hashes["bias:card1:chan1"]["outputEnabled"] == 1 and r.hashes["bias:card1:chan2"]["outputEnabled"] == 0
+    assert "vbus" not in r.hashes["bias:card2:chan1"], "Expected no measurement before one was taken"
+    assert json.loads(r.hashes["bias:crate"]["cards"]) == [1, 2]
+    assert json.loads(r.hashes["bias:crate"]["card2:chan1"])["outputEnabled"] == 1
+
+
+def test_commands_mark_the_cards_they_touch(simCrate):
+    crate, bus = simCrate
+
+    async def scenario(scheduler, mirror, r):
+        await daemon.execute(scheduler, {"command": "seekVoltage", "args": {"card": 2, "channel": 1, "voltage": 1.5}})
+        await daemon.execute(scheduler, {"command": "getAvailableCards", "args": {}})
+        while r.round_trips < 1:
+            await asyncio.sleep(0.001)
+
+    _, r = mirrored(crate, scenario)
+    assert set(r.hashes) == {f"bias:card2:chan{ch}" for ch in range(1, 9)} | {"bias:crate"}
+    state = r.hashes["bias:card2:chan1"]
+    assert state["vbus"] == pytest.approx(1.5, abs=0.02) and state["wiper"] == crate.cards[2].wiper_states[0]
+
+
+def test_disable_all_outputs_marks_the_whole_crate(simCrate):
+    crate, bus = simCrate
+
+    async def scenario(scheduler, mirror, r):
+        await daemon.execute(scheduler, {"command": "disableAllOutputs", "args": {}})
+        while r.round_trips < 1:
+            await asyncio.sleep(0.001)
+
+    _, r = mirrored(crate, scenario, prefix="")
+    assert r.hashes["card1:chan1"]["outputEnabled"] == 0 and r.hashes["card2:chan1"]["outputEnabled"] == 0
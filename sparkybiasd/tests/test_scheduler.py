@@ -0,0 +1,400 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+import redis.exceptions
+
+from sparkybiasd import daemon
+from sparkybiasd.midlevel import Preempted
+from sparkybiasd.scheduler import SAFETY, BusScheduler
+from sparkybiasd.scheduler import priority as scheduler_priority
+from sparkybiasd.scheduler import safety_scope
+from sparkybiasd.telemetry import TelemetryBuffer
+
+
+def run(crate, coro_factory):
+    """Run coro_factory(scheduler) on a fresh event loop with a started BusScheduler."""
+
+    async def scenario():
+        scheduler = BusScheduler(crate)
+        scheduler.start()
+        try:
+            return await coro_factory(scheduler)
+        finally:
+            await scheduler.stop()
+
+    return asyncio.run(scenario())
+
+
+def test_status_reads_run_while_a_seek_settles(simCrate):
+    crate, bus = simCrate
+    order = []
+
+    async def seek(scheduler):
+        res = await scheduler.drive(crate.seek_steps(1, 1, "vbus", 2.5))
+        order.append("seek")
+        return res
+
+    async def status(scheduler):
+        await asyncio.sleep(0)
+        res = await scheduler.run(crate.get_status, 2, 1)
+        order.append("status")
+        return res
+
+    async def both(scheduler):
+        return await asyncio.gather(seek(scheduler), status(scheduler))
+
+    (wiper, value, iterations), _ = run(crate, both)
+    assert value == pytest.approx(2.5, abs=0.01)
+    assert order == ["status", "seek"], "Expected the status read to complete while the seek was settling"
+
+
+def test_seek_many_steps_match_blocking_seek_many(simCrate):
+    crate, bus = simCrate
+    targets = [(1, 1, 1.0), (2, 1, 3.0), (2, 2, 1.0)]
+    results = run(crate, lambda scheduler: scheduler.drive(crate.seek_many_steps(targets, "vbus")))
+    assert results[0]["value"] == pytest.approx(1.0, abs=0.01)
+    assert results[1]["value"] == pytest.approx(3.0, abs=0.01)
+    assert "error" in results[2]
+
+
+def test_execute_dispatches_sync_and_async_handlers(simCrate):
+    crate, bus = simCrate
+
+    async def commands(scheduler):
+        return await asyncio.gather(
+            daemon.execute(scheduler, {"command": "seekVoltage", "args": {"card": 1, "channel": 1, "voltage": 2.0}}),
+            daemon.execute(scheduler, {"command": "getAvailableCards", "args": {}}),
+            daemon.execute(scheduler, {"command": "bogus", "args": {}}),
+        )
+
+    seek, cards, bogus = (json.loads(r) for r in run(crate, commands))
+    assert seek["status"] == "success" and seek["vbus"] == pytest.approx(2.0, abs=0.02)
+    assert cards["cards"] == [1, 2]
+    assert bogus["status"] == "error" and bogus["code"] == -6
+
+
+def test_commands_on_one_channel_take_turns(simCrate):
+    crate, bus = simCrate
+
+    def seek(voltage):
+        return {"command": "seekVoltage", "args": {"card": 1, "channel": 1, "voltage": voltage}}
+
+    async def scenario(scheduler):
+        replies = await asyncio.gather(
+            daemon.execute(scheduler, seek(1.0)),
+            daemon.execute(scheduler, seek(3.0)),
+            daemon.execute(scheduler, {"command": "seekVoltageMany", "args": {"targets": [[1, 1, 2.0], [2, 1, 2.0]]}}),
+        )
+        assert not scheduler.locks.locked(1, 1), "Expected every channel lock to be released"
+        return [json.loads(r) for r in replies]
+
+    low, high, many = run(crate, scenario)
+    assert low["vbus"] == pytest.approx(1.0, abs=0.02)
+    assert high["vbus"] == pytest.approx(3.0, abs=0.02), "Expected the second seek not to interleave with the first"
+    assert [r["vbus"] for r in many["results"]] == pytest.approx([2.0, 2.0], abs=0.02)
+
+
+def test_cached_status_does_not_wait_for_the_channel_lock(simCrate):
+    crate, bus = simCrate
+    crate.sweep_telemetry()
+
+    def status(**extra):
+        return {"command": "getStatus", "args": {"card": 1, "channel": 1, **extra}}
+
+    async def scenario(scheduler):
+        async with scheduler.locks.hold([(1, 1)]):  # as a running seek would
+            cached = await asyncio.wait_for(daemon.execute(scheduler, status(maxAge=60)), 1)
+            live = asyncio.ensure_future(daemon.execute(scheduler, status()))
+            await asyncio.sleep(0.1)
+            assert not live.done(), "Expected a live read to wait for the channel lock"
+        return json.loads(cached), json.loads(await live)
+
+    cached, live = run(crate, scenario)
+    assert cached["status"] == "success" and live["status"] == "success"
+    assert cached["wiper"] == live["wiper"]
+
+
+class FakeRedis:
+    """Records what handle_message publishes."""
+
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, channel, message):
+        self.published.append((channel, json.loads(message)))
+
+
+def test_replies_carry_id_and_follow_reply_to(simCrate):
+    crate, bus = simCrate
+    r = FakeRedis()
+    messages = [
+        {"id": "a", "replyTo": "client1", "command": "seekVoltage", "args": {"card": 1, "channel": 1, "voltage": 1.5}},
+        {"id": 7, "replyTo": "client2", "command": "getStatus", "args": {"card": 2, "channel": 1}},
+        {"command": "getStatus", "args": {"card": 2, "channel": 1}},
+        {"id": 8, "replyTo": "", "command": "getStatus", "args": {"card": 2, "channel": 1}},
+    ]
+
+    async def send(scheduler):
+        await asyncio.gather(*(daemon.handle_message(scheduler, r, json.dumps(m).encode()) for m in messages))
+
+    run(crate, send)
+    replies = {channel: msg for channel, msg in r.published if "id" in msg and msg["id"] != 8}
+    assert replies["client1"]["id"] == "a" and replies["client1"]["vbus"] == pytest.approx(1.5, abs=0.02)
+    assert replies["client2"]["id"] == 7 and replies["client2"]["status"] == "success"
+    channels = [channel for channel, msg in r.published]
+    assert channels.index("client2") < channels.index("client1"), "Expected the status read to finish before the seek"
+    default = [msg for channel, msg in r.published if channel == daemon.conf.redis.replyChannel]
+    assert any("id" not in msg and msg["status"] == "success" for msg in default)
+    assert any(msg.get("id") == 8 and msg["code"] == -11 for msg in default)
+
+
+def test_batch_groups_commands_per_card(simCrate):
+    crate, bus = simCrate
+    commands = []
+    for ch in range(1, 4 + 1):
+        for card in (1, 2):
+            commands.append({"command": "enableOutput", "args": {"card": card, "channel": ch}})
+    commands.append({"id": "last", "command": "getStatus", "args": {"card": 1, "channel": 4}})
+    bus.reset_stats()
+    res = json.loads(run(crate, lambda scheduler: daemon.batch(scheduler, {"commands": commands})))
+    assert res["status"] == "success"
+    expected = [(c["args"]["card"], c["args"]["channel"]) for c in commands[:8]]
+    assert [(r["card"], r["channel"]) for r in res["results"][:8]] == expected, "Expected results in command order"
+    assert res["results"][-1]["id"] == "last" and res["results"][-1]["outputEnabled"]
+    # Card 2 was connected last by the fixture: switch to card 1, then back to card 2 (disconnect + connect each)
+    assert bus.stats["ops"]["write_byte"] == 4, "Expected the repeaters to be switched once per card"
+
+
+@pytest.mark.parametrize("names, expected", [
+    ([("disableOutput", 1, 1), ("loadConfig",), ("seekVoltage", 1, 1)], [0, 1, 2]),
+    ([("enableOutput", 1, 1), ("disableAllOutputs",), ("enableOutput", 2, 1), ("enableOutput", 1, 2)], [0, 1, 2, 3]),
+    ([("enableOutput", 1, 1), ("enableOutput", 2, 1), ("enableOutput", 1, 2), ("getCrateStatus",),
+      ("enableOutput", 2, 2), ("enableOutput", 1, 3), ("enableOutput", 2, 3)], [0, 2, 1, 3, 4, 6, 5]),
+])
+def test_batch_groups_only_between_commands_without_a_card(names, expected):
+    commands = [{"command": name, "args": {"card": args[0], "channel": args[1]} if args else {}}
+                for name, *args in names]
+    assert daemon._card_grouped(commands) == expected
+
+
+def test_batch_keeps_outputs_enabled_after_a_disable_all(simCrate):
+    crate, bus = simCrate
+    commands = [
+        {"command": "enableOutput", "args": {"card": 1, "channel": 1}},
+        {"command": "disableAllOutputs", "args": {}},
+        {"command": "enableOutput", "args": {"card": 2, "channel": 1}},
+        {"command": "enableOutput", "args": {"card": 1, "channel": 2}},
+    ]
+    res = json.loads(run(crate, lambda scheduler: daemon.batch(scheduler, {"commands": commands})))
+    assert res["status"] == "success"
+    assert crate.cards[1].channel_enables == 0b10 and crate.cards[2].channel_enables == 0b1
+
+
+def test_batch_reports_failed_entries(simCrate):
+    crate, bus = simCrate
+    commands = [
+        {"command": "getStatus", "args": {"card": 1, "channel": 1}},
+        {"command": "getStatus", "args": {"card": 1}},
+        {"command": "batch", "args": {"commands": []}},
+    ]
+    res = json.loads(run(crate, lambda scheduler: daemon.batch(scheduler, {"commands": commands[:2], "ordered": True})))
+    assert res["status"] == "error" and res["code"] == -37000
+    assert [r["status"] for r in res["results"]] == ["success", "error"]
+    res = json.loads(run(crate, lambda scheduler: daemon.batch(scheduler, {"commands": commands})))
+    assert res["code"] == -37100
+
+
+def test_safety_jobs_run_before_queued_jobs(simCrate):
+    crate, bus = simCrate
+    order = []
+
+    def job(name):
+        time.sleep(0.01)
+        order.append(name)
+
+    async def jobs(scheduler):
+        tasks = [asyncio.create_task(scheduler.run(job, "running"))]
+        await asyncio.sleep(0.005)
+        tasks += [asyncio.create_task(scheduler.run(job, f"normal{i}")) for i in range(2)]
+        token = scheduler_priority.set(SAFETY)
+        tasks.append(asyncio.create_task(scheduler.run(job, "safety")))  # Tasks copy the priority when created
+        scheduler_priority.reset(token)
+        await asyncio.sleep(0)
+        assert crate.preempt.is_set()
+        await asyncio.gather(*tasks)
+
+    run(crate, jobs)
+    assert order == ["running", "safety", "normal0", "normal1"], "Expected the safety job right after the running one"
+    assert not crate.preempt.is_set()
+
+
+def test_disable_all_outputs_cancels_a_running_seek(simCrate):
+    crate, bus = simCrate
+    r = FakeRedis()
+    seek = {"id": "s", "command": "seekVoltage", "args": {"card": 1, "channel": 1, "voltage": 4.0}}
+    other = {"id": "o", "command": "seekVoltage", "args": {"card": 2, "channel": 1, "voltage": 4.0}}
+
+    async def scenario(scheduler):
+        tasks = [asyncio.create_task(daemon.handle_message(scheduler, r, json.dumps(m).encode())) for m in (seek, other)]
+        while scheduler.stats["jobs"] < 4:
+            await asyncio.sleep(0.001)
+        # A disableOutput on another channel leaves both seeks running
+        await daemon.handle_message(scheduler, r, json.dumps(
+            {"id": "d", "command": "disableOutput", "args": {"card": 2, "channel": 2}}).encode())
+        assert len(daemon.operations) == 2
+        jobs = scheduler.stats["jobs"]
+        await daemon.handle_message(scheduler, r, json.dumps(
+            {"id": "all", "command": "disableAllOutputs", "args": {}}).encode())
+        assert scheduler.stats["jobs"] - jobs <= 2, "Expected at most the running job ahead of the safety job"
+        await asyncio.gather(*tasks)
+
+    run(crate, scenario)
+    replies = {msg["id"]: msg for channel, msg in r.published}
+    assert replies["d"]["status"] == "success" and replies["all"]["status"] == "success"
+    for i in ("s", "o"):
+        assert replies[i]["code"] == -39100 and replies[i]["msg"] == "Cancelled by disableAllOutputs"
+    assert crate.cards[1].channel_enables == 0 and crate.cards[2].channel_enables == 0
+    assert daemon.operations == []
+
+
+def test_cancel_by_id(simCrate):
+    crate, bus = simCrate
+    r = FakeRedis()
+    seek = {"id": "s", "command": "seekVoltageMany", "args": {"targets": [[1, 1, 4.0], [2, 1, 4.0]]}}
+
+    async def scenario(scheduler):
+        task = asyncio.create_task(daemon.handle_message(scheduler, r, json.dumps(seek).encode()))
+        while scheduler.stats["jobs"] < 2:
+            await asyncio.sleep(0.001)
+        for target in ("s", "unknown"):
+            await daemon.handle_message(scheduler, r, json.dumps(
+                {"id": f"cancel-{target}", "command": "cancel", "args": {"target": target}}).encode())
+        await task
+
+    run(crate, scenario)
+    replies = {msg["id"]: msg for channel, msg in r.published}
+    assert replies["cancel-s"] == {"id": "cancel-s", "status": "success", "target": "s", "cancelled": 1}
+    assert replies["cancel-unknown"]["code"] == -39000
+    assert replies["s"]["code"] == -39100 and replies["s"]["msg"] == "Cancelled by cancel"
+
+
+def test_crate_sweeps_stop_for_safety_commands(simCrate):
+    crate, bus = simCrate
+    crate.preempt.set()
+    with pytest.raises(Preempted):
+        crate.get_crate_status()
+    crate.telemetry = TelemetryBuffer(16)
+    crate.sweep_telemetry()
+    assert crate.telemetry.count == 0
+    crate.preempt.clear()
+    crate.sweep_telemetry()
+    assert crate.telemetry.count == 2
+
+
+def test_disable_output_does_not_preempt_unrelated_sweeps(simCrate):
+    crate, bus = simCrate
+    started, release = threading.Event(), threading.Event()
+
+    def status():
+        started.set()
+        release.wait(1)
+        return crate.get_crate_status()
+
+    async def jobs(scheduler):
+        task = asyncio.create_task(scheduler.run(status))
+        await asyncio.get_running_loop().run_in_executor(None, started.wait)
+        level, scope = scheduler_priority.set(SAFETY), safety_scope.set((2, 1))
+        safety = asyncio.create_task(scheduler.run(crate.disable_output, 2, 1))
+        safety_scope.reset(scope)
+        scheduler_priority.reset(level)
+        await asyncio.sleep(0)
+        assert not crate.preempt.is_set() and crate.preempted_outputs == {(2, 1)}
+        release.set()
+        return await asyncio.gather(task, safety)
+
+    snapshot, _ = run(crate, jobs)
+    assert [c["card"] for c in snapshot] == [1, 2], "Expected getCrateStatus to finish past the disabled output"
+    assert crate.preempted_outputs == set() and not crate.cards[2].is_chan_enabled(1)
+
+
+def test_progress_events_carry_the_command_id(simCrate):
+    crate, bus = simCrate
+    r = FakeRedis()
+    seek = {"id": "s", "command": "seekVoltage", "args": {"card": 1, "channel": 1, "voltage": 3.0}}
+
+    async def scenario(scheduler):
+        events = asyncio.Queue(100)
+        crate.progress = daemon.progress_reporter(events)
+        publisher = asyncio.create_task(daemon.publish_progress(r, events))
+        await daemon.handle_message(scheduler, r, json.dumps(seek).encode())
+        await asyncio.sleep(0.01)
+        publisher.cancel()
+
+    run(crate, scenario)
+    progress = [msg for channel, msg in r.published if channel == daemon.conf.redis.progressChannel]
+    assert progress and all(e["id"] == "s" and e["command"] == "seekVoltage" for e in progress)
+    assert progress[0]["iteration"] == 1 and progress[-1]["done"]
+    reply = [msg for channel, msg in r.published if channel == daemon.conf.redis.replyChannel][0]
+    assert reply["status"] == "success" and "iteration" not in reply
+
+
+class FakeStreams:
+    """Serves scripted XREADGROUP results and records replies and acknowledgements."""
+
+    def __init__(self, reads):
+        self.reads = list(reads)
+        self.requests = []
+        self.replies = []
+        self.acked = []
+
+    async def xgroup_create(self, stream, group, id, mkstream):
+        raise redis.exceptions.ResponseError("BUSYGROUP Consumer Group name already exists")
+
+    async def xreadgroup(self, group, consumer, streams, count, block=None):
+        self.requests.append(dict(streams))
+        if not self.reads:
+            await asyncio.Event().wait()
+        return self.reads.pop(0)
+
+    async def xadd(self, stream, fields, maxlen, approximate):
+        self.replies.append((stream, json.loads(fields["reply"])))
+
+    async def xack(self, stream, group, entry_id):
+        self.acked.append(entry_id)
+
+
+def test_streams_transport(simCrate):
+    crate, bus = simCrate
+    stream = daemon.conf.redis.streams.commandStream
+
+    def entry(entry_id, command):
+        return entry_id, {b"command": json.dumps(command).encode()}
+
+    pending = [entry(b"1-0", {"id": "old", "command": "getStatus", "args": {"card": 2, "channel": 1}})]
+    new = [
+        entry(b"2-0", {"id": "a", "command": "enableOutput", "args": {"card": 1, "channel": 2}}),
+        entry(b"2-1", {"id": "b", "command": "enableOutput", "args": {"card": 2, "channel": 2}}),
+        entry(b"2-2", {"id": "c", "replyTo": "client", "command": "getStatus", "args": {"card": 1, "channel": 2}}),
+        (b"2-3", {b"other": b"x"}),
+        (b"2-4", {b"command": b"{not json"}),
+    ]
+    r = FakeStreams([[[stream.encode(), pending]], [[stream.encode(), []]], [[stream.encode(), new]]])
+
+    async def scenario(scheduler):
+        tasks = set()
+        server = asyncio.create_task(daemon.serve_streams(scheduler, r, tasks))
+        while len(r.acked) < 6:
+            await asyncio.sleep(0.001)
+        server.cancel()
+
+    run(crate, scenario)
+    assert r.requests[:3] == [{stream: "0"}, {stream: b"1-0"}, {stream: ">"}]
+    assert sorted(r.acked) == [b"1-0", b"2-0", b"2-1", b"2-2", b"2-3", b"2-4"]
+    replies = {msg.get("id", msg.get("code")): (name, msg) for name, msg in r.replies}
+    assert replies["old"][1]["status"] == "success"
+    assert replies["c"][0] == "client" and replies["c"][1]["outputEnabled"]
+    assert replies["a"][0] == daemon.conf.redis.streams.replyStream
+    assert -12 in replies and -2 in replies
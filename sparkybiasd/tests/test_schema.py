@@ -0,0 +1,134 @@
+import asyncio
+import json
+
+import numpy as np
+import pytest
+
+from sparkybiasd import daemon
+from sparkybiasd.scheduler import BusScheduler
+from sparkybiasd.schema import SchemaError, compile_schema
+
+
+def test_arguments_are_coerced():
+    valid, args = daemon.validate_command(
+        {"command": "seekVoltage", "args": {"card": "3", "channel": 2.0, "voltage": 1, "mode": "fast", "extra": [1]}})
+    assert valid
+    assert args == {"card": 3, "channel": 2, "voltage": 1.0, "mode": "fast", "extra": [1]}
+    assert type(args["voltage"]) is float
+    valid, args = daemon.validate_command(
+        {"command": "loadConfig", "args": {"enableOutputs": "true", "createNewConfig": False, "dryRun": None}})
+    assert valid and args["enableOutputs"] is True and "dryRun" not in args, "Expected a null optional to be dropped"
+
+
+@pytest.mark.parametrize("args, code", [
+    ({"card": "three", "channel": 1}, -8),
+    ({"card": 19, "channel": 1}, -8),
+    ({"card": True, "channel": 1}, -8),
+    ({"card": 1, "channel": 9}, -9),
+    ({"card": 1, "channel": 1.5}, -9),
+    ({"card": 1}, -7),
+    ({"card": 1, "channel": 1, "maxAge": "soon"}, -13),
+    ({"card": 1, "channel": 1, "maxAge": float("nan")}, -13),
+])
+def test_invalid_arguments_are_rejected(args, code):
+    valid, rep = daemon.validate_command({"command": "getStatus", "args": args})
+    assert not valid
+    assert json.loads(rep.error_str())["code"] == code
+
+
+@pytest.mark.parametrize("command, args, code", [
+    ("loadConfig", {"enableOutputs": 1, "createNewConfig": False}, -202),
+    ("loadConfig", {"enableOutputs": True, "createNewConfig": "no"}, -203),
+    ("loadConfig", {"enableOutputs": True, "createNewConfig": False, "dryRun": []}, -204),
+    ("seekVoltage", {"card": 1, "channel": 1, "voltage": 1.0, "tolerance": 0}, -13),
+    ("seekVoltage", {"card": 1, "channel": 1, "voltage": 1.0, "maxStep": True}, -13),
+    ("getCrateStatus", {"channels": [0]}, -9),
+    ("batch", {"commands": [], "ordered": "sometimes"}, -13),
+    ("batch", {"commands": []}, -13),
+    ("seekVoltageMany", {"targets": []}, -13),
+    ("seekVoltageMany", {"targets": [[1, 1]]}, -13),
+    ("seekVoltageMany", {"targets": [[1, 1, "high"]]}, -13),
+    ("seekVoltageMany", {"targets": [[True, 1, 2.0]]}, -8),
+    ("seekCurrentMany", {"targets": [[1, 9, 2.0]]}, -9),
+])
+def test_argument_codes_come_from_the_schema(command, args, code):
+    valid, rep = daemon.validate_command({"command": command, "args": args})
+    assert not valid and rep.code == code
+
+
+def test_null_optionals_are_accepted_by_the_handlers(simCrate):
+    crate, bus = simCrate
+    commands = [
+        {"command": "getStatus", "args": {"card": 1, "channel": 1, "maxAge": None}},
+        {"command": "getCrateStatus", "args": {"cards": None, "channels": None}},
+        {"command": "seekVoltage", "args": {"card": 1, "channel": 1, "voltage": 1.0, "tolerance": None, "mode": None,
+                                            "maxStep": None}},
+        {"command": "batch", "args": {"commands": [{"command": "getAvailableCards", "args": {}}], "ordered": None}},
+    ]
+
+    async def scenario():
+        scheduler = BusScheduler(crate)
+        scheduler.start()
+        try:
+            return [json.loads(await daemon.execute(scheduler, c)) for c in commands]
+        finally:
+            await scheduler.stop()
+
+    for command, res in zip(commands, asyncio.run(scenario())):
+        assert res["status"] == "success", f"{command['command']}: {res}"
+
+
+def test_targets_are_coerced_per_position():
+    valid, args = daemon.validate_command({"command": "seekVoltageMany", "args": {"targets": [["2", 3.0, 1]]}})
+    assert valid and args["targets"] == [[2, 3, 1.0]] and type(args["targets"][0][2]) is float
+
+
+@pytest.mark.parametrize("request_id", ["seek-42", 7, 'quote"d'])
+def test_id_is_spliced_into_the_reply(request_id):
+    r = daemon.reply()
+    r.status, r.card, r.channel = "success", 1, 2
+    for response in (r.success_str(), json.dumps({"status": "success", "results": []})):
+        spliced = daemon.with_id(response, request_id)
+        assert json.loads(spliced) == {"id": request_id, **json.loads(response)}
+        assert spliced == json.dumps({"id": request_id, **json.loads(response)})
+    assert daemon.with_id(r.success_str(), None) == r.success_str()
+
+
+def test_envelope_errors():
+    assert daemon.validate_command({"command": ["getStatus"], "args": {}})[1].code == -6
+    assert daemon.validate_command({"command": "getStatus", "args": []})[1].code == -5
+    assert daemon.validate_command("getStatus")[1].code == -3
+
+
+def test_list_items_and_choices():
+    validate = compile_schema("test", {
+        "channels": {"type": "list", "items": {"type": "int", "min": 1, "max": 8}},
+        "mode": {"type": "string", "choices": ["a", "b"], "required": False},
+    })
+    assert validate({"channels": ["1", 2]}) == {"channels": [1, 2]}
+    with pytest.raises(SchemaError, match="between 1 and 8"):
+        validate({"channels": [0]})
+    with pytest.raises(SchemaError, match="one of"):
+        validate({"channels": [], "mode": "c"})
+
+
+def test_reply_encoding_matches_json_dumps():
+    r = daemon.reply()
+    r.status, r.card, r.channel = "success", 4, 7
+    r.vbus, r.vshunt, r.current = 1.2345678, np.float32(0.001), float("nan")
+    r.outputEnabled, r.wiper = np.bool_(True), np.int16(512)
+    assert r.success_str() == json.dumps({
+        "status": "success", "card": 4, "channel": 7, "vbus": 1.2345678, "vshunt": float(np.float32(0.001)),
+        "current": float("nan"), "outputEnabled": True, "wiper": 512})
+    r = daemon.reply()
+    r.status, r.code, r.errormessage = "error", -100, 'Card "5" µA\n'
+    assert r.error_str() == json.dumps({"status": "error", "code": -100, "msg": 'Card "5" µA\n'})
+    with pytest.raises(AttributeError):
+        r.typo = 1
+
+
+def test_get_schema_describes_every_command():
+    res = json.loads(asyncio.run(daemon.get_schema(None, {})))
+    assert set(res["commands"]) == set(daemon.COMMAND_TABLE)
+    assert res["commands"]["getStatus"]["args"]["card"]["max"] == 18
+    assert res["commands"]["disableAllOutputs"]["safety"]
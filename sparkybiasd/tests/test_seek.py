@@ -0,0 +1,98 @@
+import pytest
+
+from sparkybiasd.midlevel import BiasCrate
+from sparkybiasd.seek import WiperSeek, seek_settings
+from sparkybiasd.simbus import SimulatedBus
+
+
+def run_seek(seek: WiperSeek, curve, start: int = 0) -> int:
+    """Drive a WiperSeek against a python transfer function."""
+    seek.observe(start, curve(start))
+    while not seek.done:
+        w = seek.next_wiper()
+        seek.observe(w, curve(w))
+    return seek.result
+
+
+@pytest.mark.parametrize("target", [0.05, 0.5, 2.0, 3.3, 4.4])
+def test_full_range_seek_converges_quickly(target):
+    curve = lambda w: 4.5 * (w / 1023) ** 1.1
+    seek = WiperSeek(target, 0.01)
+    wiper = run_seek(seek, curve)
+    assert abs(curve(wiper) - target) <= 0.01
+    assert seek.iterations <= 12, f"Expected ~10 measurements, took {seek.iterations}"
+
+
+def test_unreachable_target_saturates():
+    curve = lambda w: 4.0 * w / 1023
+    seek = WiperSeek(4.8, 0.01)
+    assert run_seek(seek, curve, start=500) == 1023
+
+
+def test_target_below_offset_goes_to_zero():
+    curve = lambda w: 0.1 + 4.0 * w / 1023
+    seek = WiperSeek(0.0, 0.01)
+    assert run_seek(seek, curve, start=700) == 0
+
+
+def test_max_step_limits_wiper_moves():
+    curve = lambda w: 4.0 * w / 1023
+    seek = WiperSeek(3.0, 0.01, max_step=40)
+    run_seek(seek, curve, start=0)
+    moves = [abs(b - a) for a, b in zip(seek.history, seek.history[1:])]
+    assert max(moves) <= 40
+
+
+def test_seek_settings():
+    assert seek_settings("normal") == (0.01, 6)
+    assert seek_settings("fast", 0.2)[0] == 0.2
+    with pytest.raises(ValueError):
+        seek_settings("ludicrous")
+    with pytest.raises(ValueError):
+        seek_settings("normal", -1)
+
+
+def test_simulated_seek_voltage(tmp_path):
+    bus = SimulatedBus(cards=[1], realtime=False)
+    crate = BiasCrate(bus, curve_path=str(tmp_path / "transfer_curves.yaml"))
+    crate.enable_output(1, 2)
+    wiper, value, iterations = crate.seek_voltage(1, 2, 2.5)
+    assert value == pytest.approx(2.5, abs=0.01)
+    assert iterations <= 12
+    assert crate.cards[1].wiper_states[1] == wiper
+
+
+def test_seek_many_interleaves_channels(tmp_path):
+    bus = SimulatedBus(cards=[1, 2], realtime=False)
+    crate = BiasCrate(bus, curve_path=str(tmp_path / "transfer_curves.yaml"))
+    crate.enable_all_outputs()
+    crate.disable_output(2, 8)
+    targets = [(card, ch, 0.5 * ch) for card in (1, 2) for ch in range(1, 8 + 1)] + [(7, 1, 1.0)]
+    results = crate.seek_many(targets, "vbus")
+    assert len(results) == len(targets)
+    for res in results[:15]:
+        assert res["value"] == pytest.approx(res["target"], abs=0.01)
+        assert res["iterations"] <= 12
+    assert "error" in results[15], "Expected a disabled output to be rejected"
+    assert "error" in results[16], "Expected a missing card to be rejected"
+
+
+def test_seek_many_settles_on_a_channel_that_moved_that_phase(simCrate):
+    crate, bus = simCrate
+    for v in (1.0, 3.0, 0.5, 4.0, 3.0, 0.2):
+        crate.seek_voltage(1, 1, v)  # Learn a curve so the start jump of 1:1 lands on the target
+    crate.seek_voltage(2, 1, 2.0)
+    wipers = lambda: {(card, 1): crate.cards[card].wiper_states[0] for card in (1, 2)}
+    steps = crate.seek_many_steps([(1, 1, 3.0), (2, 1, 2.1)], "vbus")
+    before = wipers()
+    try:
+        request = next(steps)
+        while True:
+            if request is not None:
+                card, channel, timeout = request
+                assert wipers()[(card, channel)] != before[(card, channel)], "Expected a settle on a moved channel"
+                before = wipers()
+                crate.settle_output(*request)
+            request = steps.send(None)
+    except StopIteration:
+        pass
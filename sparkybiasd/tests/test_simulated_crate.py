@@ -0,0 +1,425 @@
+import errno
+import json
+import time
+
+import pytest
+import smbus2
+from omegaconf import OmegaConf
+
+from sparkybiasd import daemon, midlevel
+from sparkybiasd.hardware import WIPER_RDAC_TABLE
+from sparkybiasd.midlevel import BiasCrate
+from sparkybiasd.simbus import SimulatedBus
+from sparkybiasd.telemetry import TelemetryBuffer
+
+
+def test_missing_cards_are_skipped(sparseCrate):
+    crate, bus = sparseCrate
+    assert list(crate.cards.keys()) == [1, 2, 5], "Expected only the simulated cards to be found"
+
+
+def test_absent_repeater_raises_oserror():
+    bus = SimulatedBus(cards=[1], realtime=False)
+    with pytest.raises(OSError):
+        bus.write_byte(0x60 + 2, 0x80)
+
+
+def test_card_devices_need_connected_repeater():
+    bus = SimulatedBus(cards=[1], realtime=False)
+    with pytest.raises(OSError):
+        bus.read_word_data(0x40, 0x02)
+    bus.write_byte(0x61, 0x80)
+    bus.read_word_data(0x40, 0x02)
+
+
+def test_enable_output_and_status(sparseCrate):
+    crate, bus = sparseCrate
+    crate.enable_output(2, 4)
+    assert bus.channel(2, 4).enabled, "Expected simulated channel to follow the expander"
+    assert not bus.channel(2, 3).enabled, "Expected other channels to remain off"
+    vbus, vshunt, current, enabled, wiper = crate.get_status(2, 4)
+    assert enabled
+    assert wiper == 0
+
+
+def test_wiper_sets_simulated_output(sparseCrate):
+    crate, bus = sparseCrate
+    crate.enable_output(1, 1)
+    crate.enable_testload(1, 1)
+    board = crate.cards[1]
+    board.open()
+    board.set_wiper(1, 600)
+    board.close()
+    assert bus.channel(1, 1).rdac == [88, 255, 255, 0], "Expected thermometer coded RDAC registers"
+    bus.advance(0.1)  # let the regulator settle
+    vbus, vshunt, current, enabled, wiper = crate.get_status(1, 1)
+    expected = bus.channel(1, 1).transfer(bus.channel(1, 1).code)
+    assert vbus == pytest.approx(expected, abs=0.02)
+    assert current == pytest.approx(expected / 52 * 1000, rel=0.02)
+
+
+def test_transactions_are_counted(sparseCrate):
+    crate, bus = sparseCrate
+    bus.reset_stats()
+    crate.get_status(1, 1)
+    assert bus.stats["transactions"] > 0
+    assert bus.stats["busTime"] > 0
+    assert bus.stats["collisions"] == 0
+
+
+def test_calibration_is_not_rewritten_on_every_read(sparseCrate):
+    crate, bus = sparseCrate
+    crate.get_status(1, 1)
+    bus.reset_stats()
+    crate.get_status(1, 1)
+    assert bus.stats["ops"].get("write_word_data", 0) == 0, "Expected calibration writes to be shadowed"
+
+
+def test_power_loss_is_detected(sparseCrate, monkeypatch):
+    crate, bus = sparseCrate
+    crate.enable_output(1, 2)
+    crate.enable_testload(1, 2)
+    bus.power_cycle(1)
+    bus.write_byte(0x61, 0x00)
+    monkeypatch.setattr(crate.cards[1], "verify_interval", 0.0)
+    vbus, vshunt, current, enabled, wiper = crate.get_status(1, 2)
+    assert not enabled, "Expected the card's outputs to be reported off after a power loss"
+    assert bus.channel(1, 2).ina_calibration != 0, "Expected the INA219 to be re-calibrated"
+
+
+def test_measure_reads_each_register_with_a_repeated_start(sparseCrate):
+    crate, bus = sparseCrate
+    crate.enable_output(5, 6)
+    crate.enable_testload(5, 6)
+    board = crate.cards[5]
+    board.open()
+    board.set_wiper(6, 400)
+    bus.advance(0.1)
+    bus.reset_stats()
+    vbus, vshunt, current = board.measure(6)
+    assert bus.stats["ops"] == {"i2c_rdwr": 6 * 3}, "Expected one pointer write + read per register and sample"
+    assert vbus == pytest.approx(board.get_bus(6), abs=0.01)
+    assert current == pytest.approx(board.get_current(6), abs=0.1)
+    assert vshunt == pytest.approx(board.get_shunt(6), abs=0.1)
+    board.close()
+
+
+def test_reads_before_the_last_message_are_rejected(sparseCrate):
+    crate, bus = sparseCrate
+    crate.enable_output(1, 1)
+    crate.set_adc_profile(1, 1, "lowNoise")  # About 0.14 s per conversion, so a second poll right away is stale
+    board = crate.cards[1]
+    board.open()
+    with pytest.raises(OSError) as e:
+        bus.i2c_rdwr(smbus2.i2c_msg.write(0x40, [0x02]), smbus2.i2c_msg.read(0x40, 2),
+                     smbus2.i2c_msg.write(0x40, [0x03]), smbus2.i2c_msg.read(0x40, 2))
+    assert e.value.errno == errno.EOPNOTSUPP
+    bus.advance(0.3)
+    bus.reset_stats()
+    fresh, vbus = board.poll_conversion(1)
+    assert fresh and bus.stats["ops"] == {"i2c_rdwr": 2}, "Expected the power register read only with CNVR set"
+    bus.reset_stats()
+    assert board.poll_conversion(1)[0] is False and bus.stats["ops"] == {"i2c_rdwr": 1}
+    board.close()
+
+
+def test_adc_profile_hardware_averaging(sparseCrate):
+    crate, bus = sparseCrate
+    crate.set_adc_profile(1, 3, "averaged")
+    assert bus.channel(1, 3).ina_config == 0x3667, "Expected 16 sample averaging on both ADCs"
+    board = crate.cards[1]
+    assert board.adc_profiles[3].software_samples(6) == 1
+    board.open()
+    bus.reset_stats()
+    board.measure(3)
+    assert bus.stats["bytes"] == 3 * (2 + 3), "Expected a single read of each register"
+    board.close()
+    with pytest.raises(ValueError):
+        crate.set_adc_profile(1, 3, "doesNotExist")
+
+
+def test_settle_returns_once_output_is_stable(tmp_path):
+    bus = SimulatedBus(cards=[1], settle_tau=0.005)
+    crate = BiasCrate(bus, curve_path=str(tmp_path / "transfer_curves.yaml"))
+    crate.enable_output(1, 1)
+    board = crate.cards[1]
+    board.open()
+    board.set_wiper(1, 800)
+    waited = board.settle(1, timeout=1.0)
+    vbus = board.get_bus(1)
+    board.close()
+    # A settled output still needs a few windows whose conversion noise agrees within the threshold
+    assert waited < 0.5, "Expected the settle to end as soon as the output stopped changing"
+    assert vbus == pytest.approx(bus.channel(1, 1).transfer(bus.channel(1, 1).code), abs=0.03)
+
+
+def test_settle_waits_for_a_slow_regulator(tmp_path):
+    bus = SimulatedBus(cards=[1], settle_tau=0.05)
+    crate = BiasCrate(bus, curve_path=str(tmp_path / "transfer_curves.yaml"))
+    crate.enable_output(1, 1)
+    board = crate.cards[1]
+    board.open()
+    board.set_wiper(1, 800)
+    waited = board.settle(1, timeout=1.0)
+    vbus = board.get_bus(1)
+    board.close()
+    assert waited < 0.8, "Expected the settle to end before the timeout"
+    assert vbus == pytest.approx(bus.channel(1, 1).transfer(bus.channel(1, 1).code), abs=0.02)
+
+
+def test_seek_with_a_slow_regulator_ends_on_the_right_wiper(tmp_path):
+    bus = SimulatedBus(cards=[1], settle_tau=0.05)
+    crate = BiasCrate(bus, curve_path=str(tmp_path / "transfer_curves.yaml"))
+    crate.enable_output(1, 1)
+    wiper, vbus, iterations = crate.seek_voltage(1, 1, 2.0)
+    assert vbus == pytest.approx(2.0, abs=0.01)
+    assert bus.channel(1, 1).transfer(bus.channel(1, 1).code) == pytest.approx(2.0, abs=0.02), \
+        "Expected the settled output at the final wiper to match the target"
+
+
+def test_telemetry_buffer_wraps():
+    buf = TelemetryBuffer(depth=4)
+    for i in range(6):
+        buf.append(1, 1 + i % 2, 0.1 * i, 0.0, 0.0, True, False, i, t=float(i))
+    assert buf.newest(1, 2)["wiper"] == 5
+    assert buf.newest(1, 1)["wiper"] == 4
+    assert list(buf.since(2.5)["wiper"]) == [3, 4, 5], "Expected only the retained, newer samples in order"
+    assert buf.newest(3, 1) is None
+
+
+def test_get_status_served_from_telemetry(sparseCrate):
+    crate, bus = sparseCrate
+    crate.enable_output(1, 3)
+    board = crate.cards[1]
+    board.open()
+    board.set_wiper(3, 400)
+    board.close()
+    crate.sweep_telemetry()
+    bus.reset_stats()
+    vbus, vshunt, current, enabled, wiper = crate.get_status(1, 3, max_age=60)
+    assert bus.stats["transactions"] == 0, "Expected a fresh sample to be served without touching the bus"
+    assert enabled and wiper == 400 and vbus > 0
+    board.open()
+    board.set_wiper(3, 500)
+    board.close()
+    bus.reset_stats()
+    assert crate.get_status(1, 3, max_age=60)[4] == 500
+    assert bus.stats["transactions"] > 0, "Expected a wiper change to force a live read"
+
+
+def test_crate_status_snapshot(sparseCrate):
+    crate, bus = sparseCrate
+    crate.enable_output(2, 1)
+    crate.enable_testload(2, 1)
+    bus.advance(0.1)
+    bus.reset_stats()
+    snapshot = crate.get_crate_status(navg=2)
+    assert [entry["card"] for entry in snapshot] == [1, 2, 5]
+    # Per card: repeater on/off and 8 channels * 2 samples * 3 registers
+    assert bus.stats["transactions"] == 3 * (2 + 8 * 2 * 3), "Expected one repeater open/close per card"
+    card2 = snapshot[1]
+    assert card2["outputEnables"] == 0b1 and card2["testloadEnables"] == 0b1
+    assert len(card2["vbus"]) == 8
+    vbus, vshunt, current, enabled, wiper = crate.get_status(2, 1)
+    assert card2["vbus"][0] == pytest.approx(vbus, abs=0.02)
+    assert crate.get_crate_status(cards=[5], channels=[3])[0]["wiper"] == [0]
+
+
+def test_repeater_stays_selected_between_operations(sparseCrate):
+    crate, bus = sparseCrate
+    crate.check_bus = True
+    crate.get_status(2, 1)
+    bus.reset_stats()
+    crate.check_bus = False
+    crate.get_status(2, 1)
+    crate.get_status(2, 3)
+    assert bus.stats["ops"].get("write_byte", 0) == 0, "Expected no repeater writes for consecutive ops on a card"
+    crate.check_bus = True
+    crate.enable_output(5, 1)
+    assert [c for c in (1, 2, 5) if bus.read_byte(0x60 + c) & 0x80] == [5], "Expected only card 5 to be connected"
+    crate.seek_many([(1, 1, 0.5), (5, 1, 0.5)], "vbus")
+    crate.get_crate_status()
+    assert bus.stats["collisions"] == 0
+
+
+def test_wiper_and_expander_delta_writes(sparseCrate):
+    crate, bus = sparseCrate
+    crate.enable_output(1, 4)
+    board = crate.cards[1]
+    board.open()
+    board.set_wiper(4, 600)
+    bus.reset_stats()
+    board.set_wiper(4, 601)
+    assert bus.stats["ops"] == {"write_byte_data": 1}, "Expected a one code step to write a single RDAC"
+    assert bus.channel(1, 4).rdac == [89, 255, 255, 0]
+    bus.reset_stats()
+    board.enable_chan(4, True)
+    board.set_wiper(4, 601)
+    assert bus.stats["transactions"] == 0, "Expected unchanged expander and wipers not to be rewritten"
+    board.close()
+
+
+def test_wiper_table_matches_thermometer_code():
+    for code in range(1023 + 1):
+        x = 0
+        for _ in range(code // 256):
+            x = (x | 255) << 8
+        x += code % 256
+        assert WIPER_RDAC_TABLE[code] == tuple((x >> (8 * i)) & 0xFF for i in range(4))
+
+
+
+def test_held_repeater_is_kept_while_operations_succeed(sparseCrate, monkeypatch):
+    crate, bus = sparseCrate
+    monkeypatch.setattr(crate.cards[2], "verify_interval", 0.05)
+    crate.enable_output(2, 1)
+    bus.reset_stats()
+    for _ in range(6):
+        time.sleep(0.02)
+        crate.enable_testload(2, 1)
+        crate.disable_testload(2, 1)
+    assert bus.stats["ops"].get("write_byte", 0) == 0, "Expected switching commands alone to keep the card held"
+    time.sleep(0.06)
+    crate.enable_testload(2, 1)
+    assert bus.stats["ops"]["write_byte"] == 1, "Expected the repeater to be rewritten after an idle verify_interval"
+
+def test_emergency_disable_latency(tmp_path):
+    """Regression threshold for the crate shutdown fast path on a full crate at 100 kHz."""
+    bus = SimulatedBus(realtime=False)
+    crate = BiasCrate(bus, curve_path=str(tmp_path / "transfer_curves.yaml"))
+    crate.enable_all_outputs()
+    for board in crate.cards.values():
+        board.open()
+        for ch in range(1, 8 + 1):
+            board.set_wiper(ch, 700)
+        board.close()
+    crate.clock = bus.now
+    timing = crate.emergency_disable()
+    assert not any(bus.channel(c, ch).enabled for c in crate.cards for ch in range(1, 8 + 1))
+    assert all(bus.channel(c, ch).rdac == [0, 0, 0, 0] for c in crate.cards for ch in range(1, 8 + 1))
+    assert timing["safe"] < 0.020, f"All outputs took {timing['safe'] * 1000:.1f} ms to turn off"
+    assert crate.metrics["emergencyDisable"]["worstSafe"] == timing["safe"]
+
+
+
+def test_emergency_disable_zeroes_wipers_behind_a_stale_shadow(sparseCrate):
+    crate, bus = sparseCrate
+    crate.disable_output(1, 1, zero_wiper=True)
+    crate.enable_output(1, 1)
+    bus.channel(1, 1).write_rdac(0, 40)  # Changed behind the daemon's back, the shadow still says 0
+    bus.channel(1, 1).write_rdac(1, 255)
+    crate.emergency_disable()
+    assert bus.channel(1, 1).rdac == [0, 0, 0, 0]
+    assert crate.cards[1].rdac_shadow[1] == [0, 0, 0, 0]
+
+def _card_settings(cards, overrides):
+    settings = {
+        f"card{c}": {f"chan{j}": {"output": False, "wiper": 0, "adcProfile": "default"} for j in range(1, 8 + 1)}
+        for c in cards
+    }
+    for (c, j), value in overrides.items():
+        settings[f"card{c}"][f"chan{j}"].update(value)
+    return {"biasCards": settings}
+
+
+def test_load_config_applies_only_differences(sparseCrate, tmp_path, monkeypatch):
+    crate, bus = sparseCrate
+    monkeypatch.setattr(midlevel, "CONFIGPATH", str(tmp_path) + "/")
+    OmegaConf.save(OmegaConf.create(_card_settings([1, 2, 5], {(2, 3): {"output": True, "wiper": 600}})),
+                   str(tmp_path / "config.yaml"))
+    crate.load_config(enable_outputs=True)
+    assert bus.channel(2, 3).enabled and bus.channel(2, 3).rdac == [88, 255, 255, 0]
+    bus.reset_stats()
+    assert crate.load_config(enable_outputs=True) == []
+    assert bus.stats["transactions"] == 0, "Expected a config matching the hardware not to be rewritten"
+
+    OmegaConf.save(OmegaConf.create(_card_settings([1, 2, 5], {(2, 3): {"output": True, "wiper": 601}})),
+                   str(tmp_path / "config.yaml"))
+    plan = crate.load_config(enable_outputs=True, dry_run=True)
+    # Switching the repeaters over from card 5 plus a single RDAC write
+    assert plan == [{"card": 2, "wipers": {"chan3": {"from": 600, "to": 601}}, "adcProfiles": {}, "transactions": 3}]
+    assert bus.channel(2, 3).rdac == [88, 255, 255, 0], "Expected a dry run not to touch the hardware"
+    bus.reset_stats()
+    crate.load_config(enable_outputs=True)
+    assert bus.stats["transactions"] == plan[0]["transactions"]
+
+
+def test_load_config_stops_before_a_card_with_a_pending_disable(sparseCrate, tmp_path, monkeypatch):
+    crate, bus = sparseCrate
+    monkeypatch.setattr(midlevel, "CONFIGPATH", str(tmp_path) + "/")
+    OmegaConf.save(OmegaConf.create(_card_settings([1, 2, 5], {(1, 1): {"wiper": 600}, (2, 3): {"wiper": 600}})),
+                   str(tmp_path / "config.yaml"))
+    crate.preempted_outputs.add((2, 1))
+    with pytest.raises(midlevel.Preempted, match="after 1 of"):
+        crate.load_config()
+    assert bus.channel(1, 1).rdac[0] == 88 and bus.channel(2, 3).rdac[0] != 88
+    crate.preempted_outputs.clear()
+
+
+def test_load_config_marks_a_failing_card_lost(sparseCrate, tmp_path, monkeypatch):
+    crate, bus = sparseCrate
+    monkeypatch.setattr(midlevel, "CONFIGPATH", str(tmp_path) + "/")
+    OmegaConf.save(OmegaConf.create(_card_settings([1, 2, 5], {(2, 3): {"wiper": 600}, (2, 4): {"wiper": 600}})),
+                   str(tmp_path / "config.yaml"))
+    board = crate.cards[2]
+    set_wiper = board.set_wiper
+
+    def failing_set_wiper(channel, value):
+        if channel == 4:
+            raise OSError(errno.EREMOTEIO, "Remote I/O error")
+        set_wiper(channel, value)
+
+    monkeypatch.setattr(board, "set_wiper", failing_set_wiper)
+    with pytest.raises(OSError):
+        crate.load_config()
+    assert bus.channel(2, 3).rdac[0] == 88, "Expected the writes before the failure to have gone out"
+    assert all(v is None for v in board.rdac_shadow[3]), "Expected the card to be marked lost"
+    assert bus.connected_cards() == [], "Expected the card's selection to be closed"
+
+
+@pytest.mark.parametrize("setting", [{"wiper": -1}, {"wiper": 1024}, {"wiper": "600"}, {"wiper": 600.5},
+                                     {"wiper": True}, {"adcProfile": "doesNotExist"}])
+def test_plan_config_rejects_invalid_settings(sparseCrate, setting):
+    crate, bus = sparseCrate
+    settings = OmegaConf.create(_card_settings([1, 2, 5], {(2, 3): setting})).biasCards
+    with pytest.raises(midlevel.ConfigError, match="card2.chan3"):
+        crate.plan_config(settings)
+
+
+def test_load_config_reports_invalid_settings(sparseCrate, tmp_path, monkeypatch):
+    crate, bus = sparseCrate
+    monkeypatch.setattr(midlevel, "CONFIGPATH", str(tmp_path) + "/")
+    OmegaConf.save(OmegaConf.create(_card_settings([1, 2, 5], {(1, 1): {"wiper": 500}, (2, 3): {"wiper": -5}})),
+                   str(tmp_path / "config.yaml"))
+    res = json.loads(daemon.load_config(crate, {"enableOutputs": True, "dryRun": False}))
+    assert res["code"] == -102 and "card2.chan3.wiper" in res["msg"]
+    assert bus.channel(1, 1).rdac == [0, 0, 0, 0], "Expected nothing to be written when the config is invalid"
+
+
+def test_load_config_accepts_a_null_dry_run(sparseCrate, tmp_path, monkeypatch):
+    crate, bus = sparseCrate
+    monkeypatch.setattr(midlevel, "CONFIGPATH", str(tmp_path) + "/")
+    OmegaConf.save(OmegaConf.create(_card_settings([1, 2, 5], {(2, 3): {"wiper": 600}})), str(tmp_path / "config.yaml"))
+    valid, args = daemon.validate_command(
+        {"command": "loadConfig", "args": {"enableOutputs": False, "createNewConfig": False, "dryRun": None}})
+    res = json.loads(daemon.load_config(crate, args))
+    assert res["status"] == "success" and bus.channel(2, 3).rdac[0] == 88
+
+
+def test_seek_progress_events(sparseCrate, monkeypatch):
+    crate, bus = sparseCrate
+    crate.enable_output(1, 3)
+    events = []
+    crate.progress = events.append
+    monkeypatch.setitem(midlevel.conf.progress, "interval", 0.0)
+    wiper, value, iterations = crate.seek_voltage(1, 3, 2.0)
+    assert [e["iteration"] for e in events] == list(range(1, iterations + 1))
+    assert events[-1]["done"] and events[-1]["wiper"] == wiper and events[-1]["value"] == value
+    assert events[-1]["delta"] == pytest.approx(value - 2.0)
+    assert not any(e["done"] for e in events[:-1])
+
+    events.clear()
+    monkeypatch.setitem(midlevel.conf.progress, "interval", 3600.0)
+    wiper, value, iterations = crate.seek_voltage(1, 3, 4.0)
+    assert iterations > 2
+    assert [e["iteration"] for e in events] == [1, iterations], "Expected only the first and last event"
@@ -0,0 +1,90 @@
+import asyncio
+import json
+
+import pytest
+
+from sparkybiasd import daemon, sockets
+from sparkybiasd.scheduler import BusScheduler
+from sparkybiasd.sockets import SocketServer, encode_frame, read_frame
+
+
+def serve(crate, client, **listen):
+    """Run client(server) against a SocketServer dispatching to the daemon's command table."""
+
+    async def scenario():
+        scheduler = BusScheduler(crate)
+        scheduler.start()
+        server = SocketServer(lambda command: daemon.respond(scheduler, command, None), max_frame=4096)
+        await server.start(**listen)
+        try:
+            return await client(server)
+        finally:
+            await server.close()
+            await scheduler.stop()
+
+    return asyncio.run(scenario())
+
+
+async def send(writer, command):
+    payload = command if isinstance(command, bytes) else json.dumps(command).encode()
+    writer.write(encode_frame(payload))
+    await writer.drain()
+
+
+def test_pipelined_commands_over_unix_socket(simCrate, tmp_path):
+    crate, bus = simCrate
+    path = str(tmp_path / "sparkybiasd.sock")
+
+    async def client(server):
+        reader, writer = await asyncio.open_unix_connection(path)
+        await send(writer, {"id": "seek", "command": "seekVoltage", "args": {"card": 1, "channel": 1, "voltage": 2.0}})
+        await send(writer, {"id": "status", "command": "getStatus", "args": {"card": 2, "channel": 1}})
+        await send(writer, b"{not json")
+        replies = [json.loads(await read_frame(reader, 4096)) for _ in range(3)]
+        writer.close()
+        await writer.wait_closed()
+        return replies
+
+    replies = serve(crate, client, unix_path=path)
+    by_id = {r.get("id"): r for r in replies}
+    assert by_id["seek"]["vbus"] == pytest.approx(2.0, abs=0.02)
+    assert by_id["status"]["status"] == "success"
+    assert by_id[None]["code"] == -2
+    assert replies[-1]["id"] == "seek", "Expected the seek to reply last"
+
+
+def test_tcp_frames(simCrate, monkeypatch):
+    crate, bus = simCrate
+    monkeypatch.setattr(sockets, "msgpack", None)
+
+    async def client(server):
+        reader, writer = await asyncio.open_connection("127.0.0.1", server.tcp_port)
+        await send(writer, {"command": "getAvailableCards", "args": {}})
+        cards = json.loads(await read_frame(reader, 4096))
+        await send(writer, b"\x82\xa7command")
+        binary = json.loads(await read_frame(reader, 4096))
+        writer.write(sockets.HEADER.pack(5000))
+        closed = await reader.read()
+        writer.close()
+        return cards, binary, closed
+
+    cards, binary, closed = serve(crate, client, tcp_host="127.0.0.1", tcp_port=0)
+    assert cards == {"status": "success", "cards": [1, 2]}
+    assert binary["code"] == -2 and "msgpack" in binary["msg"]
+    assert closed == b"", "Expected an oversized frame to close the connection"
+
+
+def test_msgpack_frames(simCrate, tmp_path):
+    msgpack = pytest.importorskip("msgpack")
+    crate, bus = simCrate
+    path = str(tmp_path / "sparkybiasd.sock")
+
+    async def client(server):
+        reader, writer = await asyncio.open_unix_connection(path)
+        await send(writer, msgpack.packb({"id": 1, "command": "getStatus", "args": {"card": 1, "channel": 1}}))
+        res = msgpack.unpackb(await read_frame(reader, 4096))
+        writer.close()
+        return res
+
+    res = serve(crate, client, unix_path=path)
+    assert res["id"] == 1 and res["status"] == "success" and res["outputEnabled"]
@@ -0,0 +1,104 @@
+import asyncio
+import json
+
+import pytest
+import redis.exceptions
+
+from sparkybiasd.dconf import conf
+from sparkybiasd.telestream import TelemetryStream
+
+
+class FakeRedis:
+    """Records XADDs, optionally failing the next one."""
+
+    def __init__(self):
+        self.entries = []
+        self.fail = False
+
+    async def xadd(self, stream, fields, maxlen, approximate):
+        if self.fail:
+            self.fail = False
+            raise redis.exceptions.ConnectionError("gone")
+        self.entries.append((stream, maxlen, {**fields, "channels": json.loads(fields["channels"])}))
+
+
+def publish(stream, times=1):
+    for _ in range(times):
+        asyncio.run(stream.publish())
+    return [fields for _, _, fields in stream.r.entries]
+
+
+def test_keyframes_and_deltas(simCrate):
+    crate, bus = simCrate
+    crate.sweep_telemetry()
+    r = FakeRedis()
+    deadband = {"vbus": 0.01, "vshunt": 0.1, "current": 0.01}
+    stream = TelemetryStream(crate, r, "telemetry", keyframe_every=3, max_len=100, deadband=deadband)
+    frames = publish(stream)
+    assert r.entries[0][:2] == ("telemetry", 100)
+    assert frames[0]["keyframe"] == 1 and set(frames[0]["channels"]) == {"1:1", "2:1"}
+    assert frames[0]["channels"]["1:1"][4:] == [1, 0, crate.cards[1].wiper_states[0]]
+
+    crate.seek_voltage(2, 1, 1.0)
+    crate.sweep_telemetry()
+    frames = publish(stream)
+    assert frames[1]["keyframe"] == 0 and set(frames[1]["channels"]) == {"2:1"}
+    assert frames[1]["channels"]["2:1"][1] == pytest.approx(1.0, abs=0.02)
+
+    crate.sweep_telemetry()
+    frames = publish(stream)
+    assert len(frames) == 2, "Expected no frame without changes"
+    assert stream.stats["skipped"] == 1
+
+    frames = publish(stream)
+    assert frames[2]["keyframe"] == 1 and len(frames[2]["channels"]) == 2
+    assert [f["seq"] for f in frames] == [0, 1, 2], "Expected the skipped delta not to use up a seq"
+
+
+def test_default_deadbands_hold_back_noise(simCrate):
+    crate, bus = simCrate
+    crate.enable_testload(1, 1)
+    crate.seek_voltage(1, 1, 2.0)
+    crate.sweep_telemetry()
+    t = conf.telemetry.stream
+    stream = TelemetryStream(crate, FakeRedis(), "telemetry", keyframe_every=100, deadband=t.deadband)
+    publish(stream)
+    for _ in range(20):
+        crate.sweep_telemetry()
+        publish(stream)
+    assert crate.telemetry.newest(1, 1)["current"] > 1.0, "Expected a loaded channel with a noisy current reading"
+    assert stream.stats["frames"] == 1 and stream.stats["skipped"] == 20, "Expected a steady output not to be resent"
+    crate.seek_voltage(1, 1, 2.5)
+    crate.sweep_telemetry()
+    frames = publish(stream)
+    assert set(frames[-1]["channels"]) == {"1:1"} and frames[-1]["seq"] == 1
+
+
+def test_switching_is_sent_without_a_new_measurement(simCrate):
+    crate, bus = simCrate
+    crate.sweep_telemetry()
+    stream = TelemetryStream(crate, FakeRedis(), "telemetry", keyframe_every=10)
+    publish(stream)
+    crate.enable_testload(1, 1)
+    frames = publish(stream)
+    assert set(frames[1]["channels"]) == {"1:1"} and frames[1]["channels"]["1:1"][5] == 1
+
+
+def test_failed_write_resyncs_with_a_keyframe(simCrate):
+    crate, bus = simCrate
+    crate.sweep_telemetry()
+    r = FakeRedis()
+    stream = TelemetryStream(crate, r, "telemetry", interval=0.001, keyframe_every=100)
+    publish(stream)
+    crate.seek_voltage(1, 1, 1.0)
+    crate.sweep_telemetry()
+    r.fail = True
+
+    async def scenario():
+        task = asyncio.create_task(stream.run())
+        while len(r.entries) < 2:
+            await asyncio.sleep(0.001)
+        task.cancel()
+
+    asyncio.run(scenario())
+    assert r.entries[1][2]["keyframe"] == 1 and len(r.entries[1][2]["channels"]) == 2
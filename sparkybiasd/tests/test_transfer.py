@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+from sparkybiasd.midlevel import BiasCrate
+from sparkybiasd.simbus import SimulatedBus
+from sparkybiasd.transfer import TransferCurve, TransferCurves
+
+
+def test_curve_predict_and_inverse():
+    curve = TransferCurve({0: 0.0, 100: 1.0, 200: 2.5})
+    assert curve.predict(50) == pytest.approx(0.5)
+    assert curve.predict(150) == pytest.approx(1.75)
+    assert curve.predict(300) is None, "Expected no extrapolation past the measured range"
+    wiper, slope = curve.inverse(1.75)
+    assert wiper == 150
+    assert slope == pytest.approx(0.015)
+    assert curve.inverse(3.0) is None
+
+
+def test_drift_invalidates_curve(tmp_path):
+    curves = TransferCurves(str(tmp_path / "tc.yaml"))
+    for w in (0, 100, 200):
+        curves.record(1, 1, w, vbus=w / 100)
+    assert len(curves.get(1, 1, "vbus")) == 3
+    curves.record(1, 1, 105, vbus=1.07)
+    assert len(curves.get(1, 1, "vbus")) == 4, "Small deviations should be kept"
+    curves.record(1, 1, 150, vbus=1.3)
+    assert len(curves.get(1, 1, "vbus")) == 5, "Expected no drift check far from the learned points"
+    curves.record(1, 1, 150, vbus=3.0)
+    assert len(curves.get(1, 1, "vbus")) == 1, "Expected the drifted curve to be thrown away"
+
+
+def test_curves_persist(tmp_path):
+    path = str(tmp_path / "tc.yaml")
+    curves = TransferCurves(path)
+    curves.record(3, 7, 10, vbus=0.1, current=1.0)
+    curves.record(3, 7, 20, vbus=0.2, current=2.0)
+    curves.flush(force=True)
+    loaded = TransferCurves(path)
+    assert loaded.as_dict(3, 7) == curves.as_dict(3, 7)
+
+
+def test_seek_uses_learned_curve(tmp_path):
+    bus = SimulatedBus(cards=[1], realtime=False)
+    crate = BiasCrate(bus, curve_path=str(tmp_path / "tc.yaml"))
+    crate.enable_output(1, 1)
+    for v in (1.0, 3.0, 0.5, 4.0):
+        crate.seek_voltage(1, 1, v)
+    wiper, value, iterations = crate.seek_voltage(1, 1, 2.0)
+    assert value == pytest.approx(2.0, abs=0.01)
+    assert iterations <= 2, "Expected a seek inside the learned range to only fine tune"
+
+
+def test_curves_keep_at_most_max_points(tmp_path):
+    curves = TransferCurves(str(tmp_path / "tc.yaml"), max_points=8)
+    for w in range(0, 1024, 8):
+        curves.record(1, 1, w, vbus=w / 256)
+    curve = curves.get(1, 1, "vbus")
+    assert len(curve) == 8
+    wipers = [w for w, _ in curve.sorted_points()]
+    assert wipers[0] == 0 and wipers[-1] == 1016, "Expected the curve to keep covering its range"
+    assert max(b - a for a, b in zip(wipers, wipers[1:])) <= 4 * min(b - a for a, b in zip(wipers, wipers[1:]))
+    curves.record(1, 1, 500, vbus=500 / 256)
+    assert 500 in curve.points, "Expected the newest point to be kept"
+    curves.flush(force=True)
+    assert len(TransferCurves(str(tmp_path / "tc.yaml"), max_points=4).get(1, 1, "vbus")) == 4
+
+
+def test_seeks_only_save_after_save_interval(tmp_path):
+    path = tmp_path / "tc.yaml"
+    bus = SimulatedBus(cards=[1], realtime=False)
+    crate = BiasCrate(bus, curve_path=str(path))
+    crate.enable_output(1, 1)
+    crate.curves.last_save = time.monotonic()
+    crate.seek_voltage(1, 1, 1.0)
+    assert not path.exists(), "Expected a seek not to write the curves before saveInterval passed"
+    crate.curves.last_save -= crate.curves.save_interval
+    crate.seek_voltage(1, 1, 2.0)
+    assert path.exists()